@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark for uncertainty detection
+Compares the per-pattern re.search loop with the single-pass PatternMatcher
+"""
+import argparse
+import random
+import re
+import time
+
+from gemini_integration import PATTERN_CATEGORIES, GeminiIntegration
+
+SIZES = {
+    '1KB': 1024,
+    '100KB': 100 * 1024,
+    '5MB': 5 * 1024 * 1024,
+}
+
+# Neutral filler with an occasional trigger word, closer to real assistant output
+FILLER = [
+    "the", "function", "returns", "value", "config", "server", "request",
+    "코드를", "수정했습니다", "파일", "설정", "함수", "\n", "and", "then",
+]
+TRIGGERS = ["I think", "에러", "production", "여러 방법", "maybe", "how to"]
+
+
+def per_pattern_detect(text: str):
+    """Reference implementation: one re.search per pattern"""
+    found_patterns = []
+    for category, patterns in PATTERN_CATEGORIES:
+        for pattern in patterns:
+            if re.search(pattern, text, re.IGNORECASE):
+                found_patterns.append(f"{category}: {pattern}")
+    return len(found_patterns) > 0, found_patterns
+
+
+def make_text(size: int, trigger_rate: float, seed: int = 0) -> str:
+    """Build roughly ``size`` characters of pseudo-random text"""
+    rng = random.Random(seed)
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(TRIGGERS) if rng.random() < trigger_rate else rng.choice(FILLER)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)[:size]
+
+
+def best_of(func, text: str, repeat: int) -> float:
+    """Best wall-clock time over ``repeat`` runs"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(text)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark detect_uncertainty")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per measurement (default: 5)")
+    parser.add_argument("--trigger-rate", type=float, default=0.0005,
+                        help="Fraction of words that are trigger phrases (default: 0.0005)")
+    args = parser.parse_args()
+
+    integration = GeminiIntegration({'log_consultations': False})
+
+    print(f"{'size':>6}  {'per-pattern':>12}  {'single-pass':>12}  {'speedup':>8}")
+    for label, size in SIZES.items():
+        text = make_text(size, args.trigger_rate)
+        assert per_pattern_detect(text) == integration.detect_uncertainty(text)
+
+        repeat = args.repeat if size < SIZES['5MB'] else max(1, args.repeat // 2)
+        baseline = best_of(per_pattern_detect, text, repeat)
+        compiled = best_of(integration.detect_uncertainty, text, repeat)
+        print(f"{label:>6}  {baseline * 1000:10.2f}ms  {compiled * 1000:10.2f}ms  {baseline / compiled:7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,14 +4,50 @@ Gemini CLI Integration Module
 Provides automatic consultation with Gemini for second opinions and validation
 """
 import asyncio
+import bisect
+import codecs
+import errno
+import hashlib
+import heapq
+import inspect
+import io
 import json
 import logging
+import mmap
+import os
+import random
 import re
+import signal
+import sqlite3
 import subprocess
+import sys
+import tempfile
+import threading
 import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
 from datetime import datetime
+from functools import partial
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Awaitable, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
+
+try:
+    import httpx
+except ImportError:  # Only needed for the HTTP backend
+    httpx = None
+
+try:
+    import h2  # noqa: F401 - enables HTTP/2 in httpx
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
@@ -79,66 +115,1934 @@ UNCERTAINTY_PATTERNS = [
     r"\bwrong\b"
 ]
 
-# Complex decision patterns that benefit from second opinions
-COMPLEX_DECISION_PATTERNS = [
-    # English patterns
-    r"\bmultiple approaches\b",
-    r"\bseveral options\b",
-    r"\btrade-offs?\b",
-    r"\bconsider(?:ing)?\b",
-    r"\balternatives?\b",
-    r"\bpros and cons\b",
-    r"\bweigh(?:ing)? the options\b",
-    r"\bchoice between\b",
-    r"\bdecision\b",
-    # Korean patterns
-    r"어떤 게 좋",
-    r"뭐가 나은",
-    r"어느 것",
-    r"선택",
-    r"결정",
-    r"고민",
-    r"여러 방법",
-    r"여러 가지",
-    r"장단점",
-    r"비교",
-    r"vs",
-    r"대",
-    r"중에",
-    # Help/Assistance patterns (Korean)
-    r"도와줘",
-    r"도움",
-    r"해줘",
-    r"알려줘",
-    r"가르쳐",
-    r"설명해",
-    r"방법",
-    r"어떻게",
-    r"왜",
-    r"뭔가",
-    # Help/Assistance patterns (English)
-    r"\bhelp\b",
-    r"\bassist\b",
-    r"\bguide\b",
-    r"\bshow me\b",
-    r"\btell me\b",
-    r"\bexplain\b",
-    r"\bhow to\b",
-    r"\bwhat should\b",
-    r"\bwhy\b"
-]
+# Complex decision patterns that benefit from second opinions
+COMPLEX_DECISION_PATTERNS = [
+    # English patterns
+    r"\bmultiple approaches\b",
+    r"\bseveral options\b",
+    r"\btrade-offs?\b",
+    r"\bconsider(?:ing)?\b",
+    r"\balternatives?\b",
+    r"\bpros and cons\b",
+    r"\bweigh(?:ing)? the options\b",
+    r"\bchoice between\b",
+    r"\bdecision\b",
+    # Korean patterns
+    r"어떤 게 좋",
+    r"뭐가 나은",
+    r"어느 것",
+    r"선택",
+    r"결정",
+    r"고민",
+    r"여러 방법",
+    r"여러 가지",
+    r"장단점",
+    r"비교",
+    r"vs",
+    r"대",
+    r"중에",
+    # Help/Assistance patterns (Korean)
+    r"도와줘",
+    r"도움",
+    r"해줘",
+    r"알려줘",
+    r"가르쳐",
+    r"설명해",
+    r"방법",
+    r"어떻게",
+    r"왜",
+    r"뭔가",
+    # Help/Assistance patterns (English)
+    r"\bhelp\b",
+    r"\bassist\b",
+    r"\bguide\b",
+    r"\bshow me\b",
+    r"\btell me\b",
+    r"\bexplain\b",
+    r"\bhow to\b",
+    r"\bwhat should\b",
+    r"\bwhy\b"
+]
+
+# Critical operations that should trigger consultation
+CRITICAL_OPERATION_PATTERNS = [
+    r"\bproduction\b",
+    r"\bdatabase migration\b",
+    r"\bsecurity\b",
+    r"\bauthentication\b",
+    r"\bencryption\b",
+    r"\bAPI key\b",
+    r"\bcredentials?\b",
+    r"\bperformance\s+critical\b"
+]
+
+
+# Pattern categories in the order their hits are reported by detect_uncertainty
+PATTERN_CATEGORIES = [
+    ('uncertainty', UNCERTAINTY_PATTERNS),
+    ('complex_decision', COMPLEX_DECISION_PATTERNS),
+    ('critical_operation', CRITICAL_OPERATION_PATTERNS),
+]
+
+
+class PatternMatcher:
+    """
+    Precompiled single-pass matcher over all pattern categories.
+
+    Matching runs in two stages. A candidate scan runs one case-sensitive
+    alternation of all patterns - lower-cased and with ``\\b`` assertions
+    removed, so the regex engine can skip non-matching branches cheaply -
+    over a lower-cased copy of the text. At each candidate position only the
+    patterns that can start with that character are verified with their
+    original case-insensitive regex, which keeps the result identical to a
+    ``re.search`` per pattern.
+    """
+
+    # Hits of already-known patterns tolerated before narrowing the candidate scan
+    NARROW_AFTER = 32
+
+    # Characters that make a pattern's first character non-literal
+    _SPECIAL = set("\\.^$*+?{}[]|()")
+
+    def __init__(self, categories: Optional[List[Tuple[str, List[str]]]] = None):
+        categories = PATTERN_CATEGORIES if categories is None else categories
+        self.patterns: List[Tuple[str, str]] = [
+            (category, pattern)
+            for category, patterns in categories
+            for pattern in patterns
+        ]
+        self.labels = [f"{category}: {pattern}" for category, pattern in self.patterns]
+        self.categories = list(dict.fromkeys(category for category, _ in self.patterns))
+        self._verifiers = [re.compile(pattern, re.IGNORECASE) for _, pattern in self.patterns]
+        self.max_match_length = max((self._match_length(pattern) for _, pattern in self.patterns), default=0)
+        self._all = tuple(range(len(self.patterns)))
+        self._candidate_sources = [self._candidate_source(pattern) for _, pattern in self.patterns]
+        self._candidates: Dict[Tuple[int, ...], Any] = {}
+        self._fallback = re.compile(
+            "|".join(f"(?:{self._candidate_source(pattern, lower=False)})" for _, pattern in self.patterns),
+            re.IGNORECASE
+        )
+
+        # Bucket pattern indices by the literal character they must start with
+        self._buckets: Dict[str, List[int]] = {}
+        self._anywhere: List[int] = []
+        for index, source in enumerate(self._candidate_sources):
+            first = source[:1]
+            if (not first or first in self._SPECIAL or source[1:2] in ("*", "?", "{")
+                    or self._has_top_level_alternation(source)):
+                self._anywhere.append(index)
+            else:
+                self._buckets.setdefault(first, []).append(index)
+        for first in self._buckets:
+            self._buckets[first] = sorted(self._buckets[first] + self._anywhere)
+
+        self._casefix, self._casefix_regex = self._build_casefix()
+
+    def __len__(self) -> int:
+        return len(self.patterns)
+
+    @staticmethod
+    def _match_length(pattern: str) -> int:
+        """Longest match of a pattern, or its shortest for unbounded ones (e.g. ``\\s+``)"""
+        shortest, longest = sre_parse.parse(pattern, re.IGNORECASE).getwidth()
+        return shortest if longest >= sre_parse.MAXREPEAT else longest
+
+    @staticmethod
+    def _candidate_source(pattern: str, lower: bool = True) -> str:
+        """Lower-case the literal parts of a pattern and drop word boundaries"""
+        segments = re.findall(r"\\.|[^\\]+", pattern)
+        return "".join(
+            ("" if segment in ("\\b", "\\B") else segment) if segment.startswith("\\")
+            else segment.lower() if lower else segment
+            for segment in segments
+        )
+
+    @staticmethod
+    def _has_top_level_alternation(source: str) -> bool:
+        """Whether a pattern has a ``|`` outside any group or character class"""
+        depth = 0
+        in_class = False
+        escaped = False
+        for char in source:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif in_class:
+                in_class = char != "]"
+            elif char == "[":
+                in_class = True
+            elif char == "(":
+                depth += 1
+            elif char == ")":
+                depth -= 1
+            elif char == "|" and depth == 0:
+                return True
+        return False
+
+    def _build_casefix(self) -> Tuple[Dict[int, str], Any]:
+        """
+        Map characters that IGNORECASE equates with a pattern character but
+        that ``str.lower`` does not (e.g. U+017F LATIN SMALL LETTER LONG S).
+        """
+        cased = sorted({
+            char for source in self._candidate_sources
+            for char in source if char.upper() != char.lower()
+        })
+        if not cased:
+            return {}, None
+        cased_class = re.compile("[%s]" % re.escape("".join(cased)), re.IGNORECASE)
+        casefix = {}
+        for codepoint in range(0x80, 0x10000):
+            char = chr(codepoint)
+            if cased_class.match(char) and char.lower() not in cased:
+                for target in cased:
+                    if re.match(re.escape(target), char, re.IGNORECASE):
+                        casefix[codepoint] = target
+                        break
+        if not casefix:
+            return {}, None
+        return casefix, re.compile("[%s]" % "".join(map(chr, casefix)))
+
+    def _candidate_regex(self, indices: Tuple[int, ...]):
+        """Compile (and memoize) the candidate alternation for the given patterns"""
+        regex = self._candidates.get(indices)
+        if regex is None:
+            if len(self._candidates) >= 64:
+                self._candidates = {self._all: self._candidates[self._all]}
+            regex = re.compile(self._factored_alternation(indices)) if indices else None
+            self._candidates[indices] = regex
+        return regex
+
+    def _factored_alternation(self, indices: Tuple[int, ...]) -> str:
+        """
+        Candidate alternation factored by first character, e.g. ``a(?:x|y)|b``,
+        so the regex engine tests one literal per distinct first character.
+        """
+        by_first: Dict[str, List[str]] = {}
+        others = []
+        for index in indices:
+            source = self._candidate_sources[index]
+            if index in self._anywhere:
+                others.append(f"(?:{source})")
+            else:
+                by_first.setdefault(source[0], []).append(source[1:])
+        branches = []
+        for first, rests in by_first.items():
+            if "" in rests:
+                # A single-character pattern already makes this a candidate
+                branches.append(re.escape(first))
+            else:
+                branches.append(re.escape(first) + "(?:" + "|".join(rests) + ")")
+        return "|".join(branches + others)
+
+    def _fold(self, text: str) -> Optional[str]:
+        """Lower-cased copy of text with the same length, or None if impossible"""
+        if self._casefix_regex is not None and self._casefix_regex.search(text):
+            text = text.translate(self._casefix)
+        folded = text.lower()
+        return folded if len(folded) == len(text) else None
+
+    def iter_matches(self, text: str, pos: int = 0, start_limit: Optional[int] = None,
+                     skip: Optional[set] = None) -> Iterator[Tuple[int, int, int]]:
+        """
+        Yield ``(pattern_index, start, end)`` for every pattern occurrence.
+
+        Args:
+            text: Text to scan
+            pos: Offset to start scanning from
+            start_limit: Only report matches starting before this offset
+            skip: Pattern indices the caller no longer needs. The set may grow
+                while iterating; once enough skipped hits are seen the scan
+                continues with the remaining patterns only.
+        """
+        folded = self._fold(text)
+        if folded is None:
+            # Length-changing lower-casing (e.g. U+0130); scan the original text
+            scanned, regex = text, self._fallback
+        else:
+            remaining = tuple(i for i in self._all if i not in skip) if skip else self._all
+            scanned, regex = folded, self._candidate_regex(remaining)
+
+        redundant = 0
+        while regex is not None:
+            m = regex.search(scanned, pos)
+            if m is None:
+                break
+            start = m.start()
+            if start_limit is not None and start >= start_limit:
+                break
+
+            bucket = self._all if folded is None else self._buckets.get(folded[start], self._anywhere)
+            for index in bucket:
+                if skip is not None and index in skip:
+                    redundant += 1
+                    continue
+                hit = self._verifiers[index].match(text, start)
+                if hit is not None:
+                    yield index, start, hit.end()
+
+            if folded is not None and skip is not None and redundant > self.NARROW_AFTER:
+                regex = self._candidate_regex(tuple(i for i in self._all if i not in skip))
+                redundant = 0
+            pos = start + 1
+
+    def category_mask(self, category: str) -> int:
+        """Bitmask of the pattern indices belonging to a category"""
+        mask = 0
+        for index, (pattern_category, _) in enumerate(self.patterns):
+            if pattern_category == category:
+                mask |= 1 << index
+        return mask
+
+    def labels_for_mask(self, mask: int) -> List[str]:
+        """Pattern labels for the bits set in a hit mask"""
+        return [label for index, label in enumerate(self.labels) if mask >> index & 1]
+
+    def find_masks(self, texts: Iterable[str], group_size: int = 1 << 20) -> List[int]:
+        """
+        Return one hit bitmask per text (bit i set if pattern i matches).
+
+        Texts are joined with NUL separators into groups of about
+        ``group_size`` characters and each group is scanned once, so the
+        per-text cost is a few dictionary operations rather than a full scan
+        setup. No pattern can match a NUL, and NUL is a non-word character,
+        so word boundaries at text edges behave as they do for single texts.
+        """
+        masks: List[int] = []
+        group: List[str] = []
+        group_length = 0
+        for text in texts:
+            group.append(text)
+            group_length += len(text) + 1
+            if group_length >= group_size:
+                masks.extend(self._scan_group(group))
+                group, group_length = [], 0
+        if group:
+            masks.extend(self._scan_group(group))
+        return masks
+
+    def _scan_group(self, texts: List[str]) -> List[int]:
+        starts = []
+        offset = 0
+        for text in texts:
+            starts.append(offset)
+            offset += len(text) + 1
+        joined = "\0".join(texts)
+
+        masks = [0] * len(texts)
+        for index, start, end in self.iter_matches(joined):
+            position = bisect.bisect_right(starts, start) - 1
+            if end <= starts[position] + len(texts[position]):
+                masks[position] |= 1 << index
+        return masks
+
+    def find(self, text: str) -> List[int]:
+        """Return the sorted indices of all patterns present in text"""
+        found: set = set()
+        for index, _, _ in self.iter_matches(text, skip=found):
+            found.add(index)
+        return sorted(found)
+
+
+# Shared matcher built once at import time
+_default_matcher = PatternMatcher()
+
+# Default weights for uncertainty scoring, overridable via uncertainty_thresholds
+DEFAULT_CATEGORY_WEIGHTS = {
+    'uncertainty': 1.0,
+    'complex_decision': 0.5,
+    'critical_operation': 1.0,
+}
+
+# Explicit doubt counts double; very common words barely count on their own
+DEFAULT_PATTERN_WEIGHTS = {
+    r"\bI'm not sure\b": 2.0,
+    r"\buncertain\b": 2.0,
+    r"잘 모르겠": 2.0,
+    r"확실하지 않": 2.0,
+    r"확신이 없": 2.0,
+    r"\bnot working\b": 1.5,
+    r"\bdoesn't work\b": 1.5,
+    r"작동하지 않": 1.5,
+    r"동작하지 않": 1.5,
+    r"대": 0.1,
+    r"vs": 0.2,
+    r"중에": 0.2,
+    r"왜": 0.3,
+    r"\bwhy\b": 0.3,
+    r"문제": 0.5,
+    r"해결": 0.3,
+    r"방법": 0.3,
+    r"어떻게": 0.3,
+    r"해줘": 0.2,
+    r"도움": 0.3,
+    r"뭔가": 0.2,
+    r"예상": 0.3,
+    r"\blikely\b": 0.5,
+    r"\bconsider(?:ing)?\b": 0.3,
+    r"\bhelp\b": 0.3,
+    r"\bhow to\b": 0.3,
+    r"\btell me\b": 0.3,
+}
+
+# Score at or above which auto-consultation fires
+DEFAULT_CONSULT_SCORE = 2.0
+
+# Scheduling priority per MCP tool; lower runs first, so interactive questions overtake batch-style plans
+DEFAULT_TOOL_PRIORITIES = {
+    'consult_gemini': 0,
+    'enhance_request': 1,
+    'smart_code_generation': 1,
+    'enhance_user_request': 2,
+    'submit_consultation': 2,
+    'consult_gemini_batch': 2,
+}
+
+# Error types that are worth another attempt; authentication and a missing CLI never fix themselves
+RETRYABLE_ERROR_TYPES = ('rate_limit', 'timeout')
+
+# uncertainty_thresholds switches for each pattern category
+CATEGORY_THRESHOLD_KEYS = {
+    'uncertainty': 'uncertainty_patterns',
+    'complex_decision': 'complex_decisions',
+    'critical_operation': 'critical_operations',
+}
+
+
+class UncertaintyStream:
+    """
+    Incremental uncertainty detector fed with text chunks.
+
+    Only the last ``window`` characters are retained between chunks, so memory
+    stays bounded for streams of any length. A match is not reported as soon
+    as it occurs but once every character it could depend on has arrived,
+    which is up to ``window`` characters after it ends. ``window`` is raised
+    to one more than the matcher's longest match so no pattern is missed;
+    only ``\\s+`` runs longer than the window can still hide a match. Each
+    pattern is reported once, at its first occurrence, mirroring
+    ``GeminiIntegration.detect_uncertainty``.
+    """
+
+    def __init__(self, matcher: Optional[PatternMatcher] = None, window: int = 256):
+        self.matcher = matcher or _default_matcher
+        # The trailing word boundary needs one character after the match
+        self.window = max(window, self.matcher.max_match_length + 1)
+        self.closed = False
+        self._buffer = ""
+        self._offset = 0  # Stream offset of self._buffer[0]
+        self._scan_from = 0  # Buffer position of the first unscanned match start
+        self._found: set = set()
+
+    @property
+    def consumed(self) -> int:
+        """Number of characters fed so far"""
+        return self._offset + len(self._buffer)
+
+    @property
+    def found_patterns(self) -> List[str]:
+        """Patterns found so far, in the same order as detect_uncertainty"""
+        return [self.matcher.labels[index] for index in sorted(self._found)]
+
+    @property
+    def has_uncertainty(self) -> bool:
+        return len(self._found) > 0
+
+    def feed(self, chunk: str) -> List[Dict[str, Any]]:
+        """Add a chunk of text and return the patterns first seen in it"""
+        if self.closed:
+            raise ValueError("Cannot feed a closed UncertaintyStream")
+
+        self._buffer += chunk
+        # Any match starting before `settled` ends at least one character
+        # before the buffer does, so trailing word boundaries are decidable
+        settled = len(self._buffer) - self.window
+        if settled <= self._scan_from:
+            return []
+
+        hits = self._scan(settled)
+        # Keep one character before the unscanned region for leading \b checks
+        keep_from = settled - 1
+        self._buffer = self._buffer[keep_from:]
+        self._offset += keep_from
+        self._scan_from = settled - keep_from
+        return hits
+
+    def close(self) -> List[Dict[str, Any]]:
+        """Mark the end of the stream and return the remaining new patterns"""
+        if self.closed:
+            return []
+        hits = self._scan(None)
+        self.closed = True
+        self._buffer = ""
+        return hits
+
+    def _scan(self, start_limit: Optional[int]) -> List[Dict[str, Any]]:
+        hits = []
+        for index, start, end in self.matcher.iter_matches(
+            self._buffer, self._scan_from, start_limit, skip=self._found
+        ):
+            self._found.add(index)
+            category, pattern = self.matcher.patterns[index]
+            hits.append({
+                'pattern': self.matcher.labels[index],
+                'category': category,
+                'start': self._offset + start,
+                'end': self._offset + end
+            })
+        if hits:
+            logger.debug(f"Uncertainty detected in stream: {[hit['pattern'] for hit in hits]}")
+        return hits
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimate the Gemini token count of a text without a tokenizer.
+
+    ASCII text (English, code) averages about four characters per token,
+    while Hangul, CJK and other non-ASCII characters cost most of a token
+    each, so the two are counted separately.
+    """
+    if not text:
+        return 0
+    ascii_chars = len(text.encode('ascii', 'ignore'))
+    return int(ascii_chars / 4 + (len(text) - ascii_chars) * 0.7) + 1
+
+
+class ContextCompactor:
+    """
+    Shrinks consultation context before it is sent.
+
+    Trailing whitespace and runs of blank lines are removed, a line or block
+    of up to ``max_period`` lines repeated ``min_repeats`` or more times in a
+    row (log spam, recursive stack frames) is kept once with a note, and if
+    the result is still over ``max_tokens`` the head and tail are kept and the
+    middle is dropped. Savings are accumulated for ``gemini_status``.
+    """
+
+    def __init__(self, max_tokens: Optional[int] = None, dedupe: bool = True, normalize_whitespace: bool = True,
+                 head_ratio: float = 0.6, max_period: int = 4, min_repeats: int = 3):
+        self.max_tokens = max_tokens
+        self.dedupe = dedupe
+        self.normalize_whitespace = normalize_whitespace
+        self.head_ratio = head_ratio
+        self.max_period = max_period
+        self.min_repeats = min_repeats
+        self.runs = 0
+        self.saved_bytes = 0
+        self.saved_tokens = 0
+        self.repeated_lines_removed = 0
+        self.omitted_tokens = 0
+
+    def _collapse_repeats(self, lines: List[str]) -> Tuple[List[str], int]:
+        out = []
+        removed = 0
+        i = 0
+        n = len(lines)
+        while i < n:
+            for period in range(1, self.max_period + 1):
+                block = lines[i:i + period]
+                if len(block) < period or not any(line.strip() for line in block):
+                    continue
+                end = i + period
+                while lines[end:end + period] == block:
+                    end += period
+                repeats = (end - i) // period
+                if repeats >= self.min_repeats:
+                    out.extend(block)
+                    noun = "line" if period == 1 else f"{period} lines"
+                    out.append(f"[previous {noun} repeated {repeats - 1} more times]")
+                    removed += (repeats - 1) * period
+                    i = end
+                    break
+            else:
+                out.append(lines[i])
+                i += 1
+        return out, removed
+
+    def _keep_head_and_tail(self, text: str, tokens: int) -> Tuple[str, int]:
+        """Drop the middle of ``text`` so roughly ``max_tokens`` remain, cutting at line breaks"""
+        keep = int(len(text) * self.max_tokens / tokens)
+        head_end = int(keep * self.head_ratio)
+        tail_start = len(text) - (keep - head_end)
+        newline = text.rfind("\n", 0, head_end)
+        if newline > head_end // 2:
+            head_end = newline
+        newline = text.find("\n", tail_start)
+        if newline != -1 and newline - tail_start < (len(text) - tail_start) // 2:
+            tail_start = newline + 1
+        omitted = estimate_tokens(text[head_end:tail_start])
+        marker = f"\n[... ~{omitted} tokens omitted ...]\n"
+        return text[:head_end] + marker + text[tail_start:], omitted
+
+    def compact(self, text: str, fit: bool = True) -> Tuple[str, Dict[str, Any]]:
+        """
+        Compact ``text``; with ``fit`` also enforce ``max_tokens``.
+
+        Returns:
+            The compacted text and its before/after byte and token counts
+        """
+        tokens_before = estimate_tokens(text)
+        bytes_before = len(text.encode())
+        removed = 0
+        omitted = 0
+
+        if self.normalize_whitespace or self.dedupe:
+            lines = text.splitlines()
+            if self.normalize_whitespace:
+                lines = [line.rstrip() for line in lines]
+                lines = [line for index, line in enumerate(lines) if line or (index and lines[index - 1])]
+            if self.dedupe:
+                lines, removed = self._collapse_repeats(lines)
+            text = "\n".join(lines).strip("\n") if self.normalize_whitespace else "\n".join(lines)
+
+        tokens = estimate_tokens(text)
+        if fit and self.max_tokens and tokens > self.max_tokens:
+            text, omitted = self._keep_head_and_tail(text, tokens)
+            tokens = estimate_tokens(text)
+
+        stats = {
+            'bytes_before': bytes_before,
+            'bytes_after': len(text.encode()),
+            'tokens_before': tokens_before,
+            'tokens_after': tokens,
+            'repeated_lines_removed': removed,
+            'omitted_tokens': omitted
+        }
+        self.runs += 1
+        self.saved_bytes += stats['bytes_before'] - stats['bytes_after']
+        self.saved_tokens += tokens_before - tokens
+        self.repeated_lines_removed += removed
+        self.omitted_tokens += omitted
+        return text, stats
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'max_tokens': self.max_tokens,
+            'runs': self.runs,
+            'saved_bytes': self.saved_bytes,
+            'saved_tokens': self.saved_tokens,
+            'repeated_lines_removed': self.repeated_lines_removed,
+            'omitted_tokens': self.omitted_tokens
+        }
+
+
+class ResponseCache:
+    """
+    In-memory LRU cache of Gemini responses with a TTL and a memory budget.
+
+    Entries are keyed by a hash of the model and the fully prepared prompt,
+    so only byte-identical consultations share an answer.
+    """
+
+    def __init__(self, max_entries: int = 128, ttl: float = 300.0, max_bytes: int = 8 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries: "OrderedDict[str, Tuple[float, int, Dict[str, Any]]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def make_key(prompt: str, model: str) -> str:
+        """Cache key for a prepared prompt sent to a model"""
+        digest = hashlib.sha256()
+        digest.update((model or "").encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(prompt.encode("utf-8"))
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Return the cached value for key, or None if absent or expired"""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        stored_at, size, value = entry
+        if time.time() - stored_at > self.ttl:
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: str, value: Dict[str, Any], size: int):
+        """Store value, evicting least recently used entries to fit the budget"""
+        if size > self.max_bytes or self.max_entries <= 0:
+            return
+        if key in self._entries:
+            self._remove(key)
+
+        self._entries[key] = (time.time(), size, value)
+        self.total_bytes += size
+
+        while len(self._entries) > self.max_entries or self.total_bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self.total_bytes = 0
+
+    def _remove(self, key: str):
+        _, size, _ = self._entries.pop(key)
+        self.total_bytes -= size
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self.total_bytes,
+            'max_bytes': self.max_bytes,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'expirations': self.expirations
+        }
+
+
+class DiskResponseCache:
+    """
+    Persistent response cache stored in SQLite, shared by server processes.
+
+    The database is opened lazily on first use so server startup does not
+    touch the disk. WAL journaling plus a busy timeout lets several server
+    processes read and write concurrently; writes and size-based eviction of
+    the least recently accessed entries run in one immediate transaction.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 64 * 1024 * 1024, ttl: float = 86400.0):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self.errors = 0
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(str(self.path), timeout=5.0, check_same_thread=False,
+                                         isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, model TEXT, response TEXT NOT NULL, "
+                "size INTEGER NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+            self._connection = connection
+            logger.debug(f"Opened disk response cache at {self.path}")
+        return self._connection
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Return the cached value for key, or None if absent or expired"""
+        with self._lock:
+            try:
+                connection = self._connect()
+                row = connection.execute(
+                    "SELECT response, created FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                now = time.time()
+                if row is not None and now - row[1] > self.ttl:
+                    connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    row = None
+                if row is None:
+                    self.misses += 1
+                    return None
+                connection.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+                self.hits += 1
+                return {'response': row[0]}
+            except sqlite3.Error as e:
+                self.errors += 1
+                logger.warning(f"Disk cache read failed: {e}")
+                return None
+
+    def put(self, key: str, value: Dict[str, Any], model: str = ""):
+        """Store value and evict least recently accessed entries over the size budget"""
+        response = value['response']
+        size = len(response.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            try:
+                connection = self._connect()
+                now = time.time()
+                connection.execute("BEGIN IMMEDIATE")
+                try:
+                    connection.execute(
+                        "INSERT OR REPLACE INTO responses (key, model, response, size, created, accessed) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        (key, model, response, size, now, now)
+                    )
+                    total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+                    excess = total - self.max_bytes
+                    if excess > 0:
+                        victims = []
+                        for victim, victim_size in connection.execute(
+                            "SELECT key, size FROM responses WHERE key != ? ORDER BY accessed", (key,)
+                        ):
+                            victims.append((victim,))
+                            excess -= victim_size
+                            if excess <= 0:
+                                break
+                        connection.executemany("DELETE FROM responses WHERE key = ?", victims)
+                        self.evictions += len(victims)
+                    connection.execute("COMMIT")
+                except BaseException:
+                    connection.execute("ROLLBACK")
+                    raise
+                self.writes += 1
+            except sqlite3.Error as e:
+                self.errors += 1
+                logger.warning(f"Disk cache write failed: {e}")
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'path': str(self.path),
+            'loaded': self._connection is not None,
+            'max_bytes': self.max_bytes,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'writes': self.writes,
+            'evictions': self.evictions,
+            'errors': self.errors
+        }
+
+
+class ConsultationSession:
+    """Context and conversation turns shared by follow-up consultations"""
+
+    def __init__(self, session_id: str, context: str = ""):
+        self.session_id = session_id
+        self.context = context
+        self.deltas: List[str] = []
+        self.turns: List[Tuple[str, str]] = []
+        self.digest: Optional[str] = None
+        self.digest_task = None
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+
+    @property
+    def size(self) -> int:
+        """Approximate characters held by the session"""
+        return (len(self.context) + sum(len(delta) for delta in self.deltas)
+                + sum(len(query) + len(answer) for query, answer in self.turns) + len(self.digest or ""))
+
+
+class SessionStore:
+    """
+    Consultation sessions evicted by idle time, count and total size.
+
+    Expired sessions are dropped on access; beyond ``max_sessions`` or
+    ``max_chars`` the least recently used ones go first.
+    """
+
+    def __init__(self, ttl: float = 1800.0, max_sessions: int = 32, max_chars: int = 4 * 1024 * 1024):
+        self.ttl = ttl
+        self.max_sessions = max(1, max_sessions)
+        self.max_chars = max_chars
+        self.created = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._sessions: "OrderedDict[str, ConsultationSession]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def get(self, session_id: str) -> Optional[ConsultationSession]:
+        self._expire()
+        session = self._sessions.get(session_id)
+        if session is not None:
+            session.last_used = time.monotonic()
+            self._sessions.move_to_end(session_id)
+        return session
+
+    def open(self, session_id: Optional[str], context: str = "",
+             new: bool = False) -> Optional[ConsultationSession]:
+        """
+        Return the session for ``session_id``, or None if it is unknown or expired.
+
+        With ``new`` a session is started instead, under ``session_id`` (which
+        replaces any session with that ID) or a generated ID, and stores
+        ``context`` as its base context. On an existing session non-empty
+        ``context`` is kept as additional context.
+        """
+        if new:
+            if session_id:
+                self.close(session_id)
+            session = ConsultationSession(session_id or uuid.uuid4().hex[:12], context)
+            self._sessions[session.session_id] = session
+            self.created += 1
+        else:
+            session = self.get(session_id) if session_id else None
+            if session is None:
+                return None
+            if context:
+                session.deltas.append(context)
+        self.enforce_limits()
+        return session
+
+    def close(self, session_id: str) -> bool:
+        session = self._sessions.pop(session_id, None)
+        if session is not None and session.digest_task is not None:
+            session.digest_task.cancel()
+        return session is not None
+
+    def _expire(self):
+        now = time.monotonic()
+        for session_id in [sid for sid, s in self._sessions.items() if now - s.last_used > self.ttl]:
+            self.close(session_id)
+            self.expirations += 1
+
+    def enforce_limits(self):
+        """Evict least recently used sessions over the count or size budget"""
+        total = sum(session.size for session in self._sessions.values())
+        while len(self._sessions) > 1 and (len(self._sessions) > self.max_sessions or total > self.max_chars):
+            session_id, session = next(iter(self._sessions.items()))
+            total -= session.size
+            self.close(session_id)
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'sessions': len(self._sessions),
+            'chars': sum(session.size for session in self._sessions.values()),
+            'created': self.created,
+            'evictions': self.evictions,
+            'expirations': self.expirations
+        }
+
+
+class ConsultationJob:
+    """A consultation running in the background for the submit/poll job API"""
+
+    def __init__(self, job_id: str, query: str):
+        self.job_id = job_id
+        self.query = query
+        self.task: Optional[asyncio.Future] = None
+        self.partial: List[str] = []
+        self.submitted_at = time.monotonic()
+        self.finished_at: Optional[float] = None
+
+    @property
+    def state(self) -> str:
+        if self.task is None or not self.task.done():
+            return 'running'
+        return 'cancelled' if self.task.cancelled() else 'completed'
+
+    def record_progress(self, text: str):
+        self.partial.append(text)
+
+    def finish(self, _task=None):
+        self.finished_at = time.monotonic()
+        # The final answer replaces the streamed pieces
+        self.partial = []
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Job state for pollers; the consultation result once it has completed"""
+        end = self.finished_at if self.finished_at is not None else time.monotonic()
+        snapshot = {
+            'job_id': self.job_id,
+            'state': self.state,
+            'query': self.query[:200],
+            'elapsed': end - self.submitted_at
+        }
+        if snapshot['state'] == 'running':
+            snapshot['partial_response'] = "".join(self.partial)
+        elif snapshot['state'] == 'completed':
+            snapshot['result'] = self.task.result()
+        return snapshot
+
+
+class JobTable:
+    """
+    Background consultation jobs, kept until polled results go stale.
+
+    Finished jobs are dropped ``ttl`` seconds after they finish; beyond
+    ``max_jobs`` the oldest finished jobs go first. Running jobs are never
+    evicted, so a table full of running jobs refuses new ones.
+    """
+
+    def __init__(self, ttl: float = 3600.0, max_jobs: int = 100):
+        self.ttl = ttl
+        self.max_jobs = max(1, max_jobs)
+        self.submitted = 0
+        self.cancelled = 0
+        self.expirations = 0
+        self._jobs: "OrderedDict[str, ConsultationJob]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+    @property
+    def running(self) -> int:
+        return sum(1 for job in self._jobs.values() if job.state == 'running')
+
+    def _expire(self):
+        now = time.monotonic()
+        for job_id in [jid for jid, job in self._jobs.items()
+                       if job.finished_at is not None and now - job.finished_at > self.ttl]:
+            del self._jobs[job_id]
+            self.expirations += 1
+
+    def has_room(self) -> bool:
+        """Whether a new job fits, after evicting stale and surplus finished jobs"""
+        self._expire()
+        finished = [jid for jid, job in self._jobs.items() if job.finished_at is not None]
+        while len(self._jobs) >= self.max_jobs and finished:
+            del self._jobs[finished.pop(0)]
+            self.expirations += 1
+        return len(self._jobs) < self.max_jobs
+
+    def add(self, job: ConsultationJob):
+        self._jobs[job.job_id] = job
+        self.submitted += 1
+
+    def get(self, job_id: str) -> Optional[ConsultationJob]:
+        self._expire()
+        return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> Optional[ConsultationJob]:
+        job = self.get(job_id)
+        if job is not None and job.state == 'running':
+            job.task.cancel()
+            self.cancelled += 1
+        return job
+
+    def cancel_all(self):
+        for job in self._jobs.values():
+            if job.task is not None and not job.task.done():
+                job.task.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'jobs': len(self._jobs),
+            'running': self.running,
+            'submitted': self.submitted,
+            'cancelled': self.cancelled,
+            'expirations': self.expirations
+        }
+
+
+class DeadlineExceededError(Exception):
+    """Raised when a consultation's deadline passes before or while it runs"""
+
+    def __init__(self, stage: str):
+        super().__init__(f"Consultation deadline exceeded {stage}")
+        self.stage = stage
+
+
+def time_left(deadline: Optional[float]) -> Optional[float]:
+    """Seconds until a ``time.monotonic()`` deadline, or None without one"""
+    return None if deadline is None else deadline - time.monotonic()
+
+
+class ConsultationScheduler:
+    """
+    Admits consultations through a token bucket and a bound on concurrency.
+
+    Tokens refill at one per ``rate_limit_delay`` seconds up to ``burst``, and
+    at most ``max_in_flight`` consultations run at once. Callers waiting for a
+    token or a slot are served by priority (lower runs first), then in
+    arrival order. With ``aging`` set, a waiter gains one priority level per
+    ``aging`` seconds in the queue, so low-priority work is never starved.
+    A waiter whose ``deadline`` passes is dropped from the queue with
+    ``DeadlineExceededError`` before it starts.
+    """
+
+    def __init__(self, rate_limit_delay: float = 2.0, burst: int = 1, max_in_flight: int = 4,
+                 aging: float = 0.0):
+        self.rate_limit_delay = rate_limit_delay
+        self.burst = max(1, burst)
+        self.max_in_flight = max(1, max_in_flight)
+        self.aging = aging
+        self.in_flight = 0
+        self.granted = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.last_wait = 0.0
+        self.expired = 0
+        self._tokens = float(self.burst)
+        self._refilled_at = time.monotonic()
+        self._token_waiters: List[list] = []
+        self._slot_waiters: List[list] = []
+        self._sequence = 0
+
+    @property
+    def queue_depth(self) -> int:
+        """Callers currently waiting for a token or a slot"""
+        return len(self._token_waiters) + len(self._slot_waiters)
+
+    def _enqueue(self, queue: List[list], priority: int) -> list:
+        """
+        Add a waiter entry ``[key, sequence, priority, future]`` to a heap.
+
+        Aging lowers every waiter's effective priority at the same rate, so
+        ``priority + enqueued_at / aging`` orders waiters the same way at any
+        later moment and can serve as a fixed heap key.
+        """
+        key = priority + time.monotonic() / self.aging if self.aging > 0 else priority
+        self._sequence += 1
+        entry = [key, self._sequence, priority, asyncio.get_running_loop().create_future()]
+        heapq.heappush(queue, entry)
+        return entry
+
+    @staticmethod
+    def _dequeue(queue: List[list], entry: list):
+        if entry in queue:
+            queue.remove(entry)
+            heapq.heapify(queue)
+
+    def _expire(self, stage: str) -> DeadlineExceededError:
+        self.expired += 1
+        logger.info(f"Dropping queued consultation: deadline passed {stage}")
+        return DeadlineExceededError(stage)
+
+    def _take_token(self) -> float:
+        """Take a token if one is available, else return seconds until one is"""
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) / self.rate_limit_delay)
+        self._refilled_at = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        return (1 - self._tokens) * self.rate_limit_delay
+
+    def _record_wait(self, waited: float):
+        self.granted += 1
+        self.total_wait += waited
+        self.last_wait = waited
+        self.max_wait = max(self.max_wait, waited)
+
+    async def acquire_token(self, priority: int = 0, deadline: Optional[float] = None):
+        """Wait, in priority order, until the token bucket admits one consultation"""
+        if self.rate_limit_delay <= 0:
+            return
+        started = time.monotonic()
+        entry = self._enqueue(self._token_waiters, priority)
+        try:
+            while True:
+                remaining = time_left(deadline)
+                if remaining is not None and remaining <= 0:
+                    raise self._expire("while waiting for the rate limiter")
+                if self._token_waiters[0] is not entry:
+                    # Woken when this caller reaches the head of the queue
+                    try:
+                        await asyncio.wait_for(asyncio.shield(entry[3]), remaining)
+                    except asyncio.TimeoutError:
+                        continue
+                    entry[3] = asyncio.get_running_loop().create_future()
+                    continue
+                delay = self._take_token()
+                if delay <= 0:
+                    break
+                if remaining is not None and remaining < delay:
+                    raise self._expire("while waiting for the rate limiter")
+                logger.debug(f"Rate limiting: sleeping for {delay:.2f} seconds")
+                # A more urgent caller may take the head meanwhile; the loop re-checks
+                await asyncio.sleep(delay)
+        finally:
+            self._dequeue(self._token_waiters, entry)
+            if self._token_waiters and not self._token_waiters[0][3].done():
+                self._token_waiters[0][3].set_result(None)
+        self._record_wait(time.monotonic() - started)
+
+    async def _acquire_slot(self, priority: int = 0, deadline: Optional[float] = None):
+        remaining = time_left(deadline)
+        if remaining is not None and remaining <= 0:
+            raise self._expire("before a consultation slot was free")
+        if self.in_flight < self.max_in_flight and not self._slot_waiters:
+            self.in_flight += 1
+            return
+        started = time.monotonic()
+        entry = self._enqueue(self._slot_waiters, priority)
+        waiter = entry[3]
+        try:
+            await asyncio.wait_for(waiter, remaining)
+        except (asyncio.CancelledError, asyncio.TimeoutError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just before the cancellation or deadline
+                self._release_slot()
+            else:
+                self._dequeue(self._slot_waiters, entry)
+            if isinstance(e, asyncio.TimeoutError):
+                raise self._expire("before a consultation slot was free")
+            raise
+        self._record_wait(time.monotonic() - started)
+
+    def _release_slot(self):
+        while self._slot_waiters:
+            waiter = heapq.heappop(self._slot_waiters)[3]
+            if not waiter.done():
+                # Hand the slot straight to the most urgent caller
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+    @asynccontextmanager
+    async def running(self, priority: int = 0, deadline: Optional[float] = None):
+        """Hold one of the ``max_in_flight`` consultation slots"""
+        await self._acquire_slot(priority, deadline)
+        try:
+            yield
+        finally:
+            self._release_slot()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'burst': self.burst,
+            'max_in_flight': self.max_in_flight,
+            'in_flight': self.in_flight,
+            'queue_depth': self.queue_depth,
+            'waiting_for_token': len(self._token_waiters),
+            'waiting_for_slot': len(self._slot_waiters),
+            'expired': self.expired,
+            'queued_priorities': sorted(entry[2] for entry in self._token_waiters + self._slot_waiters),
+            'aging': self.aging,
+            'avg_wait': self.total_wait / self.granted if self.granted else 0.0,
+            'max_wait': self.max_wait,
+            'last_wait': self.last_wait
+        }
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling Gemini while the circuit breaker is open"""
+
+    def __init__(self, error_type: str, failures: int, retry_in: float):
+        super().__init__(
+            f"Gemini calls suspended after {failures} {error_type} failures; "
+            f"next attempt in {retry_in:.0f}s"
+        )
+        self.error_type = error_type
+
+
+class CircuitBreaker:
+    """
+    Stops calling Gemini after repeated classified failures.
+
+    The breaker opens once ``failure_threshold`` failures of a ``trip_on``
+    type fall within ``window`` seconds. While open, calls are rejected
+    without starting a request. After ``recovery_timeout`` seconds up to
+    ``half_open_probes`` calls are let through: a success closes the
+    breaker, a failure opens it again. A ``failure_threshold`` of 0
+    disables the breaker.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int = 5, window: float = 60.0, recovery_timeout: float = 30.0,
+                 half_open_probes: int = 1,
+                 trip_on: Iterable[str] = ('authentication', 'rate_limit', 'timeout', 'cli_not_found')):
+        self.failure_threshold = failure_threshold
+        self.window = window
+        self.recovery_timeout = recovery_timeout
+        self.half_open_probes = max(1, half_open_probes)
+        self.trip_on = set(trip_on)
+        self.state = self.CLOSED
+        self.last_error_type: Optional[str] = None
+        self.opened = 0
+        self.rejected = 0
+        self._failures: deque = deque()
+        self._opened_at = 0.0
+        self._probes = 0
+
+    def retry_in(self) -> float:
+        """Seconds until the open breaker lets a probe through"""
+        if self.state != self.OPEN:
+            return 0.0
+        return max(0.0, self._opened_at + self.recovery_timeout - time.monotonic())
+
+    @property
+    def rejecting(self) -> bool:
+        """Whether a call made now would be rejected"""
+        if self.state == self.OPEN:
+            return self.retry_in() > 0
+        return self.state == self.HALF_OPEN and self._probes >= self.half_open_probes
+
+    def before_call(self) -> bool:
+        """
+        Admit a call or raise ``CircuitOpenError``.
+
+        Returns:
+            Whether the admitted call is a half-open probe
+        """
+        if self.state == self.OPEN and self.retry_in() == 0:
+            self.state = self.HALF_OPEN
+            logger.info("Circuit breaker half-open; probing Gemini")
+        if self.rejecting:
+            self.rejected += 1
+            raise CircuitOpenError(self.last_error_type or 'unknown', len(self._failures), self.retry_in())
+        if self.state == self.HALF_OPEN:
+            self._probes += 1
+            return True
+        return False
+
+    def _open(self):
+        self.state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._probes = 0
+        self.opened += 1
+        logger.warning(f"Circuit breaker opened after {len(self._failures)} {self.last_error_type} failures")
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logger.info("Circuit breaker closed; Gemini recovered")
+            self.state = self.CLOSED
+            self._probes = 0
+            self._failures.clear()
+
+    def record_failure(self, error_type: str, probe: bool = False):
+        if error_type not in self.trip_on or self.failure_threshold <= 0:
+            self.release(probe)
+            return
+        now = time.monotonic()
+        self.last_error_type = error_type
+        self._failures.append(now)
+        while self._failures and self._failures[0] < now - self.window:
+            self._failures.popleft()
+        if self.state == self.HALF_OPEN or (self.state == self.CLOSED and len(self._failures) >= self.failure_threshold):
+            self._open()
+
+    def release(self, probe: bool = False):
+        """End a call that produced no verdict, such as a cancelled one"""
+        if probe and self.state == self.HALF_OPEN:
+            self._probes = max(0, self._probes - 1)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'state': self.state,
+            'failures': len(self._failures),
+            'failure_threshold': self.failure_threshold,
+            'last_error_type': self.last_error_type,
+            'retry_in': self.retry_in(),
+            'opened': self.opened,
+            'rejected': self.rejected
+        }
+
+
+class LatencyTracker:
+    """
+    Keeps a sliding window of recent consultation latencies per model.
+
+    Only successful consultations are recorded, so the percentiles describe
+    how long a good answer takes rather than how fast failures come back.
+    """
+
+    def __init__(self, window: int = 100):
+        self.window = max(1, window)
+        self._samples: Dict[str, deque] = {}
+
+    def record(self, model: str, seconds: float):
+        samples = self._samples.get(model)
+        if samples is None:
+            samples = self._samples[model] = deque(maxlen=self.window)
+        samples.append(seconds)
+
+    def count(self, model: str) -> int:
+        return len(self._samples.get(model, ()))
+
+    def percentile(self, model: str, q: float) -> Optional[float]:
+        """Latency below which a fraction ``q`` of the recorded samples fall"""
+        samples = self._samples.get(model)
+        if not samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            model: {
+                'count': len(samples),
+                'p50': self.percentile(model, 0.5),
+                'p95': self.percentile(model, 0.95),
+                'last': samples[-1]
+            }
+            for model, samples in self._samples.items() if samples
+        }
+
+
+class ModelRouter:
+    """
+    Picks a model per consultation from ordered, configurable rules.
+
+    A rule matches when every condition it sets holds: ``tool``,
+    ``complexity_level``, ``output_format`` (each a value or a list of
+    values), and ``min_tokens`` / ``max_tokens`` on the estimated prompt
+    size. The first matching rule wins; otherwise the default model is
+    used. When the chosen model's observed p95 latency exceeds its
+    ``max_p95`` (set on the rule or in ``latency_slo``), the ``fallback``
+    model is used instead.
+    """
+
+    HINTS = ('tool', 'complexity_level', 'output_format')
+
+    def __init__(self, default_model: str, rules: Optional[List[Dict[str, Any]]] = None,
+                 latency: Optional[LatencyTracker] = None, latency_slo: Optional[Dict[str, float]] = None,
+                 fallback_model: Optional[str] = None, min_samples: int = 5, percentile: float = 0.95,
+                 history: int = 20):
+        self.default_model = default_model
+        self.rules = list(rules or [])
+        self.latency = latency or LatencyTracker()
+        self.latency_slo = dict(latency_slo or {})
+        self.fallback_model = fallback_model
+        self.min_samples = min_samples
+        self.percentile = percentile
+        self.routes: Dict[str, int] = {}
+        self.reasons: Dict[str, int] = {}
+        self.recent: deque = deque(maxlen=history)
+
+    @classmethod
+    def _matches(cls, rule: Dict[str, Any], tokens: int, hints: Dict[str, Any]) -> bool:
+        for name in cls.HINTS:
+            if name in rule:
+                expected = rule[name]
+                allowed = expected if isinstance(expected, (list, tuple)) else [expected]
+                if hints.get(name) not in allowed:
+                    return False
+        if 'min_tokens' in rule and tokens < rule['min_tokens']:
+            return False
+        if 'max_tokens' in rule and tokens > rule['max_tokens']:
+            return False
+        return True
+
+    def _too_slow(self, model: str, max_p95: Optional[float]) -> bool:
+        if max_p95 is None or self.latency.count(model) < self.min_samples:
+            return False
+        return self.latency.percentile(model, self.percentile) > max_p95
+
+    def route(self, tokens: int, record: bool = True, **hints: Any) -> Tuple[str, str]:
+        """
+        Choose the model for a prompt of about ``tokens`` tokens.
+
+        With ``record=False`` the decision is not counted in the stats; the
+        caller passes it to ``record`` once the prompt is really sent.
+
+        Returns:
+            The model and a short reason for the decision
+        """
+        model, reason, rule = self.default_model, 'default', {}
+        for index, candidate in enumerate(self.rules):
+            if self._matches(candidate, tokens, hints):
+                model, reason, rule = candidate['model'], f"rule {index}", candidate
+                break
+
+        fallback = rule.get('fallback', self.fallback_model)
+        if fallback and fallback != model and self._too_slow(model, rule.get('max_p95', self.latency_slo.get(model))):
+            model, reason = fallback, f"{reason}, {model} over latency SLO"
+
+        if record:
+            self.record(model, reason, tokens, **hints)
+        return model, reason
+
+    def record(self, model: str, reason: str, tokens: int, **hints: Any):
+        """Count a routing decision in the stats"""
+        self.routes[model] = self.routes.get(model, 0) + 1
+        self.reasons[reason] = self.reasons.get(reason, 0) + 1
+        self.recent.append({
+            'model': model,
+            'reason': reason,
+            'tokens': tokens,
+            **{name: value for name, value in hints.items() if value is not None}
+        })
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'rules': len(self.rules),
+            'routes': dict(self.routes),
+            'reasons': dict(self.reasons),
+            'recent': list(self.recent)
+        }
+
+
+class CapturedOutput:
+    """
+    Process output held in memory up to ``memory_limit`` bytes.
+
+    Anything larger spills to an anonymous temporary file, so many concurrent
+    huge answers don't all sit in memory while they are being read. This
+    only bounds memory during the read: the finished answer is still decoded
+    into one ``str`` for the response and the cache.
+    ``getbuffer`` exposes the bytes without copying (a memoryview of the
+    in-memory buffer or of an mmap of the spill file), and ``decode`` mirrors
+    ``bytes.decode`` so callers can treat it like the ``bytes`` it replaces.
+    """
+
+    def __init__(self, memory_limit: int = 1024 * 1024):
+        self.memory_limit = memory_limit
+        self.size = 0
+        self._buffer: Optional[io.BytesIO] = io.BytesIO()
+        self._file = None
+        self._mmap = None
+
+    def __len__(self) -> int:
+        return self.size
+
+    @property
+    def spilled(self) -> bool:
+        return self._file is not None
+
+    def write(self, data: bytes):
+        if self._file is None and self.size + len(data) > self.memory_limit:
+            self._file = tempfile.TemporaryFile()
+            self._file.write(self._buffer.getbuffer())
+            self._buffer = None
+        (self._file or self._buffer).write(data)
+        self.size += len(data)
+
+    def getbuffer(self) -> memoryview:
+        """Read-only view of everything captured so far"""
+        if self._file is None:
+            return self._buffer.getbuffer().toreadonly()
+        if self.size == 0:
+            return memoryview(b"")
+        if self._mmap is None or len(self._mmap) != self.size:
+            self._file.flush()
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self._mmap)
+
+    def decode(self, encoding: str = 'utf-8', errors: str = 'strict') -> str:
+        with self.getbuffer() as view:
+            return str(view, encoding, errors)
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._buffer = None
+
+
+class ProcessTracker:
+    """
+    Owns the lifecycle of Gemini CLI child processes.
+
+    Children are started in their own session so the whole process group
+    (Node.js plus anything it spawned) can be signalled. ``terminate`` sends
+    SIGTERM, escalates to SIGKILL after ``kill_grace`` seconds and then reaps
+    the child; a child that still hasn't exited is counted as leaked.
+    """
+
+    # Keyword arguments for create_subprocess_exec that give the child its own process group
+    SPAWN_KWARGS: Dict[str, Any] = {'start_new_session': True} if os.name == 'posix' else {}
+
+    def __init__(self, kill_grace: float = 2.0, reap_timeout: float = 5.0):
+        self.kill_grace = kill_grace
+        self.reap_timeout = reap_timeout
+        self.spawned = 0
+        self.terminated = 0
+        self.force_killed = 0
+        self.leaked = 0
+        self._children: set = set()
+
+    @property
+    def live(self) -> int:
+        """Children started through the tracker that have not exited yet"""
+        self._children = {process for process in self._children if process.returncode is None}
+        return len(self._children)
+
+    async def spawn(self, *cmd: str, **kwargs):
+        """Start a child in its own process group and track it"""
+        process = await asyncio.create_subprocess_exec(*cmd, **self.SPAWN_KWARGS, **kwargs)
+        self.spawned += 1
+        self._children.add(process)
+        return process
+
+    @staticmethod
+    def _signal(process, force: bool):
+        try:
+            if os.name == 'posix' and os.getpgid(process.pid) == process.pid:
+                os.killpg(process.pid, signal.SIGKILL if force else signal.SIGTERM)
+            elif force:
+                process.kill()
+            else:
+                process.terminate()
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    async def terminate(self, process):
+        """Stop a child and its process group, then reap it"""
+        if process.returncode is not None:
+            return
+        self.terminated += 1
+        self._signal(process, force=False)
+        try:
+            await asyncio.wait_for(process.wait(), timeout=self.kill_grace)
+            return
+        except asyncio.TimeoutError:
+            pass
+
+        self.force_killed += 1
+        self._signal(process, force=True)
+        try:
+            await asyncio.wait_for(process.wait(), timeout=self.reap_timeout)
+        except asyncio.TimeoutError:
+            self.leaked += 1
+            logger.error(f"Gemini CLI process {process.pid} did not exit after SIGKILL")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'live': self.live,
+            'spawned': self.spawned,
+            'terminated': self.terminated,
+            'force_killed': self.force_killed,
+            'leaked': self.leaked
+        }
+
+
+class WorkerPool:
+    """
+    Keeps pre-started Gemini CLI processes waiting for a prompt on stdin.
+
+    The CLI has no multi-prompt session protocol in non-interactive mode, so
+    each worker answers exactly one prompt: spawning it ahead of time moves
+    Node.js startup and credential loading off the request path. Idle
+    workers are kept per command (the model is part of it), up to ``size``
+    for each of the ``max_commands`` most recently used commands; a command
+    falling out of that set is drained. Used workers are replaced in the
+    background and workers idle for longer than ``max_idle`` seconds are
+    recycled. A worker that exited before it was used counts as a failed
+    spawn (the CLI may not wait on an empty stdin); after
+    ``max_spawn_failures`` of those in a row the pool disables itself rather
+    than pay for spawns that never serve a prompt.
+    """
+
+    def __init__(self, size: int = 2, max_idle: float = 300.0, tracker: Optional[ProcessTracker] = None,
+                 max_spawn_failures: int = 3, max_commands: int = 2):
+        self.size = max(0, size)
+        self.max_idle = max_idle
+        self.tracker = tracker or ProcessTracker()
+        self.max_spawn_failures = max_spawn_failures
+        self.max_commands = max(1, max_commands)
+        self.hits = 0
+        self.misses = 0
+        self.spawned = 0
+        self.recycled = 0
+        self.spawn_failures = 0
+        self._consecutive_failures = 0
+        # Idle workers per command, least recently used command first
+        self._idle: "OrderedDict[Tuple[str, ...], deque]" = OrderedDict()
+        self._spawning: Dict[Tuple[str, ...], int] = {}
+        self._tasks: set = set()
+        self._closed = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0 and not self._closed
+
+    async def acquire(self, command: List[str]):
+        """
+        Take a warm worker started with ``command``, or None if none is ready.
+
+        The pool for ``command`` is topped up again in the background either way.
+        """
+        if not self.enabled:
+            return None
+        command = tuple(command)
+        if command in self._idle:
+            self._idle.move_to_end(command)
+        else:
+            self._idle[command] = deque()
+            while len(self._idle) > self.max_commands:
+                self._drain(next(iter(self._idle)))
+
+        idle = self._idle[command]
+        process = None
+        while idle:
+            candidate, spawned_at = idle.popleft()
+            if candidate.returncode is not None:
+                self._exited_early(candidate)
+                continue
+            if time.monotonic() - spawned_at <= self.max_idle:
+                process = candidate
+                break
+            self._discard(candidate)
+
+        if process is not None:
+            self.hits += 1
+            self._consecutive_failures = 0
+        else:
+            self.misses += 1
+        self._refill(command)
+        return process
+
+    def _refill(self, command: Tuple[str, ...]):
+        """Start background spawns until idle plus starting workers for ``command`` reach ``size``"""
+        while (self.enabled and command in self._idle
+               and len(self._idle[command]) + self._spawning.get(command, 0) < self.size):
+            self._spawning[command] = self._spawning.get(command, 0) + 1
+            task = asyncio.ensure_future(self._spawn(command))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _spawn(self, command: Tuple[str, ...]):
+        try:
+            process = await self.tracker.spawn(
+                *command,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+        except Exception as e:
+            logger.warning(f"Failed to start warm Gemini CLI worker: {e}")
+            self._spawn_failed()
+            return
+        finally:
+            self._spawning[command] -= 1
+            if not self._spawning[command]:
+                del self._spawning[command]
+
+        self.spawned += 1
+        if command not in self._idle or not self.enabled:
+            self._discard(process)
+        else:
+            self._idle[command].append((process, time.monotonic()))
+
+    def _discard(self, process):
+        self.recycled += 1
+        self._reap(process)
+
+    def _reap(self, process):
+        # Stop and reap in the background so no zombie is left behind
+        task = asyncio.ensure_future(self.tracker.terminate(process) if process.returncode is None else process.wait())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _exited_early(self, process):
+        logger.warning(f"Warm Gemini CLI worker exited with code {process.returncode} before it was used")
+        self._reap(process)
+        self._spawn_failed()
+
+    def _spawn_failed(self):
+        self.spawn_failures += 1
+        self._consecutive_failures += 1
+        if self.size and self._consecutive_failures >= self.max_spawn_failures:
+            logger.warning(f"Disabling the Gemini CLI worker pool after {self._consecutive_failures} failed workers")
+            self.size = 0
+            self._drain()
+
+    def _drain(self, command: Optional[Tuple[str, ...]] = None):
+        """Discard the idle workers of ``command``, or of every command"""
+        for key in [command] if command is not None else list(self._idle):
+            idle = self._idle.pop(key, deque())
+            while idle:
+                process, _ = idle.popleft()
+                self._discard(process)
+
+    async def close(self):
+        """Stop all idle workers and wait for them to exit"""
+        self._closed = True
+        self._drain()
+        if self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'size': self.size,
+            'commands': len(self._idle),
+            'idle': sum(len(idle) for idle in self._idle.values()),
+            'starting': sum(self._spawning.values()),
+            'hits': self.hits,
+            'misses': self.misses,
+            'spawned': self.spawned,
+            'recycled': self.recycled,
+            'spawn_failures': self.spawn_failures
+        }
+
+
+class GeminiBackend(ABC):
+    """
+    Transport that turns a prepared prompt into a Gemini answer.
+
+    ``generate`` returns ``{'output': str, 'execution_time': float}`` and
+    raises ``Exception`` with a descriptive message on failure, the same
+    contract as ``GeminiIntegration._execute_gemini_cli``. ``timeout``
+    shortens the backend's own timeout for one call.
+    """
+
+    name = "base"
+
+    @abstractmethod
+    async def generate(self, prompt: str, model: str, on_output: Optional[Callable[[str], Any]] = None,
+                       timeout: Optional[float] = None) -> Dict[str, Any]:
+        """Answer ``prompt`` with ``model``, streaming partial output to ``on_output``"""
+
+    async def close(self):
+        """Release connections or processes held by the backend"""
+
+    def stats(self) -> Dict[str, Any]:
+        return {'name': self.name}
+
+
+class CLIBackend(GeminiBackend):
+    """Runs each prompt through the ``gemini`` CLI (warm worker or one-shot process)"""
+
+    name = "cli"
+
+    def __init__(self, integration: 'GeminiIntegration'):
+        self.integration = integration
 
-# Critical operations that should trigger consultation
-CRITICAL_OPERATION_PATTERNS = [
-    r"\bproduction\b",
-    r"\bdatabase migration\b",
-    r"\bsecurity\b",
-    r"\bauthentication\b",
-    r"\bencryption\b",
-    r"\bAPI key\b",
-    r"\bcredentials?\b",
-    r"\bperformance\s+critical\b"
-]
+    async def generate(self, prompt: str, model: str, on_output: Optional[Callable[[str], Any]] = None,
+                       timeout: Optional[float] = None) -> Dict[str, Any]:
+        return await self.integration._execute_gemini_cli(prompt, on_output=on_output, model=model, timeout=timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        return {'name': self.name, 'cli_command': self.integration.cli_command}
+
+
+class HTTPBackend(GeminiBackend):
+    """
+    Calls the Gemini REST API directly over a pooled keep-alive connection.
+
+    No process is started per call. HTTP/2 is negotiated when the ``h2``
+    package is installed; streaming calls use ``streamGenerateContent`` with
+    server-sent events so partial output reaches ``on_output`` as it arrives.
+    """
+
+    name = "http"
+    DEFAULT_BASE_URL = "https://generativelanguage.googleapis.com/v1beta"
+
+    def __init__(self, api_key: Optional[str], base_url: Optional[str] = None, timeout: float = 60,
+                 max_connections: int = 10):
+        if httpx is None:
+            raise ImportError("The HTTP backend requires the 'httpx' package")
+        self.api_key = api_key
+        self.base_url = (base_url or self.DEFAULT_BASE_URL).rstrip("/")
+        self.timeout = timeout
+        self.max_connections = max(1, max_connections)
+        self.requests = 0
+        self.failures = 0
+        self.last_http_version: Optional[str] = None
+        self._client = None
+
+    def _get_client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                http2=HTTP2_AVAILABLE,
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections
+                ),
+                headers={'x-goog-api-key': self.api_key or ""}
+            )
+        return self._client
+
+    @staticmethod
+    def _extract_text(payload: Dict[str, Any]) -> str:
+        """Concatenate the text parts of the first candidate"""
+        candidates = payload.get('candidates') or []
+        if not candidates:
+            return ""
+        parts = (candidates[0].get('content') or {}).get('parts') or []
+        return "".join(part.get('text', "") for part in parts)
+
+    @staticmethod
+    def _raise_for_status(status_code: int, body: str):
+        try:
+            message = json.loads(body).get('error', {}).get('message', body)
+        except (ValueError, AttributeError):
+            message = body
+        if status_code in (401, 403):
+            raise Exception(f"Gemini API authentication failed (HTTP {status_code}): {message}")
+        if status_code == 429:
+            raise Exception(f"Gemini API rate limit exceeded (HTTP 429): {message}")
+        raise Exception(f"Gemini API request failed (HTTP {status_code}): {message}")
+
+    async def generate(self, prompt: str, model: str, on_output: Optional[Callable[[str], Any]] = None,
+                       timeout: Optional[float] = None) -> Dict[str, Any]:
+        if not self.api_key:
+            raise Exception("Gemini API authentication failed: no API key. Set GEMINI_API_KEY or 'api_key' in gemini-config.json")
+
+        start_time = time.time()
+        timeout = self.timeout if timeout is None else min(self.timeout, timeout)
+        body = {'contents': [{'role': 'user', 'parts': [{'text': prompt}]}]}
+        client = self._get_client()
+        self.requests += 1
+
+        try:
+            if on_output is None:
+                response = await client.post(f"/models/{model}:generateContent", json=body, timeout=timeout)
+                self.last_http_version = response.http_version
+                if response.status_code != 200:
+                    self._raise_for_status(response.status_code, response.text)
+                output = self._extract_text(response.json())
+            else:
+                chunks = []
+                async with client.stream("POST", f"/models/{model}:streamGenerateContent",
+                                         params={'alt': 'sse'}, json=body, timeout=timeout) as response:
+                    self.last_http_version = response.http_version
+                    if response.status_code != 200:
+                        self._raise_for_status(response.status_code, (await response.aread()).decode(errors='replace'))
+                    async for line in response.aiter_lines():
+                        if not line.startswith("data:"):
+                            continue
+                        text = self._extract_text(json.loads(line[5:]))
+                        if text:
+                            chunks.append(text)
+                            await GeminiIntegration._notify_output(on_output, text)
+                output = "".join(chunks)
+        except httpx.TimeoutException:
+            self.failures += 1
+            raise Exception(f"Gemini API timed out after {timeout:g} seconds")
+        except httpx.HTTPError as e:
+            self.failures += 1
+            raise Exception(f"Gemini API request failed: {e}")
+        except Exception:
+            self.failures += 1
+            raise
+
+        return {
+            'output': output.strip(),
+            'execution_time': time.time() - start_time
+        }
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'name': self.name,
+            'base_url': self.base_url,
+            'http2': HTTP2_AVAILABLE,
+            'last_http_version': self.last_http_version,
+            'max_connections': self.max_connections,
+            'requests': self.requests,
+            'failures': self.failures
+        }
 
 
 class GeminiIntegration:
@@ -151,31 +2055,200 @@ class GeminiIntegration:
         self.cli_command = self.config.get('cli_command', 'gemini')
         self.timeout = self.config.get('timeout', 60)
         self.rate_limit_delay = self.config.get('rate_limit_delay', 2.0)
-        self.last_consultation = 0
+        self.scheduler = ConsultationScheduler(
+            rate_limit_delay=self.rate_limit_delay,
+            burst=self.config.get('rate_limit_burst', 1),
+            max_in_flight=self.config.get('max_in_flight', 4),
+            aging=self.config.get('priority_aging', 10.0)
+        )
+        self.tool_priorities = dict(DEFAULT_TOOL_PRIORITIES, **self.config.get('tool_priorities', {}))
+        self.default_priority = self.config.get('default_priority', 1)
         self.consultation_log = []
         self.max_context_length = self.config.get('max_context_length', 4000)
+        self.max_context_tokens = self.config.get('max_context_tokens')
+        self.compactor = (
+            ContextCompactor(
+                max_tokens=self.max_context_tokens,
+                dedupe=self.config.get('compaction_dedupe', True),
+                normalize_whitespace=self.config.get('compaction_normalize_whitespace', True),
+                head_ratio=self.config.get('compaction_head_ratio', 0.6)
+            )
+            if self.config.get('context_compaction', True) else None
+        )
+        self.sessions = SessionStore(
+            ttl=self.config.get('session_ttl', 1800.0),
+            max_sessions=self.config.get('max_sessions', 32),
+            max_chars=self.config.get('session_max_chars', 4 * 1024 * 1024)
+        )
+        self.batch_parallelism = max(1, self.config.get('batch_parallelism', 4))
+        self.max_batch_items = self.config.get('max_batch_items', 100)
+        self.jobs = JobTable(
+            ttl=self.config.get('job_ttl', 3600.0),
+            max_jobs=self.config.get('max_jobs', 100)
+        )
+        self.session_history_turns = self.config.get('session_history_turns', 5)
+        self.session_digest = self.config.get('session_digest', False)
+        self.session_digest_min_tokens = self.config.get('session_digest_min_tokens', 2000)
+        self.chunked_context = self.config.get('chunked_context', False)
+        self.map_parallelism = max(1, self.config.get('map_parallelism', 4))
         self.model = self.config.get('model', 'gemini-2.5-flash')
+        self.hedging = self.config.get('hedging', {})
+        self.latency = LatencyTracker(window=self.config.get('latency_window', 100))
+        self.hedge_stats = {'hedged': 0, 'fanouts': 0, 'secondary_wins': 0, 'cancelled': 0}
+        routing = self.config.get('routing', {})
+        self.router = (
+            ModelRouter(
+                default_model=self.model,
+                rules=routing.get('rules'),
+                latency=self.latency,
+                latency_slo=routing.get('latency_slo'),
+                fallback_model=routing.get('fallback_model'),
+                min_samples=routing.get('min_samples', 5),
+                percentile=routing.get('percentile', 0.95)
+            )
+            if routing.get('enabled', True) and routing.get('rules') else None
+        )
+        self.uncertainty_thresholds = self.config.get('uncertainty_thresholds', {})
+        self.consult_score = self.uncertainty_thresholds.get('consult_score', DEFAULT_CONSULT_SCORE)
+        self._pattern_scores, self._unscored = self._build_pattern_scores()
+        self.auto_consult_checks = 0
+        self.auto_consult_triggered = 0
+        self._inflight: Dict[str, Dict[str, Any]] = {}
+        self.coalesced_consultations = 0
+        self.cache_enabled = self.config.get('cache_enabled', True)
+        self.response_cache = ResponseCache(
+            max_entries=self.config.get('cache_max_entries', 128),
+            ttl=self.config.get('cache_ttl', 300.0),
+            max_bytes=self.config.get('cache_max_bytes', 8 * 1024 * 1024)
+        )
+        disk_cache_path = self.config.get('disk_cache_path')
+        self.disk_cache = (
+            DiskResponseCache(
+                disk_cache_path,
+                max_bytes=self.config.get('disk_cache_max_bytes', 64 * 1024 * 1024),
+                ttl=self.config.get('disk_cache_ttl', 86400.0)
+            )
+            if disk_cache_path and self.config.get('disk_cache_enabled', True) else None
+        )
+        self.process_tracker = ProcessTracker(kill_grace=self.config.get('kill_grace', 2.0))
+        self.worker_pool = WorkerPool(
+            size=self.config.get('worker_pool_size', 0),
+            max_idle=self.config.get('worker_max_idle', 300.0),
+            tracker=self.process_tracker,
+            max_commands=self.config.get('worker_pool_models', 2)
+        )
+        self.prompt_delivery = self.config.get('prompt_delivery', 'auto')
+        self.stdin_threshold = self.config.get('stdin_threshold', 8192)
+        self.output_memory_limit = self.config.get('output_memory_limit', 1024 * 1024)
+        self.spilled_outputs = 0
+        self.backend = self._create_backend(self.config.get('backend', 'cli'))
+        self.retry_max_attempts = max(1, self.config.get('retry_max_attempts', 3))
+        self.retry_base_delay = self.config.get('retry_base_delay', 1.0)
+        self.retry_max_delay = self.config.get('retry_max_delay', 30.0)
+        self.retry_deadline = self.config.get('retry_deadline', self.timeout * 2)
+        self.retry_on = set(self.config.get('retry_on', RETRYABLE_ERROR_TYPES))
+        self.retry_stats = {'retries': 0, 'recovered': 0, 'exhausted': 0}
+        self.default_budget = self.config.get('default_budget')
+        self.max_queue_depth = self.config.get('max_queue_depth', 32)
+        self.load_shed = {'overloaded': 0, 'deadline_exceeded': 0}
+        self.breaker = CircuitBreaker(
+            failure_threshold=(
+                self.config.get('circuit_failure_threshold', 5)
+                if self.config.get('circuit_breaker_enabled', True) else 0
+            ),
+            window=self.config.get('circuit_window', 60.0),
+            recovery_timeout=self.config.get('circuit_recovery_timeout', 30.0),
+            half_open_probes=self.config.get('circuit_half_open_probes', 1)
+        )
         
         logger.info(f"GeminiIntegration initialized - enabled: {self.enabled}, auto_consult: {self.auto_consult}")
     
-    def detect_uncertainty(self, text: str) -> Tuple[bool, List[str]]:
-        """Detect if text contains uncertainty patterns"""
-        found_patterns = []
+    def _create_backend(self, name: str) -> GeminiBackend:
+        """Create the configured backend, falling back to the CLI when HTTP is unavailable"""
+        if name == 'http':
+            try:
+                return HTTPBackend(
+                    api_key=self.config.get('api_key') or os.getenv('GEMINI_API_KEY'),
+                    base_url=self.config.get('api_base_url'),
+                    timeout=self.timeout,
+                    max_connections=self.config.get('http_max_connections', 10)
+                )
+            except ImportError as e:
+                logger.warning(f"{e}; falling back to the Gemini CLI backend")
+        elif name != 'cli':
+            logger.warning(f"Unknown Gemini backend '{name}'; using the Gemini CLI backend")
+        return CLIBackend(self)
+    
+    def _build_pattern_scores(self) -> Tuple[List[float], set]:
+        """Resolve the score of every pattern from uncertainty_thresholds"""
+        category_weights = dict(DEFAULT_CATEGORY_WEIGHTS)
+        category_weights.update(self.uncertainty_thresholds.get('category_weights', {}))
+        pattern_weights = dict(DEFAULT_PATTERN_WEIGHTS)
+        pattern_weights.update(self.uncertainty_thresholds.get('pattern_weights', {}))
+        
+        scores = []
+        for category, pattern in _default_matcher.patterns:
+            if not self.uncertainty_thresholds.get(CATEGORY_THRESHOLD_KEYS.get(category, category), True):
+                scores.append(0.0)
+                continue
+            score = float(category_weights.get(category, 1.0)) * float(pattern_weights.get(pattern, 1.0))
+            if score < 0:
+                logger.warning(f"Ignoring negative uncertainty weight for {category}: {pattern}")
+                score = 0.0
+            scores.append(score)
+        
+        unscored = {index for index, score in enumerate(scores) if score == 0}
+        return scores, unscored
+    
+    def score_uncertainty(self, text: str) -> Dict[str, Any]:
+        """
+        Score text by the weights of the distinct patterns it contains.
+        
+        Scanning stops as soon as the score reaches ``consult_score``, since
+        weights are non-negative and the decision can no longer change.
+        Patterns with zero weight (including disabled categories) are never
+        scanned for.
+        """
+        matcher = _default_matcher
+        skip = set(self._unscored)
+        matched = []
+        score = 0.0
+        early_exit = False
         
-        # Check uncertainty patterns
-        for pattern in UNCERTAINTY_PATTERNS:
-            if re.search(pattern, text, re.IGNORECASE):
-                found_patterns.append(f"uncertainty: {pattern}")
+        for index, _, _ in matcher.iter_matches(text, skip=skip):
+            skip.add(index)
+            matched.append(matcher.labels[index])
+            score += self._pattern_scores[index]
+            if score >= self.consult_score:
+                early_exit = True
+                break
         
-        # Check complex decision patterns
-        for pattern in COMPLEX_DECISION_PATTERNS:
-            if re.search(pattern, text, re.IGNORECASE):
-                found_patterns.append(f"complex_decision: {pattern}")
+        return {
+            'score': score,
+            'threshold': self.consult_score,
+            'should_consult': score >= self.consult_score,
+            'matched_patterns': matched,
+            'early_exit': early_exit
+        }
+    
+    def should_auto_consult(self, text: str) -> Tuple[bool, Dict[str, Any]]:
+        """Decide whether text warrants an automatic Gemini consultation"""
+        if not (self.enabled and self.auto_consult):
+            return False, {'score': 0.0, 'threshold': self.consult_score, 'should_consult': False,
+                           'matched_patterns': [], 'early_exit': False}
+        
+        result = self.score_uncertainty(text)
+        self.auto_consult_checks += 1
+        if result['should_consult']:
+            self.auto_consult_triggered += 1
+            logger.info(f"Auto-consult triggered (score {result['score']:.2f}): {result['matched_patterns']}")
         
-        # Check critical operation patterns
-        for pattern in CRITICAL_OPERATION_PATTERNS:
-            if re.search(pattern, text, re.IGNORECASE):
-                found_patterns.append(f"critical_operation: {pattern}")
+        return result['should_consult'], result
+    
+    def detect_uncertainty(self, text: str) -> Tuple[bool, List[str]]:
+        """Detect if text contains uncertainty patterns"""
+        matcher = _default_matcher
+        found_patterns = [matcher.labels[index] for index in matcher.find(text)]
         
         has_uncertainty = len(found_patterns) > 0
         
@@ -184,19 +2257,70 @@ class GeminiIntegration:
         
         return has_uncertainty, found_patterns
     
-    async def _enforce_rate_limit(self):
-        """Enforce rate limiting between consultations"""
-        current_time = time.time()
-        time_since_last = current_time - self.last_consultation
+    def detect_uncertainty_batch(self, texts: Iterable[str]) -> List[Dict[str, Any]]:
+        """
+        Detect uncertainty patterns in many texts at once.
+
+        Returns one entry per text with ``has_uncertainty``, per-category
+        ``counts`` of distinct matched patterns, the raw pattern ``mask``
+        (bit i set if ``PatternMatcher.labels[i]`` matched), and the weighted
+        ``score`` / ``should_consult`` decision of score_uncertainty.
+        """
+        matcher = _default_matcher
+        category_masks = {
+            category: matcher.category_mask(category) for category in matcher.categories
+        }
+        
+        results = []
+        for mask in matcher.find_masks(texts):
+            score = 0.0
+            remaining = mask
+            while remaining:
+                lowest = remaining & -remaining
+                score += self._pattern_scores[lowest.bit_length() - 1]
+                remaining ^= lowest
+            results.append({
+                'has_uncertainty': mask != 0,
+                'counts': {
+                    category: bin(mask & category_mask).count("1")
+                    for category, category_mask in category_masks.items()
+                },
+                'mask': mask,
+                'score': score,
+                'should_consult': score >= self.consult_score
+            })
         
-        if time_since_last < self.rate_limit_delay:
-            sleep_time = self.rate_limit_delay - time_since_last
-            logger.debug(f"Rate limiting: sleeping for {sleep_time:.2f} seconds")
-            await asyncio.sleep(sleep_time)
+        logger.debug(f"Batch uncertainty detection: {sum(r['has_uncertainty'] for r in results)}/{len(results)} texts matched")
+        return results
+    
+    def patterns_for_mask(self, mask: int) -> List[str]:
+        """Pattern labels for a mask returned by detect_uncertainty_batch"""
+        return _default_matcher.labels_for_mask(mask)
+    
+    def uncertainty_stream(self, window: int = 256) -> UncertaintyStream:
+        """
+        Create an incremental detector for streamed or chunked text.
         
-        self.last_consultation = time.time()
+        Hits are reported up to ``window`` characters after they end, not as
+        soon as they occur; the window is never smaller than the longest
+        pattern needs.
+        """
+        return UncertaintyStream(_default_matcher, window)
     
-    def _log_consultation(self, consultation_id: str, query: str, status: str, execution_time: float):
+    def detect_uncertainty_chunks(self, chunks: Iterable[str]) -> Tuple[bool, List[str]]:
+        """Like detect_uncertainty, but for text supplied as an iterable of chunks"""
+        stream = self.uncertainty_stream()
+        for chunk in chunks:
+            stream.feed(chunk)
+        stream.close()
+        return stream.has_uncertainty, stream.found_patterns
+    
+    async def _enforce_rate_limit(self, priority: int = 0, deadline: Optional[float] = None):
+        """Wait for the consultation scheduler to admit another consultation"""
+        await self.scheduler.acquire_token(priority, deadline)
+    
+    def _log_consultation(self, consultation_id: str, query: str, status: str, execution_time: float,
+                          cached: bool = False, retries: int = 0):
         """Log consultation for debugging and statistics"""
         if not self.config.get('log_consultations', True):
             return
@@ -206,7 +2330,9 @@ class GeminiIntegration:
             'timestamp': datetime.now().isoformat(),
             'query': query[:200] + "..." if len(query) > 200 else query,
             'status': status,
-            'execution_time': execution_time
+            'execution_time': execution_time,
+            'cached': cached,
+            'retries': retries
         }
         
         self.consultation_log.append(log_entry)
@@ -217,32 +2343,179 @@ class GeminiIntegration:
         
         logger.info(f"Consultation logged: {consultation_id} - {status} in {execution_time:.2f}s")
     
-    async def _execute_gemini_cli(self, query: str) -> Dict[str, Any]:
-        """Execute Gemini CLI command and return results"""
-        start_time = time.time()
-        
-        # Build command
+    def _build_command(self, query: str, model: Optional[str] = None) -> List[str]:
+        """Build the Gemini CLI command line for a prepared prompt"""
         cmd = [self.cli_command]
-        if self.model:
-            cmd.extend(['-m', self.model])
+        model = model or self.model
+        if model:
+            cmd.extend(['-m', model])
         cmd.extend(['-p', query])  # Non-interactive mode
+        return cmd
+    
+    def _build_worker_command(self, model: Optional[str] = None) -> List[str]:
+        """Build the command line for a CLI process that reads its prompt from stdin"""
+        cmd = [self.cli_command]
+        model = model or self.model
+        if model:
+            cmd.extend(['-m', model])
+        return cmd
+    
+    def _use_stdin(self, query: str) -> bool:
+        """Whether a one-shot CLI process should receive the prompt on stdin"""
+        if self.prompt_delivery == 'stdin':
+            return True
+        if self.prompt_delivery == 'argv':
+            return False
+        return len(query) > self.stdin_threshold
+    
+    async def _spawn_cli(self, query: str, model: Optional[str] = None) -> Tuple[Any, Optional[bytes]]:
+        """
+        Start a one-shot CLI process for a prompt.
+        
+        Returns the process and the bytes to write to its stdin (None when the
+        prompt was passed as ``-p``). A prompt too large for argv is retried
+        over stdin instead of failing with E2BIG.
+        """
+        if not self._use_stdin(query):
+            try:
+                process = await self.process_tracker.spawn(
+                    *self._build_command(query, model),
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE
+                )
+                return process, None
+            except OSError as e:
+                if e.errno != errno.E2BIG:
+                    raise
+                logger.warning("Prompt too large for the command line; sending it over stdin")
+        
+        process = await self.process_tracker.spawn(
+            *self._build_worker_command(model),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        return process, query.encode()
+    
+    @staticmethod
+    async def _write_stdin(process, data: bytes, chunk_size: int = 65536):
+        """
+        Stream the prompt to the CLI in chunks and close stdin so it starts working.
+        
+        Chunks are memoryview slices, so the encoded prompt is never copied
+        again, and draining after each one keeps the pipe buffer bounded.
+        """
+        view = memoryview(data)
+        try:
+            for offset in range(0, len(view), chunk_size):
+                process.stdin.write(view[offset:offset + chunk_size])
+                await process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # The CLI exited early; its exit code and stderr explain why
+            logger.debug("Gemini CLI closed stdin before the whole prompt was sent")
+        finally:
+            process.stdin.close()
+    
+    @staticmethod
+    async def _read_tail(stream, limit: int = 65536) -> bytes:
+        """Read a stream to EOF, keeping only its last ``limit`` bytes"""
+        tail = bytearray()
+        while True:
+            chunk = await stream.read(65536)
+            if not chunk:
+                return bytes(tail)
+            tail += chunk
+            if len(tail) > limit:
+                del tail[:-limit]
+    
+    async def _read_process_output(self, process, on_output: Optional[Callable[[str], Any]] = None,
+                                   stdin_data: Optional[bytes] = None) -> Tuple[CapturedOutput, bytes]:
+        """
+        Read CLI stdout incrementally while collecting stderr.
+        
+        Each decoded stdout chunk is passed to ``on_output`` as soon as it
+        arrives, so callers can show partial answers before the CLI exits.
+        ``stdin_data``, if given, is written to the process concurrently.
+        Stdout is captured in a ``CapturedOutput`` bounded by
+        ``output_memory_limit``; only the tail of stderr is kept.
+        """
+        stdin_task = asyncio.ensure_future(self._write_stdin(process, stdin_data)) if stdin_data is not None else None
+        stderr_task = asyncio.ensure_future(self._read_tail(process.stderr))
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        captured = CapturedOutput(self.output_memory_limit)
+        try:
+            while True:
+                chunk = await process.stdout.read(65536)
+                if not chunk:
+                    break
+                captured.write(chunk)
+                if on_output is not None:
+                    text = decoder.decode(chunk)
+                    if text:
+                        await self._notify_output(on_output, text)
+            stderr = await stderr_task
+            if stdin_task is not None:
+                await stdin_task
+        except BaseException:
+            captured.close()
+            raise
+        finally:
+            for task in (stdin_task, stderr_task):
+                if task is not None and not task.done():
+                    task.cancel()
+        
+        if captured.spilled:
+            self.spilled_outputs += 1
+        await process.wait()
+        return captured, stderr
+    
+    @staticmethod
+    async def _notify_output(on_output: Callable[[str], Any], text: str):
+        """Deliver partial output to a sync or async callback, never failing the consultation"""
+        try:
+            result = on_output(text)
+            if inspect.isawaitable(result):
+                await result
+        except Exception as e:
+            logger.debug(f"Partial output callback failed: {e}")
+    
+    async def _execute_gemini_cli(self, query: str, on_output: Optional[Callable[[str], Any]] = None,
+                                  model: Optional[str] = None, timeout: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Execute Gemini CLI command and return results.
+        
+        Output over ``output_memory_limit`` is spilled to disk while the CLI
+        runs, but the returned ``output`` is always a full ``str``, so a huge
+        answer is held in memory once the process exits.
+        """
+        start_time = time.time()
+        timeout = self.timeout if timeout is None else min(self.timeout, timeout)
+        
+        cmd = self._build_worker_command(model)
         
         logger.debug(f"Executing Gemini CLI: {' '.join(cmd[:3])}...")  # Don't log full query for privacy
         
+        process = None
         try:
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
+            # Prefer a pre-started worker; fall back to a one-shot process
+            process = await self.worker_pool.acquire(cmd)
+            if process is not None:
+                stdin_data = query.encode()
+            else:
+                process, stdin_data = await self._spawn_cli(query, model)
             
             stdout, stderr = await asyncio.wait_for(
-                process.communicate(),
-                timeout=self.timeout
+                self._read_process_output(process, on_output, stdin_data=stdin_data),
+                timeout=timeout
             )
             
             execution_time = time.time() - start_time
             
+            # Materialize the answer once and release the capture buffer
+            output = stdout.decode(errors='replace').strip() if process.returncode == 0 else ""
+            if isinstance(stdout, CapturedOutput):
+                stdout.close()
+            
             if process.returncode != 0:
                 error_msg = stderr.decode() if stderr else "Unknown error"
                 
@@ -254,7 +2527,6 @@ class GeminiIntegration:
                 
                 raise Exception(f"Gemini CLI failed (exit code {process.returncode}): {error_msg}")
             
-            output = stdout.decode().strip()
             logger.debug(f"Gemini CLI completed successfully in {execution_time:.2f}s")
             
             return {
@@ -263,21 +2535,23 @@ class GeminiIntegration:
             }
             
         except asyncio.TimeoutError:
-            logger.error(f"Gemini CLI timed out after {self.timeout} seconds")
-            raise Exception(f"Gemini CLI timed out after {self.timeout} seconds")
+            logger.error(f"Gemini CLI timed out after {timeout:g} seconds")
+            raise Exception(f"Gemini CLI timed out after {timeout:g} seconds")
         except FileNotFoundError:
             logger.error(f"Gemini CLI command '{self.cli_command}' not found")
             raise Exception(f"Gemini CLI command '{self.cli_command}' not found. Please install with 'npm install -g @google/gemini-cli'")
         except Exception as e:
             logger.error(f"Error executing Gemini CLI: {str(e)}")
             raise
+        finally:
+            # On timeout or cancellation the child is still running: kill its group and reap it
+            if process is not None and process.returncode is None:
+                await asyncio.shield(self.process_tracker.terminate(process))
     
-    def _prepare_query(self, query: str, context: str, comparison_mode: bool) -> str:
+    def _prepare_query(self, query: str, context: str, comparison_mode: bool, truncate: bool = True) -> str:
         """Prepare the full query for Gemini CLI"""
-        # Truncate context if too long
-        if len(context) > self.max_context_length:
-            context = context[:self.max_context_length] + "\n[Context truncated...]"
-            logger.debug(f"Context truncated to {self.max_context_length} characters")
+        if truncate and context:
+            context, _ = self._compact_context(context)
         
         parts = []
         
@@ -308,8 +2582,627 @@ class GeminiIntegration:
         
         return full_query
     
-    async def consult_gemini(self, query: str, context: str = "", comparison_mode: bool = True, force_consult: bool = False) -> Dict[str, Any]:
-        """Consult Gemini CLI for second opinion"""
+    def _compact_context(self, context: str) -> Tuple[str, Optional[Dict[str, Any]]]:
+        """
+        Compact context and fit it to the token budget, or else to max_context_length characters.
+        
+        Returns:
+            The context and the compaction stats (None without a compactor)
+        """
+        compaction = None
+        if self.compactor is not None:
+            context, compaction = self.compactor.compact(context)
+            if compaction['tokens_after'] < compaction['tokens_before']:
+                logger.debug(
+                    f"Context compacted from ~{compaction['tokens_before']} "
+                    f"to ~{compaction['tokens_after']} tokens"
+                )
+        
+        # Truncate context if too long
+        if self.max_context_tokens is None and len(context) > self.max_context_length:
+            context = context[:self.max_context_length] + "\n[Context truncated...]"
+            logger.debug(f"Context truncated to {self.max_context_length} characters")
+        return context, compaction
+    
+    def _context_over_budget(self, context: str) -> bool:
+        if self.max_context_tokens is not None:
+            return estimate_tokens(context) > self.max_context_tokens
+        return len(context) > self.max_context_length
+    
+    @staticmethod
+    def _split_context(context: str, limit: int, measure: Callable[[str], int] = len) -> List[str]:
+        """
+        Split context into chunks of at most ``limit`` as counted by ``measure``.
+        
+        ``measure`` defaults to characters; pass ``estimate_tokens`` for a
+        token budget. Fenced code blocks and blank-line separated paragraphs
+        are kept whole when they fit; larger blocks are split between lines,
+        and only a single line over ``limit`` is cut mid-line.
+        """
+        blocks = []
+        block: List[str] = []
+        in_fence = False
+        for line in context.splitlines(keepends=True):
+            if line.lstrip().startswith("```"):
+                if not in_fence and block:
+                    blocks.append("".join(block))
+                    block = []
+                block.append(line)
+                if in_fence:
+                    blocks.append("".join(block))
+                    block = []
+                in_fence = not in_fence
+            else:
+                block.append(line)
+                if not in_fence and not line.strip():
+                    blocks.append("".join(block))
+                    block = []
+        if block:
+            blocks.append("".join(block))
+        
+        chunks = []
+        current: List[str] = []
+        size = 0
+        for block in blocks:
+            if measure(block) <= limit:
+                pieces = [block]
+            else:
+                # No character costs more than one token, so ``limit`` characters fit either measure
+                pieces = [
+                    line[start:start + limit]
+                    for line in block.splitlines(keepends=True)
+                    for start in range(0, len(line), limit)
+                ]
+            for piece in pieces:
+                cost = measure(piece)
+                if current and size + cost > limit:
+                    chunks.append("".join(current))
+                    current = []
+                    size = 0
+                current.append(piece)
+                size += cost
+        if current:
+            chunks.append("".join(current))
+        return chunks
+    
+    def _prepare_map_query(self, query: str, chunk: str, index: int, total: int) -> str:
+        """Prepare the prompt that analyses one section of an oversized context"""
+        return "\n".join([
+            f"You are analysing part {index} of {total} of a larger context.",
+            "Extract and analyse only what in this part is relevant to the question below.",
+            "Be concise: your notes will be merged with the notes on the other parts.",
+            "",
+            f"Context (part {index}/{total}):",
+            chunk,
+            "",
+            "Question/Topic:",
+            query
+        ])
+    
+    def _use_map_reduce(self, context: str, chunked: Optional[bool]) -> bool:
+        """Whether a context is too large for one prompt and should be map-reduced"""
+        enabled = self.chunked_context if chunked is None else chunked
+        return enabled and self._context_over_budget(context)
+    
+    def _session_context(self, session: ConsultationSession) -> str:
+        """
+        Context to send with the next turn of a session.
+        
+        The first turn sends the stored context. Follow-ups send its summary
+        once one is available (else the context itself), any additional
+        context and the most recent turns.
+        """
+        if not session.turns:
+            return "\n\n".join([session.context] + session.deltas)
+        
+        parts = []
+        if session.digest:
+            parts.append(f"Summary of the session context:\n{session.digest}")
+        elif session.context:
+            parts.append(session.context)
+        parts.extend(f"Additional context:\n{delta}" for delta in session.deltas)
+        history = session.turns[-self.session_history_turns:] if self.session_history_turns else []
+        if history:
+            parts.append("Earlier in this session:\n" + "\n\n".join(
+                f"Q: {question}\nA: {answer[:2000]}" for question, answer in history
+            ))
+        return "\n\n".join(parts)
+    
+    def _record_session_turn(self, session: ConsultationSession, query: str, response: str):
+        """Store a turn and start summarizing a large base context after the first one"""
+        session.turns.append((query, response))
+        session.last_used = time.monotonic()
+        if (self.session_digest and session.digest is None and session.digest_task is None
+                and estimate_tokens(session.context) >= self.session_digest_min_tokens):
+            session.digest_task = asyncio.ensure_future(self._build_session_digest(session))
+        self.sessions.enforce_limits()
+    
+    async def _build_session_digest(self, session: ConsultationSession):
+        """Summarize a session's base context once so follow-ups can send the summary instead"""
+        prompt = "\n".join([
+            "Summarize the following context so that follow-up questions can be answered from the summary alone.",
+            "Keep file names, function and class signatures, error messages, versions and decisions verbatim.",
+            "",
+            "Context:",
+            session.context
+        ])
+        try:
+            await self._enforce_rate_limit(self.default_priority)
+            result = await self._generate_one(prompt, self.model, priority=self.default_priority)
+            session.digest = result['output']
+            logger.info(f"Session {session.session_id} context summarized for follow-ups")
+        except Exception as e:
+            logger.warning(f"Failed to summarize context of session {session.session_id}: {e}")
+    
+    async def _cache_lookup(self, cache_key: str) -> Optional[Dict[str, Any]]:
+        """Look a response up in the memory cache, then the disk cache"""
+        cached = self.response_cache.get(cache_key)
+        if cached is None and self.disk_cache is not None:
+            loop = asyncio.get_running_loop()
+            cached = await loop.run_in_executor(None, self.disk_cache.get, cache_key)
+            if cached is not None:
+                self.response_cache.put(cache_key, cached, sys.getsizeof(cached['response']) + len(cache_key))
+        return cached
+    
+    async def _cache_store(self, cache_key: str, response: str, model: Optional[str] = None):
+        """Store a successful response, and the model that gave it, in the memory and disk caches"""
+        value = {'response': response}
+        self.response_cache.put(cache_key, value, sys.getsizeof(response) + len(cache_key))
+        if self.disk_cache is not None:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self.disk_cache.put, cache_key, value, model or self.model)
+    
+    def _route_model(self, query: str, context: str, tool: Optional[str] = None,
+                     route_hints: Optional[Dict[str, Any]] = None) -> Tuple[str, Optional[Dict[str, Any]]]:
+        """
+        Pick the model for a consultation, or the configured model when routing is off.
+        
+        Returns:
+            The model and the routing decision to pass to ``ModelRouter.record``
+            if the consultation is dispatched (None when routing is off)
+        """
+        if self.router is None:
+            return self.model, None
+        tokens = estimate_tokens(query) + estimate_tokens(context)
+        hints = dict(route_hints or {}, tool=tool)
+        model, reason = self.router.route(tokens, record=False, **hints)
+        logger.debug(f"Routing ~{tokens} tokens from {tool or 'consult_gemini'} to {model} ({reason})")
+        return model, dict(hints, model=model, reason=reason, tokens=tokens)
+    
+    async def _dispatch_routed(self, route: Dict[str, Any], work: Callable[..., Awaitable[Dict[str, Any]]],
+                               **kwargs: Any) -> Dict[str, Any]:
+        """Run ``work``, counting its routing decision now that a prompt is really sent"""
+        self.router.record(**route)
+        return await work(**kwargs)
+    
+    def _hedging_plan(self, tool: Optional[str] = None, model: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Resolve the hedging policy for a tool from the ``hedging`` setting.
+        
+        ``hedging`` maps tool names (and ``default``) to a ``policy`` of
+        ``none``, ``hedge`` or ``fanout`` and the ``models`` to ask. A hedge
+        or fan-out with a single model asks two copies of it. Without
+        ``models`` the routed ``model`` (default: ``self.model``) is asked.
+        """
+        settings = dict(self.hedging.get('default', {}))
+        if tool:
+            settings.update(self.hedging.get(tool, {}))
+        policy = settings.get('policy', 'none')
+        models = list(settings.get('models') or [model or self.model])
+        if policy not in ('hedge', 'fanout'):
+            policy, models = 'none', models[:1]
+        elif len(models) == 1:
+            models = models * 2
+        return {
+            'policy': policy,
+            'models': models,
+            'hedge_delay': settings.get('hedge_delay', 10.0),
+            'min_samples': settings.get('min_samples', 5),
+            'percentile': settings.get('percentile', 0.95),
+            'priority': self.default_priority,
+            'deadline': None
+        }
+    
+    def _hedge_delay(self, plan: Dict[str, Any]) -> float:
+        """Seconds to wait on the primary request before hedging: its observed p95 once known"""
+        primary = plan['models'][0]
+        if self.latency.count(primary) >= plan['min_samples']:
+            return self.latency.percentile(primary, plan['percentile'])
+        return plan['hedge_delay']
+    
+    async def _generate_one(self, prompt: str, model: str, on_output: Optional[Callable[[str], Any]] = None,
+                            priority: int = 0, deadline: Optional[float] = None,
+                            caller_deadline: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Run one prompt on one model within a scheduler slot, through the circuit breaker.
+        
+        With a ``deadline`` the slot wait and the backend timeout are both cut
+        to the time left. A backend timeout cut short by ``caller_deadline``,
+        the caller's own deadline, raises ``DeadlineExceededError``, which does
+        not count against the circuit breaker; one cut by an earlier deadline,
+        such as the retry deadline, stays a timeout.
+        """
+        probe = self.breaker.before_call()
+        remaining = time_left(deadline)
+        try:
+            async with self.scheduler.running(priority, deadline):
+                remaining = time_left(deadline)
+                if remaining is not None and remaining <= 0:
+                    raise DeadlineExceededError("before the request started")
+                start = time.monotonic()
+                result = await self.backend.generate(prompt, model, on_output=on_output, timeout=remaining)
+                self.latency.record(model, time.monotonic() - start)
+        except (asyncio.CancelledError, DeadlineExceededError):
+            self.breaker.release(probe)
+            raise
+        except Exception as e:
+            error_type = self.classify_error(str(e))
+            if (error_type == 'timeout' and remaining is not None and remaining < self.timeout
+                    and caller_deadline is not None and deadline >= caller_deadline):
+                # The caller's budget, not Gemini, cut this request short
+                self.breaker.release(probe)
+                raise DeadlineExceededError("while Gemini was answering") from e
+            self.breaker.record_failure(error_type, probe)
+            raise
+        self.breaker.record_success()
+        return dict(result, model=model)
+    
+    async def _generate(self, prompt: str, plan: Dict[str, Any],
+                        on_output: Optional[Callable[[str], Any]] = None) -> Dict[str, Any]:
+        """
+        Run a prompt under a hedging plan and return the first good answer.
+        
+        ``hedge`` starts the next model only once the previous one has run
+        past ``_hedge_delay`` (or failed); ``fanout`` starts every model at
+        once. Only the first request to produce output streams to
+        ``on_output``. Requests still running when an answer arrives are
+        cancelled, which terminates their CLI processes.
+        """
+        models = plan['models']
+        if plan['policy'] == 'none':
+            return await self._generate_one(prompt, models[0], on_output, plan['priority'], plan['deadline'],
+                                            plan.get('caller_deadline'))
+        
+        streaming: List[int] = []
+        
+        def forward_for(index: int) -> Optional[Callable[[str], Any]]:
+            if on_output is None:
+                return None
+            
+            async def forward(text: str):
+                if not streaming:
+                    streaming.append(index)
+                if streaming[0] == index:
+                    await self._notify_output(on_output, text)
+            
+            return forward
+        
+        pending: Dict[asyncio.Future, int] = {}
+        launched = 0
+        hedge_at = 0.0
+        
+        def launch():
+            nonlocal launched, hedge_at
+            task = asyncio.ensure_future(
+                self._generate_one(prompt, models[launched], forward_for(launched), plan['priority'],
+                                   plan['deadline'], plan.get('caller_deadline'))
+            )
+            pending[task] = launched
+            launched += 1
+            hedge_at = time.monotonic() + self._hedge_delay(plan)
+        
+        launch()
+        if plan['policy'] == 'fanout':
+            self.hedge_stats['fanouts'] += 1
+            while launched < len(models):
+                launch()
+        
+        last_error: Optional[BaseException] = None
+        try:
+            while pending:
+                timeout = max(0.0, hedge_at - time.monotonic()) if launched < len(models) else None
+                done, _ = await asyncio.wait(list(pending), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    logger.info(f"No answer within {self._hedge_delay(plan):.1f}s; hedging with {models[launched]}")
+                    self.hedge_stats['hedged'] += 1
+                    launch()
+                    continue
+                for task in done:
+                    index = pending.pop(task)
+                    if task.exception() is None:
+                        if index > 0:
+                            self.hedge_stats['secondary_wins'] += 1
+                        return task.result()
+                    last_error = task.exception()
+                    logger.warning(f"Gemini request to {models[index]} failed: {last_error}")
+                if launched < len(models) and not pending:
+                    # The only running request failed: hedge immediately
+                    self.hedge_stats['hedged'] += 1
+                    launch()
+            raise last_error
+        finally:
+            for task in pending:
+                task.cancel()
+                self.hedge_stats['cancelled'] += 1
+    
+    @staticmethod
+    def classify_error(error_msg: str) -> str:
+        """Sort a consultation failure into the error types used for retries and suggestions"""
+        message = error_msg.lower()
+        if "deadline exceeded" in message:
+            return "deadline"
+        if "authentication" in message:
+            return "authentication"
+        if "timeout" in message or "timed out" in message:
+            return "timeout"
+        if "not found" in message:
+            return "cli_not_found"
+        if "rate limit" in message or "429" in message or "quota" in message or "resource_exhausted" in message:
+            return "rate_limit"
+        return "unknown"
+    
+    @staticmethod
+    def _plan_deadline(plan: Dict[str, Any], limit: Optional[float] = None) -> Optional[float]:
+        """The plan's current deadline, capped at ``limit``"""
+        if plan['deadline'] is None:
+            return limit
+        return plan['deadline'] if limit is None else min(plan['deadline'], limit)
+    
+    async def _under_plan_deadline(self, plan: Dict[str, Any], call: Callable[..., Awaitable[Any]],
+                                   limit: Optional[float] = None) -> Any:
+        """
+        Run ``call(deadline=...)`` under the plan's deadline, capped at ``limit``.
+        
+        Callers joining a coalesced consultation can push the plan's deadline
+        out while ``call`` runs; if it runs out of the deadline it was given
+        by then, it is started again under the new one.
+        """
+        while True:
+            deadline = self._plan_deadline(plan, limit)
+            try:
+                return await call(deadline=deadline)
+            except DeadlineExceededError:
+                extended = self._plan_deadline(plan, limit)
+                if extended is not None and (deadline is None or extended <= deadline):
+                    raise
+                logger.debug("Consultation deadline extended by a joining caller, starting the stage again")
+    
+    async def _with_retries(self, call: Callable[..., Awaitable[Dict[str, Any]]],
+                            attempts: Dict[str, int], plan: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Run ``call(deadline=...)``, retrying transient failures with decorrelated jitter.
+        
+        Only error types in ``retry_on`` are retried, at most
+        ``retry_max_attempts`` attempts in all. ``call`` receives the earlier
+        of ``retry_deadline`` seconds from the first attempt and the plan's
+        ``deadline``, so each attempt is cut to the time left, and no retry
+        is started that would sleep past it.
+        Each backoff is drawn from ``[retry_base_delay, 3 * previous]`` and
+        capped at ``retry_max_delay``. Retries are counted in ``attempts``.
+        """
+        retry_deadline = time.monotonic() + self.retry_deadline
+        delay = self.retry_base_delay
+        for attempt in range(1, self.retry_max_attempts + 1):
+            try:
+                result = await self._under_plan_deadline(plan, call, retry_deadline)
+            except CircuitOpenError:
+                raise
+            except Exception as e:
+                error_type = self.classify_error(str(e))
+                if error_type not in self.retry_on:
+                    raise
+                delay = min(self.retry_max_delay, random.uniform(self.retry_base_delay, delay * 3))
+                if attempt == self.retry_max_attempts or time.monotonic() + delay > self._plan_deadline(plan, retry_deadline):
+                    self.retry_stats['exhausted'] += 1
+                    raise
+                logger.warning(f"Gemini {error_type} error, retrying in {delay:.1f}s "
+                               f"(attempt {attempt + 1}/{self.retry_max_attempts}): {e}")
+                attempts['retries'] += 1
+                self.retry_stats['retries'] += 1
+                await asyncio.sleep(delay)
+                continue
+            if attempt > 1:
+                self.retry_stats['recovered'] += 1
+            return result
+    
+    async def _execute_consultation(self, cache_key: str, full_query: str, force_consult: bool,
+                                    plan: Dict[str, Any], attempts: Dict[str, int],
+                                    on_output: Optional[Callable[[str], Any]] = None) -> Dict[str, Any]:
+        """Schedule, run the CLI and cache the response for one prepared prompt"""
+        async def attempt(deadline: Optional[float]) -> Dict[str, Any]:
+            # Taken before any wait, while it still matches ``deadline``
+            attempt_plan = dict(plan, deadline=deadline, caller_deadline=plan['deadline'])
+            if not force_consult:
+                await self._enforce_rate_limit(plan['priority'], deadline)
+            return await self._generate(full_query, attempt_plan, on_output=on_output)
+        
+        result = await self._with_retries(attempt, attempts, plan)
+        
+        if self.cache_enabled:
+            await self._cache_store(cache_key, result['output'], result.get('model'))
+        
+        return dict(result, retries=attempts['retries'])
+    
+    async def _execute_map_reduce(self, cache_key: str, query: str, context: str, comparison_mode: bool,
+                                  force_consult: bool, plan: Dict[str, Any], attempts: Dict[str, int],
+                                  on_output: Optional[Callable[[str], Any]] = None) -> Dict[str, Any]:
+        """
+        Consult on an oversized context section by section, then merge.
+        
+        Every section call and the reduce call take their own rate-limit
+        token, so a fan-out spends as much quota as it sends requests.
+        Sections are analysed concurrently, at most ``map_parallelism`` at a
+        time and within the scheduler's ``max_in_flight`` slots; a final
+        reduce consultation merges their notes and streams to ``on_output``.
+        Only the reduce step is hedged; sections go to the plan's first model.
+        Each section and the reduce step are retried on their own. A context
+        that fits in one section after compaction is sent as a single prompt.
+        """
+        if self.compactor is not None:
+            # Dedupe and normalize before splitting; each section is then sent whole
+            context, _ = self.compactor.compact(context, fit=False)
+        if self.max_context_tokens is not None:
+            chunks = self._split_context(context, self.max_context_tokens, estimate_tokens)
+        else:
+            chunks = self._split_context(context, self.max_context_length)
+        if len(chunks) <= 1:
+            full_query = self._prepare_query(query, context, comparison_mode)
+            return await self._execute_consultation(cache_key, full_query, force_consult, plan, attempts,
+                                                    on_output=on_output)
+        
+        start_time = time.time()
+        semaphore = asyncio.Semaphore(self.map_parallelism)
+        logger.info(f"Map-reduce consultation over {len(chunks)} context sections")
+        
+        async def analyse(index: int, chunk: str) -> str:
+            prompt = self._prepare_map_query(query, chunk, index, len(chunks))
+            
+            async def attempt(deadline: Optional[float]) -> Dict[str, Any]:
+                caller_deadline = plan['deadline']
+                if not force_consult:
+                    await self._enforce_rate_limit(plan['priority'], deadline)
+                return await self._generate_one(prompt, plan['models'][0], priority=plan['priority'],
+                                                deadline=deadline, caller_deadline=caller_deadline)
+            
+            async with semaphore:
+                result = await self._with_retries(attempt, attempts, plan)
+                return result['output']
+        
+        tasks = [asyncio.ensure_future(analyse(index, chunk)) for index, chunk in enumerate(chunks, 1)]
+        try:
+            notes = await asyncio.gather(*tasks)
+        finally:
+            # One failed section fails the consultation; don't leave the others running
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+        
+        merged = "\n\n".join(
+            f"[Notes on part {index}/{len(notes)}]\n{note}" for index, note in enumerate(notes, 1)
+        )
+        # The notes are already condensed; truncating them would drop whole sections
+        reduce_query = self._prepare_query(query, merged, comparison_mode, truncate=False)
+        
+        async def reduce(deadline: Optional[float]) -> Dict[str, Any]:
+            reduce_plan = dict(plan, deadline=deadline, caller_deadline=plan['deadline'])
+            if not force_consult:
+                await self._enforce_rate_limit(plan['priority'], deadline)
+            return await self._generate(reduce_query, reduce_plan, on_output=on_output)
+        
+        result = await self._with_retries(reduce, attempts, plan)
+        
+        if self.cache_enabled:
+            await self._cache_store(cache_key, result['output'], result.get('model'))
+        
+        return {
+            'output': result['output'],
+            'execution_time': time.time() - start_time,
+            'chunks': len(chunks),
+            'model': result['model'],
+            'retries': attempts['retries']
+        }
+    
+    async def _execute_coalesced(self, cache_key: str,
+                                 work: Callable[..., Awaitable[Dict[str, Any]]],
+                                 on_progress: Optional[Callable[[str], Any]] = None,
+                                 plan: Optional[Dict[str, Any]] = None) -> Tuple[Dict[str, Any], bool]:
+        """
+        Run a consultation, sharing it with identical ones already in flight.
+        
+        The first caller for a cache key starts ``work``; later callers wait on
+        the same task and receive the same result or exception. When the first
+        caller has an ``on_progress`` callback, ``work(on_output=...)``
+        streams and partial output is broadcast to the callback of every
+        waiter; otherwise ``work`` runs without ``on_output`` so backends can
+        use their non-streaming path, and later waiters get no partial output.
+        The shared task is cancelled only when every waiting caller has been
+        cancelled.
+        
+        ``plan`` is the hedging plan ``work`` runs under. A joining caller
+        widens the shared plan to its own ``deadline`` (the latest one wins,
+        and no deadline beats any) and ``priority`` (the most urgent wins), so
+        it never inherits a tighter budget than its own; each caller still
+        stops waiting at its own deadline.
+        
+        Returns:
+            The CLI result and whether this call joined an existing one
+        """
+        entry = self._inflight.get(cache_key)
+        coalesced = entry is not None
+        if entry is None:
+            listeners: List[Callable[[str], Any]] = []
+            
+            async def broadcast(text: str):
+                for listener in list(listeners):
+                    await self._notify_output(listener, text)
+            
+            task = asyncio.ensure_future(work(on_output=broadcast) if on_progress is not None else work())
+            entry = {'task': task, 'waiters': 0, 'listeners': listeners, 'plan': plan}
+            self._inflight[cache_key] = entry
+            
+            def _forget(_, key=cache_key, owner=entry):
+                if self._inflight.get(key) is owner:
+                    del self._inflight[key]
+            
+            task.add_done_callback(_forget)
+        else:
+            self.coalesced_consultations += 1
+            logger.info("Joining identical Gemini consultation already in flight")
+            shared = entry['plan']
+            if shared is not None and plan is not None:
+                if shared['deadline'] is not None:
+                    shared['deadline'] = None if plan['deadline'] is None else max(shared['deadline'], plan['deadline'])
+                shared['priority'] = min(shared['priority'], plan['priority'])
+        
+        entry['waiters'] += 1
+        if on_progress is not None:
+            entry['listeners'].append(on_progress)
+        try:
+            return await asyncio.shield(entry['task']), coalesced
+        finally:
+            entry['waiters'] -= 1
+            if on_progress is not None:
+                entry['listeners'].remove(on_progress)
+            if entry['waiters'] == 0 and not entry['task'].done():
+                entry['task'].cancel()
+    
+    async def consult_gemini(self, query: str, context: str = "", comparison_mode: bool = True, force_consult: bool = False,
+                             use_cache: bool = True,
+                             on_progress: Optional[Callable[[str], Any]] = None,
+                             chunked: Optional[bool] = None,
+                             session_id: Optional[str] = None, new_session: bool = False,
+                             tool: Optional[str] = None,
+                             route_hints: Optional[Dict[str, Any]] = None,
+                             priority: Optional[int] = None,
+                             budget: Optional[float] = None, deadline: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Consult Gemini CLI for second opinion.
+        
+        Successful responses are cached per prepared prompt and model; pass
+        ``use_cache=False`` to bypass the cache for a single call.
+        ``on_progress`` (sync or async) receives partial output as it streams.
+        A context longer than ``max_context_length`` is map-reduced instead of
+        truncated when ``chunked`` (default: the ``chunked_context`` setting)
+        is true.
+        With ``new_session`` the context is stored in a new session (under
+        ``session_id`` if given) and follow-ups passing its ``session_id``
+        only need the new question. An unknown or expired ``session_id``
+        fails with error type ``session_not_found``.
+        ``tool`` selects the hedging policy configured for the calling tool;
+        it and ``route_hints`` (``complexity_level``, ``output_format``) feed
+        the model router.
+        ``priority`` (lower runs first) overrides the tool's default priority
+        in the scheduler queues.
+        ``budget`` (seconds from now, default: the ``default_budget`` setting)
+        or an absolute ``time.monotonic()`` ``deadline`` bounds queueing,
+        retries and the Gemini call together. When more than
+        ``max_queue_depth`` consultations are already queued, the call is
+        rejected at once with status ``overloaded``.
+        """
+        if deadline is None:
+            budget = budget if budget is not None else self.default_budget
+            deadline = time.monotonic() + budget if budget is not None else None
+        
         if not self.enabled:
             logger.warning("Gemini integration is disabled")
             return {
@@ -317,25 +3210,118 @@ class GeminiIntegration:
                 'message': 'Gemini integration is disabled'
             }
         
-        if not force_consult:
-            await self._enforce_rate_limit()
-        
         consultation_id = f"consult_{int(time.time())}"
-        logger.info(f"Starting Gemini consultation: {consultation_id}")
+        attempts = None
         
         try:
-            # Prepare query with context
-            full_query = self._prepare_query(query, context, comparison_mode)
+            session = None
+            digest_used = False
+            if session_id or new_session:
+                session = self.sessions.open(session_id, context, new=new_session)
+                if session is None:
+                    # Answering without the stored context would look like success; make the client resend it
+                    message = f"Unknown or expired session: {session_id}"
+                    logger.warning(message)
+                    self._log_consultation(consultation_id, query, 'error', 0)
+                    return {
+                        'status': 'error',
+                        'error': message,
+                        'error_type': 'session_not_found',
+                        'consultation_id': consultation_id,
+                        'timestamp': datetime.now().isoformat()
+                    }
+                # Follow-ups may stand in a lossy summary for the stored context; tell the caller
+                digest_used = bool(session.turns and session.digest)
+                context = self._session_context(session)
+            
+            model, route = self._route_model(query, context, tool, route_hints)
+            plan = self._hedging_plan(tool, model)
+            if priority is None:
+                priority = self.tool_priorities.get(tool, self.default_priority)
+            plan['priority'] = priority
+            plan['deadline'] = deadline
+            attempts = {'retries': 0}
+            models = ",".join(plan['models'])
+            compaction = None
+            if self._use_map_reduce(context, chunked):
+                # Key on the untruncated input: the prepared prompt would be cut
+                cache_key = ResponseCache.make_key(
+                    "\0".join(['map-reduce', str(comparison_mode), query, context]), models
+                )
+                work = partial(self._execute_map_reduce, cache_key, query, context, comparison_mode, force_consult,
+                               plan, attempts)
+            else:
+                # Prepare query with context
+                if context:
+                    context, compaction = self._compact_context(context)
+                full_query = self._prepare_query(query, context, comparison_mode, truncate=False)
+                cache_key = ResponseCache.make_key(full_query, models)
+                work = partial(self._execute_consultation, cache_key, full_query, force_consult, plan, attempts)
+            
+            if use_cache and self.cache_enabled:
+                cached = await self._cache_lookup(cache_key)
+                if cached is not None:
+                    logger.info(f"Serving Gemini consultation from cache: {consultation_id}")
+                    self._log_consultation(consultation_id, query, 'success', 0, cached=True)
+                    if session is not None:
+                        self._record_session_turn(session, query, cached['response'])
+                    return {
+                        'status': 'success',
+                        'response': cached['response'],
+                        'execution_time': 0.0,
+                        'consultation_id': consultation_id,
+                        'timestamp': datetime.now().isoformat(),
+                        'cached': True,
+                        'session_id': session.session_id if session is not None else None,
+                        'session_digest_used': digest_used
+                    }
             
-            # Execute Gemini CLI command
-            result = await self._execute_gemini_cli(full_query)
+            if self.breaker.rejecting:
+                # Fail fast rather than queue behind the rate limiter for a call that would be rejected
+                self.breaker.before_call()
+            
+            queue_depth = self.scheduler.queue_depth
+            if self.max_queue_depth and queue_depth >= self.max_queue_depth and cache_key not in self._inflight:
+                self.load_shed['overloaded'] += 1
+                logger.warning(f"Rejecting Gemini consultation {consultation_id}: {queue_depth} already queued")
+                self._log_consultation(consultation_id, query, 'overloaded', 0)
+                message = (
+                    f"Gemini is overloaded: {queue_depth} consultations are already queued "
+                    f"(limit {self.max_queue_depth}). Please retry shortly."
+                )
+                return {
+                    'status': 'overloaded',
+                    'message': message,
+                    'error': message,
+                    'error_type': 'overloaded',
+                    'queue_depth': queue_depth,
+                    'consultation_id': consultation_id,
+                    'timestamp': datetime.now().isoformat()
+                }
+            
+            logger.info(f"Starting Gemini consultation: {consultation_id}")
+            if route is not None:
+                # Cache hits and calls joining one in flight send nothing, so they are not counted
+                work = partial(self._dispatch_routed, route, work)
+            
+            # Execute Gemini CLI command, joining an identical one already in flight
+            try:
+                result, coalesced = await asyncio.wait_for(
+                    self._execute_coalesced(cache_key, work, on_progress, plan), time_left(deadline)
+                )
+            except asyncio.TimeoutError:
+                raise DeadlineExceededError("while waiting for Gemini")
+            
+            if session is not None:
+                self._record_session_turn(session, query, result['output'])
             
             # Log successful consultation
             self._log_consultation(
                 consultation_id, 
                 query, 
                 'success', 
-                result.get('execution_time', 0)
+                result.get('execution_time', 0),
+                retries=result.get('retries', 0)
             )
             
             return {
@@ -343,7 +3329,16 @@ class GeminiIntegration:
                 'response': result['output'],
                 'execution_time': result['execution_time'],
                 'consultation_id': consultation_id,
-                'timestamp': datetime.now().isoformat()
+                'timestamp': datetime.now().isoformat(),
+                'cached': False,
+                'coalesced': coalesced,
+                'chunks': result.get('chunks', 1),
+                'model': result.get('model'),
+                'retries': result.get('retries', 0),
+                'compaction': compaction,
+                'session_id': session.session_id if session is not None else None,
+                'session_turn': len(session.turns) if session is not None else None,
+                'session_digest_used': digest_used
             }
             
         except Exception as e:
@@ -351,27 +3346,107 @@ class GeminiIntegration:
             logger.error(f"Error consulting Gemini: {error_msg}")
             
             # Log failed consultation
-            self._log_consultation(consultation_id, query, 'error', 0)
+            retries = attempts['retries'] if attempts is not None else 0
+            self._log_consultation(consultation_id, query, 'error', 0, retries=retries)
+            
+            if isinstance(e, DeadlineExceededError):
+                self.load_shed['deadline_exceeded'] += 1
             
             # Determine error type for better user guidance
-            error_type = "unknown"
-            if "authentication" in error_msg.lower():
-                error_type = "authentication"
-            elif "timeout" in error_msg.lower():
-                error_type = "timeout"
-            elif "not found" in error_msg.lower():
-                error_type = "cli_not_found"
-            elif "rate limit" in error_msg.lower():
-                error_type = "rate_limit"
+            if isinstance(e, CircuitOpenError):
+                error_type = e.error_type
+            else:
+                error_type = self.classify_error(error_msg)
             
             return {
                 'status': 'error',
                 'error': error_msg,
                 'error_type': error_type,
+                'circuit_open': isinstance(e, CircuitOpenError),
+                'retries': retries,
                 'consultation_id': consultation_id,
                 'timestamp': datetime.now().isoformat()
             }
     
+    def end_session(self, session_id: str) -> bool:
+        """Forget a consultation session and its stored context"""
+        return self.sessions.close(session_id)
+    
+    async def consult_gemini_batch(self, items: List[Dict[str, Any]], parallelism: Optional[int] = None,
+                                   budget: Optional[float] = None, **kwargs: Any) -> Dict[str, Any]:
+        """
+        Consult Gemini on independent ``{query, context}`` items concurrently.
+        
+        At most ``parallelism`` items run at once, capped at (and defaulting
+        to) ``batch_parallelism`` so one client cannot claim every slot; each still goes through the rate limiter, cache and retries of
+        ``consult_gemini``, which receives the remaining ``kwargs``. One
+        ``budget`` covers the whole batch. Results come back in item order,
+        each with its own status and timing.
+        """
+        if len(items) > self.max_batch_items:
+            message = f"Too many batch items: {len(items)} (limit {self.max_batch_items})"
+            return {'status': 'error', 'error': message, 'error_type': 'invalid_request', 'results': []}
+        
+        kwargs.setdefault('tool', 'consult_gemini_batch')
+        deadline = time.monotonic() + budget if budget is not None else None
+        semaphore = asyncio.Semaphore(max(1, min(parallelism or self.batch_parallelism, self.batch_parallelism)))
+        start_time = time.time()
+        
+        async def run(index: int, item: Any) -> Dict[str, Any]:
+            if not isinstance(item, dict) or not isinstance(item.get('query'), str) or not item['query']:
+                return {'index': index, 'status': 'error', 'error': "Each item needs a non-empty 'query' string",
+                        'error_type': 'invalid_request', 'elapsed': 0.0}
+            async with semaphore:
+                started = time.time()
+                result = await self.consult_gemini(item['query'], context=item.get('context') or "",
+                                                   deadline=deadline, **kwargs)
+            return dict(result, index=index, elapsed=time.time() - started)
+        
+        results = await asyncio.gather(*(run(index, item) for index, item in enumerate(items)))
+        succeeded = sum(1 for result in results if result['status'] == 'success')
+        return {
+            'status': 'success' if succeeded == len(results) else 'partial' if succeeded else 'error',
+            'results': results,
+            'succeeded': succeeded,
+            'failed': len(results) - succeeded,
+            'execution_time': time.time() - start_time
+        }
+    
+    def submit_consultation(self, query: str, **kwargs: Any) -> Dict[str, Any]:
+        """
+        Start ``consult_gemini(query, **kwargs)`` in the background.
+        
+        Returns a job ID at once; poll it with ``get_consultation_result``.
+        Must be called from a running event loop.
+        """
+        if not self.jobs.has_room():
+            message = f"Too many consultation jobs running (limit {self.jobs.max_jobs}). Please retry shortly."
+            return {'status': 'overloaded', 'message': message, 'error': message, 'error_type': 'overloaded'}
+        kwargs.setdefault('tool', 'submit_consultation')
+        job = ConsultationJob(uuid.uuid4().hex[:12], query)
+        job.task = asyncio.ensure_future(self.consult_gemini(query, on_progress=job.record_progress, **kwargs))
+        job.task.add_done_callback(job.finish)
+        self.jobs.add(job)
+        logger.info(f"Submitted Gemini consultation job {job.job_id}")
+        return {'status': 'submitted', 'job_id': job.job_id}
+    
+    async def get_consultation_result(self, job_id: str, wait: float = 0.0) -> Dict[str, Any]:
+        """Report a job's state, waiting up to ``wait`` seconds for it to finish"""
+        job = self.jobs.get(job_id)
+        if job is None:
+            return {'job_id': job_id, 'state': 'not_found'}
+        if wait > 0 and job.state == 'running':
+            await asyncio.wait([job.task], timeout=wait)
+        return job.snapshot()
+    
+    def cancel_consultation(self, job_id: str) -> Dict[str, Any]:
+        """Cancel a running job; its CLI process is terminated"""
+        job = self.jobs.cancel(job_id)
+        if job is None:
+            return {'job_id': job_id, 'state': 'not_found'}
+        # A task that was still running finishes cancelling on the next loop iteration
+        return {'job_id': job_id, 'state': job.state if job.task.done() else 'cancelled'}
+    
     def get_error_suggestion(self, error_type: str) -> str:
         """Get user-friendly error suggestions based on error type"""
         suggestions = {
@@ -390,6 +3465,14 @@ class GeminiIntegration:
             "rate_limit": (
                 "Rate limit exceeded. Please wait before making another request. "
                 f"Current rate limit: {self.rate_limit_delay} seconds between calls."
+            ),
+            "deadline": (
+                "The consultation did not finish within its time budget. "
+                "Pass a larger budget_seconds or try again when fewer consultations are queued."
+            ),
+            "session_not_found": (
+                "The session has expired or was never started. "
+                "Resend the full context with new_session to start a new session."
             )
         }
         
@@ -401,10 +3484,26 @@ class GeminiIntegration:
             "enabled": self.enabled,
             "auto_consult": self.auto_consult,
             "cli_command": self.cli_command,
+            "prompt_delivery": self.prompt_delivery,
+            "backend": self.backend.stats(),
             "model": self.model,
+            "hedging": dict(self.hedge_stats),
+            "retries": dict(self.retry_stats),
+            "circuit_breaker": self.breaker.stats(),
+            "max_queue_depth": self.max_queue_depth,
+            "load_shed": dict(self.load_shed),
+            "latency": self.latency.stats(),
+            "routing": self.router.stats() if self.router is not None else None,
             "timeout": self.timeout,
             "rate_limit_delay": self.rate_limit_delay,
             "max_context_length": self.max_context_length,
+            "max_context_tokens": self.max_context_tokens,
+            "compaction": self.compactor.stats() if self.compactor is not None else None,
+            "sessions": self.sessions.stats(),
+            "jobs": self.jobs.stats(),
+            "consult_score": self.consult_score,
+            "auto_consult_checks": self.auto_consult_checks,
+            "auto_consult_triggered": self.auto_consult_triggered,
             "total_consultations": len(self.consultation_log),
             "last_consultation": (
                 self.consultation_log[-1]['timestamp'] 
@@ -417,8 +3516,24 @@ class GeminiIntegration:
             "failed_consultations": len([
                 log for log in self.consultation_log 
                 if log['status'] == 'error'
-            ])
+            ]),
+            "scheduler": self.scheduler.stats(),
+            "tool_priorities": dict(self.tool_priorities),
+            "inflight_consultations": len(self._inflight),
+            "coalesced_consultations": self.coalesced_consultations,
+            "cache_enabled": self.cache_enabled,
+            "cache": self.response_cache.stats(),
+            "disk_cache": self.disk_cache.stats() if self.disk_cache is not None else None,
+            "worker_pool": self.worker_pool.stats(),
+            "processes": self.process_tracker.stats(),
+            "spilled_outputs": self.spilled_outputs
         }
+    
+    async def close(self):
+        """Cancel background jobs and release backend connections and warm CLI workers"""
+        self.jobs.cancel_all()
+        await self.backend.close()
+        await self.worker_pool.close()
 
 
 # Singleton pattern implementation
@@ -8,7 +8,7 @@ import json
 import os
 import sys
 from pathlib import Path
-from typing import Any, Dict, List
+from typing import Any, Awaitable, Callable, Dict, List, Optional
 
 import mcp.server.stdio
 import mcp.types as types
@@ -19,6 +19,9 @@ from gemini_integration import get_integration
 
 
 class MCPServer:
+    # Longest a get_consultation_result call may block, so polls stay under client tool timeouts
+    MAX_POLL_WAIT = 30.0
+
     def __init__(self, project_root: str = None):
         self.project_root = Path(project_root) if project_root else Path.cwd()
         self.server = Server("gemini-mcp-integration")
@@ -57,8 +60,32 @@ class MCPServer:
             'GEMINI_CLI_COMMAND': ('cli_command', str),
             'GEMINI_TIMEOUT': ('timeout', int),
             'GEMINI_RATE_LIMIT': ('rate_limit_delay', float),
+            'GEMINI_RATE_BURST': ('rate_limit_burst', int),
+            'GEMINI_MAX_IN_FLIGHT': ('max_in_flight', int),
             'GEMINI_MODEL': ('model', str),
             'GEMINI_MAX_CONTEXT': ('max_context_length', int),
+            'GEMINI_MAX_CONTEXT_TOKENS': ('max_context_tokens', int),
+            'GEMINI_CONTEXT_COMPACTION': ('context_compaction', lambda x: x.lower() == 'true'),
+            'GEMINI_CHUNKED_CONTEXT': ('chunked_context', lambda x: x.lower() == 'true'),
+            'GEMINI_MAP_PARALLELISM': ('map_parallelism', int),
+            'GEMINI_SESSION_TTL': ('session_ttl', float),
+            'GEMINI_CACHE_ENABLED': ('cache_enabled', lambda x: x.lower() == 'true'),
+            'GEMINI_CACHE_TTL': ('cache_ttl', float),
+            'GEMINI_DISK_CACHE': ('disk_cache_enabled', lambda x: x.lower() == 'true'),
+            'GEMINI_WORKER_POOL': ('worker_pool_size', int),
+            'GEMINI_BACKEND': ('backend', str),
+            'GEMINI_PROMPT_DELIVERY': ('prompt_delivery', str),
+            'GEMINI_OUTPUT_MEMORY_LIMIT': ('output_memory_limit', int),
+            'GEMINI_KILL_GRACE': ('kill_grace', float),
+            'GEMINI_API_BASE_URL': ('api_base_url', str),
+            'GEMINI_HTTP_MAX_CONNECTIONS': ('http_max_connections', int),
+            'GEMINI_RETRY_MAX_ATTEMPTS': ('retry_max_attempts', int),
+            'GEMINI_RETRY_DEADLINE': ('retry_deadline', float),
+            'GEMINI_CIRCUIT_BREAKER': ('circuit_breaker_enabled', lambda x: x.lower() == 'true'),
+            'GEMINI_CIRCUIT_THRESHOLD': ('circuit_failure_threshold', int),
+            'GEMINI_CIRCUIT_RECOVERY': ('circuit_recovery_timeout', float),
+            'GEMINI_MAX_QUEUE_DEPTH': ('max_queue_depth', int),
+            'GEMINI_DEFAULT_BUDGET': ('default_budget', float),
         }
         
         env_overrides = 0
@@ -74,6 +101,9 @@ class MCPServer:
         if env_overrides > 0:
             print(f"Applied {env_overrides} environment variable overrides")
         
+        # Persist consultation answers under the project root across restarts
+        config.setdefault('disk_cache_path', str(self.project_root / ".gemini-cache" / "consultations.sqlite3"))
+        
         return config
 
     def _setup_tools(self):
@@ -99,11 +129,78 @@ class MCPServer:
                                 "type": "boolean",
                                 "description": "Whether to request structured comparison format",
                                 "default": True
+                            },
+                            "use_cache": {
+                                "type": "boolean",
+                                "description": "Whether a cached answer to an identical consultation may be returned",
+                                "default": True
+                            },
+                            "chunked_context": {
+                                "type": "boolean",
+                                "description": "Analyse a context longer than max_context_length in sections and merge the answers instead of truncating it (default: chunked_context setting)"
+                            },
+                            "session_id": {
+                                "type": "string",
+                                "description": "Consultation session to continue. Follow-ups reuse the stored context, so only the new question and any new context need to be sent. An unknown or expired ID is an error; resend the context with new_session"
+                            },
+                            "new_session": {
+                                "type": "boolean",
+                                "description": "Start a new session (under session_id if given, else a generated ID) and store 'context' in it",
+                                "default": False
+                            },
+                            "priority": {
+                                "type": "integer",
+                                "description": "Scheduling priority, lower runs first (default: 0 for consult_gemini; waiting calls gain one level every priority_aging seconds)"
+                            },
+                            "budget_seconds": {
+                                "type": "number",
+                                "description": "Time budget for the whole consultation, including queueing and retries; work still queued when it runs out is dropped"
                             }
                         },
                         "required": ["query"]
                     }
                 ),
+                types.Tool(
+                    name="consult_gemini_batch",
+                    description="Consult Gemini on many independent snippets at once; answers come back in order with per-item status and timing",
+                    inputSchema={
+                        "type": "object",
+                        "properties": {
+                            "items": {
+                                "type": "array",
+                                "items": {
+                                    "type": "object",
+                                    "properties": {
+                                        "query": {"type": "string"},
+                                        "context": {"type": "string"}
+                                    },
+                                    "required": ["query"]
+                                },
+                                "description": "Consultations to run, each with a query and optional context"
+                            },
+                            "comparison_mode": {
+                                "type": "boolean",
+                                "description": "Whether to request structured comparison format",
+                                "default": True
+                            },
+                            "parallelism": {
+                                "type": "integer",
+                                "minimum": 1,
+                                "maximum": self.gemini.batch_parallelism,
+                                "description": "Items consulted at once, capped at the batch_parallelism setting (default: that setting)"
+                            },
+                            "priority": {
+                                "type": "integer",
+                                "description": "Scheduling priority, lower runs first (default: 2)"
+                            },
+                            "budget_seconds": {
+                                "type": "number",
+                                "description": "Time budget for the whole batch; items still queued when it runs out fail with a deadline error"
+                            }
+                        },
+                        "required": ["items"]
+                    }
+                ),
                 types.Tool(
                     name="gemini_status",
                     description="Check Gemini integration status and statistics",
@@ -113,6 +210,112 @@ class MCPServer:
                         "required": []
                     }
                 ),
+                types.Tool(
+                    name="end_gemini_session",
+                    description="End a consultation session and discard its stored context",
+                    inputSchema={
+                        "type": "object",
+                        "properties": {
+                            "session_id": {
+                                "type": "string",
+                                "description": "Session ID returned by consult_gemini"
+                            }
+                        },
+                        "required": ["session_id"]
+                    }
+                ),
+                types.Tool(
+                    name="submit_consultation",
+                    description="Start a Gemini consultation in the background and return a job ID at once; poll it with get_consultation_result",
+                    inputSchema={
+                        "type": "object",
+                        "properties": {
+                            "query": {
+                                "type": "string",
+                                "description": "The question or topic to consult Gemini about"
+                            },
+                            "context": {
+                                "type": "string",
+                                "description": "Additional context for the consultation"
+                            },
+                            "comparison_mode": {
+                                "type": "boolean",
+                                "description": "Whether to request structured comparison format",
+                                "default": True
+                            },
+                            "chunked_context": {
+                                "type": "boolean",
+                                "description": "Analyse a context longer than max_context_length in sections and merge the answers instead of truncating it"
+                            },
+                            "session_id": {
+                                "type": "string",
+                                "description": "Consultation session to continue"
+                            },
+                            "priority": {
+                                "type": "integer",
+                                "description": "Scheduling priority, lower runs first (default: 2)"
+                            },
+                            "budget_seconds": {
+                                "type": "number",
+                                "description": "Time budget for the whole consultation, including queueing and retries"
+                            }
+                        },
+                        "required": ["query"]
+                    }
+                ),
+                types.Tool(
+                    name="get_consultation_result",
+                    description="Get the state of a consultation job, and its answer once completed",
+                    inputSchema={
+                        "type": "object",
+                        "properties": {
+                            "job_id": {
+                                "type": "string",
+                                "description": "Job ID returned by submit_consultation"
+                            },
+                            "wait_seconds": {
+                                "type": "number",
+                                "description": "Wait up to this many seconds for the job to finish before answering",
+                                "default": 0
+                            }
+                        },
+                        "required": ["job_id"]
+                    }
+                ),
+                types.Tool(
+                    name="cancel_consultation",
+                    description="Cancel a running consultation job and stop its Gemini CLI process",
+                    inputSchema={
+                        "type": "object",
+                        "properties": {
+                            "job_id": {
+                                "type": "string",
+                                "description": "Job ID returned by submit_consultation"
+                            }
+                        },
+                        "required": ["job_id"]
+                    }
+                ),
+                types.Tool(
+                    name="detect_uncertainty_batch",
+                    description="Detect uncertainty patterns in many texts at once to decide which need a Gemini consultation",
+                    inputSchema={
+                        "type": "object",
+                        "properties": {
+                            "texts": {
+                                "type": "array",
+                                "items": {"type": "string"},
+                                "description": "Texts to analyze"
+                            },
+                            "include_patterns": {
+                                "type": "boolean",
+                                "description": "Whether to list the matched patterns for each text",
+                                "default": False
+                            }
+                        },
+                        "required": ["texts"]
+                    }
+                ),
                 types.Tool(
                     name="toggle_gemini_auto_consult",
                     description="Enable or disable automatic Gemini consultation",
@@ -140,6 +343,14 @@ class MCPServer:
                             "project_context": {
                                 "type": "string",
                                 "description": "프로젝트 컨텍스트 (기술 스택, 현재 상태 등)"
+                            },
+                            "priority": {
+                                "type": "integer",
+                                "description": "스케줄링 우선순위, 낮을수록 먼저 실행 (기본값: 1)"
+                            },
+                            "budget_seconds": {
+                                "type": "number",
+                                "description": "대기열 대기와 재시도를 포함한 전체 시간 예산 (초)"
                             }
                         },
                         "required": ["user_request"]
@@ -163,6 +374,14 @@ class MCPServer:
                                 "type": "string",
                                 "description": "구현 복잡도 (basic, intermediate, advanced)",
                                 "default": "intermediate"
+                            },
+                            "priority": {
+                                "type": "integer",
+                                "description": "스케줄링 우선순위, 낮을수록 먼저 실행 (기본값: 1)"
+                            },
+                            "budget_seconds": {
+                                "type": "number",
+                                "description": "대기열 대기와 재시도를 포함한 전체 시간 예산 (초)"
                             }
                         },
                         "required": ["enhanced_request"]
@@ -186,6 +405,14 @@ class MCPServer:
                                 "type": "string",
                                 "description": "출력 형식 (detailed_plan, quick_guide, step_by_step)",
                                 "default": "detailed_plan"
+                            },
+                            "priority": {
+                                "type": "integer",
+                                "description": "스케줄링 우선순위, 낮을수록 먼저 실행 (기본값: 2)"
+                            },
+                            "budget_seconds": {
+                                "type": "number",
+                                "description": "대기열 대기와 재시도를 포함한 전체 시간 예산 (초)"
                             }
                         },
                         "required": ["user_request"]
@@ -197,8 +424,20 @@ class MCPServer:
         async def handle_call_tool(name: str, arguments: Dict[str, Any]):
             if name == "consult_gemini":
                 return await self._handle_consult_gemini(arguments)
+            elif name == "consult_gemini_batch":
+                return await self._handle_consult_gemini_batch(arguments)
             elif name == "gemini_status":
                 return await self._handle_gemini_status(arguments)
+            elif name == "end_gemini_session":
+                return await self._handle_end_gemini_session(arguments)
+            elif name == "submit_consultation":
+                return await self._handle_submit_consultation(arguments)
+            elif name == "get_consultation_result":
+                return await self._handle_get_consultation_result(arguments)
+            elif name == "cancel_consultation":
+                return await self._handle_cancel_consultation(arguments)
+            elif name == "detect_uncertainty_batch":
+                return await self._handle_detect_uncertainty_batch(arguments)
             elif name == "toggle_gemini_auto_consult":
                 return await self._handle_toggle_auto_consult(arguments)
             elif name == "enhance_request":
@@ -210,11 +449,39 @@ class MCPServer:
             else:
                 raise ValueError(f"Unknown tool: {name}")
 
+    def _progress_reporter(self) -> Optional[Callable[[str], Awaitable[None]]]:
+        """Forward partial Gemini output as MCP progress notifications, if the client asked for progress"""
+        try:
+            ctx = self.server.request_context
+        except LookupError:
+            return None
+        
+        progress_token = ctx.meta.progressToken if ctx.meta else None
+        if progress_token is None:
+            return None
+        
+        received = 0
+        
+        async def report(text: str):
+            nonlocal received
+            received += len(text)
+            try:
+                await ctx.session.send_progress_notification(progress_token, received, message=text)
+            except TypeError:
+                # Older MCP SDKs cannot attach a message to progress notifications
+                await ctx.session.send_progress_notification(progress_token, received)
+        
+        return report
+
     async def _handle_consult_gemini(self, arguments: Dict[str, Any]) -> List[types.TextContent]:
         """Handle Gemini consultation requests"""
         query = arguments.get('query', '')
         context = arguments.get('context', '')
         comparison_mode = arguments.get('comparison_mode', True)
+        use_cache = arguments.get('use_cache', True)
+        chunked = arguments.get('chunked_context')
+        session_id = arguments.get('session_id')
+        new_session = arguments.get('new_session', False)
         
         if not query:
             return [types.TextContent(
@@ -227,13 +494,78 @@ class MCPServer:
         result = await self.gemini.consult_gemini(
             query=query,
             context=context,
-            comparison_mode=comparison_mode
+            comparison_mode=comparison_mode,
+            use_cache=use_cache,
+            on_progress=self._progress_reporter(),
+            chunked=chunked,
+            session_id=session_id,
+            new_session=new_session,
+            tool="consult_gemini",
+            priority=arguments.get('priority'),
+            budget=arguments.get('budget_seconds')
         )
         
+        return [types.TextContent(type="text", text=self._format_consultation(result))]
+
+    async def _handle_consult_gemini_batch(self, arguments: Dict[str, Any]) -> List[types.TextContent]:
+        """Handle batch Gemini consultation requests"""
+        items = arguments.get('items')
+        
+        if not isinstance(items, list) or not items:
+            return [types.TextContent(
+                type="text",
+                text="❌ Error: 'items' parameter must be a non-empty list of {query, context} objects"
+            )]
+        
+        print(f"Processing Gemini batch consultation: {len(items)} items...")
+        
+        batch = await self.gemini.consult_gemini_batch(
+            items,
+            parallelism=arguments.get('parallelism'),
+            budget=arguments.get('budget_seconds'),
+            comparison_mode=arguments.get('comparison_mode', True),
+            priority=arguments.get('priority')
+        )
+        
+        if not batch['results']:
+            return [types.TextContent(type="text", text=f"❌ **Gemini Batch Failed**\n\n{batch.get('error', 'Unknown error')}")]
+        
+        parts = [
+            f"🤖 **Gemini Batch Consultation**: {batch['succeeded']}/{len(batch['results'])} succeeded "
+            f"in {batch['execution_time']:.2f}s\n"
+        ]
+        for result in batch['results']:
+            number = result['index'] + 1
+            if result['status'] == 'success':
+                timing = "cached" if result.get('cached') else f"{result['elapsed']:.2f}s"
+                parts.extend([f"\n### {number}. ✅ ({timing})\n\n", result['response'], "\n"])
+            else:
+                parts.append(
+                    f"\n### {number}. ❌ {result.get('error_type', result['status'])} "
+                    f"({result['elapsed']:.2f}s)\n\n{result.get('error') or result.get('message', 'Unknown error')}\n"
+                )
+        
+        # Join once so many large answers are copied a single time
+        return [types.TextContent(type="text", text="".join(parts))]
+
+    def _format_consultation(self, result: Dict[str, Any]) -> str:
+        """Render a consult_gemini result as tool output"""
         if result['status'] == 'success':
-            response_text = f"🤖 **Gemini Second Opinion**\n\n{result['response']}\n\n"
-            response_text += f"⏱️ *Consultation completed in {result['execution_time']:.2f}s*"
-            response_text += f"\n📋 *Consultation ID: {result['consultation_id']}*"
+            # Join once so a large answer is copied a single time
+            response_text = "".join([
+                "🤖 **Gemini Second Opinion**\n\n",
+                result['response'],
+                "\n\n",
+                "⚡ *Served from cache*" if result.get('cached')
+                else f"⏱️ *Consultation completed in {result['execution_time']:.2f}s*",
+                f"\n🧩 *Context analysed in {result['chunks']} sections*" if result.get('chunks', 1) > 1 else "",
+                f"\n🧵 *Session: {result['session_id']}*" if result.get('session_id') else "",
+                " *(context sent as a summary)*" if result.get('session_digest_used') else "",
+                f"\n🧠 *Answered by {result['model']}*" if result.get('model') else "",
+                f"\n📋 *Consultation ID: {result['consultation_id']}*"
+            ])
+        elif result['status'] == 'overloaded':
+            response_text = f"⏳ **Gemini Overloaded**\n\n{result['message']}"
         elif result['status'] == 'disabled':
             response_text = "⚠️ **Gemini Integration Disabled**\n\nGemini integration is currently disabled. Enable it with the toggle_gemini_auto_consult tool."
         else:
@@ -242,7 +574,7 @@ class MCPServer:
             response_text += f"**Error:** {result.get('error', 'Unknown error')}\n\n"
             response_text += f"**Suggestion:** {error_suggestion}"
         
-        return [types.TextContent(type="text", text=response_text)]
+        return response_text
 
     async def _handle_gemini_status(self, arguments: Dict[str, Any]) -> List[types.TextContent]:
         """Handle Gemini status requests"""
@@ -254,10 +586,12 @@ class MCPServer:
             f"• **Enabled**: {'✅ Yes' if status_info['enabled'] else '❌ No'}",
             f"• **Auto-consult**: {'✅ Yes' if status_info['auto_consult'] else '❌ No'}",
             f"• **CLI Command**: `{status_info['cli_command']}`",
+            f"• **Backend**: {(status_info.get('backend') or {}).get('name', 'cli')}",
             f"• **Model**: {status_info['model']}",
             f"• **Rate Limit**: {status_info['rate_limit_delay']}s between calls",
             f"• **Timeout**: {status_info['timeout']}s",
             f"• **Max Context**: {status_info['max_context_length']} characters",
+            f"• **Auto-consult Score**: ≥ {status_info.get('consult_score', 'n/a')}",
             "",
             f"📊 **Statistics**:",
             f"• **Total Consultations**: {status_info['total_consultations']}",
@@ -265,11 +599,223 @@ class MCPServer:
             f"• **Failed**: {status_info['failed_consultations']}",
         ]
         
+        scheduler = status_info.get('scheduler')
+        if scheduler:
+            status_lines.append(
+                f"• **Scheduler**: {scheduler['in_flight']}/{scheduler['max_in_flight']} running, "
+                f"{scheduler['queue_depth']} queued, avg wait {scheduler['avg_wait']:.2f}s "
+                f"(max {scheduler['max_wait']:.2f}s)"
+            )
+            if scheduler.get('queued_priorities'):
+                status_lines.append(
+                    f"• **Queued Priorities**: {', '.join(map(str, scheduler['queued_priorities']))}"
+                )
+        
+        if 'inflight_consultations' in status_info:
+            status_lines.append(
+                f"• **In Flight**: {status_info['inflight_consultations']} "
+                f"({status_info['coalesced_consultations']} duplicate calls coalesced)"
+            )
+        
+        cache = status_info.get('cache')
+        if cache:
+            status_lines.append(
+                f"• **Cache**: {cache['hits']} hits / {cache['misses']} misses, "
+                f"{cache['entries']} entries ({cache['bytes']} bytes)"
+            )
+        disk_cache = status_info.get('disk_cache')
+        if disk_cache:
+            status_lines.append(
+                f"• **Disk Cache**: {disk_cache['hits']} hits / {disk_cache['misses']} misses "
+                f"(`{disk_cache['path']}`)"
+            )
+        processes = status_info.get('processes')
+        if processes:
+            status_lines.append(
+                f"• **CLI Processes**: {processes['live']} live, {processes['terminated']} killed "
+                f"on timeout/cancel, {processes['leaked']} leaked"
+            )
+        compaction = status_info.get('compaction')
+        if compaction and compaction['runs']:
+            status_lines.append(
+                f"• **Context Compaction**: ~{compaction['saved_tokens']} tokens / "
+                f"{compaction['saved_bytes']} bytes saved over {compaction['runs']} contexts"
+            )
+        sessions = status_info.get('sessions')
+        if sessions and sessions['created']:
+            status_lines.append(
+                f"• **Sessions**: {sessions['sessions']} active ({sessions['chars']} chars stored), "
+                f"{sessions['evictions'] + sessions['expirations']} evicted"
+            )
+        breaker = status_info.get('circuit_breaker')
+        if breaker and breaker['failure_threshold'] > 0:
+            state = {'closed': '✅ closed', 'open': '🛑 open', 'half_open': '⚠️ half-open'}[breaker['state']]
+            line = f"• **Circuit Breaker**: {state}, {breaker['failures']}/{breaker['failure_threshold']} recent failures"
+            if breaker['state'] == 'open':
+                line += f" (last: {breaker['last_error_type']}, probing in {breaker['retry_in']:.0f}s)"
+            if breaker['rejected']:
+                line += f", {breaker['rejected']} calls rejected"
+            status_lines.append(line)
+        load_shed = status_info.get('load_shed')
+        if load_shed and (load_shed['overloaded'] or load_shed['deadline_exceeded']):
+            status_lines.append(
+                f"• **Load Shedding**: {load_shed['overloaded']} rejected as overloaded "
+                f"(limit {status_info['max_queue_depth']} queued), {load_shed['deadline_exceeded']} past their deadline"
+            )
+        retries = status_info.get('retries')
+        if retries and retries['retries']:
+            status_lines.append(
+                f"• **Retries**: {retries['retries']} retries, {retries['recovered']} recovered, "
+                f"{retries['exhausted']} gave up"
+            )
+        hedging = status_info.get('hedging')
+        if hedging and (hedging['hedged'] or hedging['fanouts']):
+            status_lines.append(
+                f"• **Hedging**: {hedging['hedged']} hedged, {hedging['fanouts']} fan-outs, "
+                f"{hedging['secondary_wins']} won by a backup request, {hedging['cancelled']} losers cancelled"
+            )
+        routing = status_info.get('routing')
+        if routing and routing['routes']:
+            routes = ", ".join(f"{model} ×{count}" for model, count in routing['routes'].items())
+            status_lines.append(f"• **Model Routing**: {routes} ({routing['rules']} rules)")
+        for model, latency in (status_info.get('latency') or {}).items():
+            status_lines.append(
+                f"• **Latency ({model})**: p50 {latency['p50']:.2f}s / p95 {latency['p95']:.2f}s "
+                f"over {latency['count']} calls"
+            )
+        jobs = status_info.get('jobs')
+        if jobs and jobs['submitted']:
+            status_lines.append(
+                f"• **Background Jobs**: {jobs['running']} running, {jobs['jobs']} stored, "
+                f"{jobs['submitted']} submitted, {jobs['cancelled']} cancelled"
+            )
+        worker_pool = status_info.get('worker_pool')
+        if worker_pool and worker_pool['size']:
+            status_lines.append(
+                f"• **Warm Workers**: {worker_pool['idle']}/{worker_pool['size']} ready, "
+                f"{worker_pool['hits']} hits / {worker_pool['misses']} cold starts"
+            )
+
+        if status_info.get('auto_consult_checks'):
+            status_lines.append(
+                f"• **Auto-consult Triggered**: {status_info['auto_consult_triggered']}"
+                f"/{status_info['auto_consult_checks']} checks"
+            )
+        
         if status_info['last_consultation']:
             status_lines.append(f"• **Last Consultation**: {status_info['last_consultation']}")
         
         return [types.TextContent(type="text", text="\n".join(status_lines))]
     
+    async def _handle_end_gemini_session(self, arguments: Dict[str, Any]) -> List[types.TextContent]:
+        """Handle ending a consultation session"""
+        session_id = arguments.get('session_id', '')
+        
+        if self.gemini.end_session(session_id):
+            response_text = f"🧵 **Session ended**\n\nSession `{session_id}` and its stored context were discarded."
+        else:
+            response_text = f"⚠️ **Unknown session**\n\nNo active session `{session_id}` (it may have expired)."
+        
+        return [types.TextContent(type="text", text=response_text)]
+
+    async def _handle_submit_consultation(self, arguments: Dict[str, Any]) -> List[types.TextContent]:
+        """Handle starting a background consultation job"""
+        query = arguments.get('query', '')
+        
+        if not query:
+            return [types.TextContent(
+                type="text",
+                text="❌ Error: 'query' parameter is required for Gemini consultation"
+            )]
+        
+        result = self.gemini.submit_consultation(
+            query,
+            context=arguments.get('context', ''),
+            comparison_mode=arguments.get('comparison_mode', True),
+            chunked=arguments.get('chunked_context'),
+            session_id=arguments.get('session_id'),
+            priority=arguments.get('priority'),
+            budget=arguments.get('budget_seconds')
+        )
+        
+        if result['status'] == 'submitted':
+            response_text = (
+                f"📨 **Consultation submitted**\n\n"
+                f"Job ID: `{result['job_id']}`\n"
+                f"Poll it with get_consultation_result (optionally with wait_seconds) or stop it with cancel_consultation."
+            )
+        else:
+            response_text = self._format_consultation(result)
+        
+        return [types.TextContent(type="text", text=response_text)]
+
+    async def _handle_get_consultation_result(self, arguments: Dict[str, Any]) -> List[types.TextContent]:
+        """Handle polling a background consultation job"""
+        job_id = arguments.get('job_id', '')
+        wait = min(max(float(arguments.get('wait_seconds', 0) or 0), 0.0), self.MAX_POLL_WAIT)
+        
+        job = await self.gemini.get_consultation_result(job_id, wait=wait)
+        
+        if job['state'] == 'not_found':
+            response_text = f"⚠️ **Unknown job**\n\nNo consultation job `{job_id}` (it may have expired)."
+        elif job['state'] == 'running':
+            response_text = "".join([
+                f"⏳ **Job {job_id} running** ({job['elapsed']:.0f}s)",
+                f"\n\n**Partial answer so far:**\n{job['partial_response']}" if job['partial_response'] else ""
+            ])
+        elif job['state'] == 'cancelled':
+            response_text = f"🛑 **Job {job_id} cancelled**"
+        else:
+            response_text = self._format_consultation(job['result'])
+        
+        return [types.TextContent(type="text", text=response_text)]
+
+    async def _handle_cancel_consultation(self, arguments: Dict[str, Any]) -> List[types.TextContent]:
+        """Handle cancelling a background consultation job"""
+        job_id = arguments.get('job_id', '')
+        
+        job = self.gemini.cancel_consultation(job_id)
+        
+        if job['state'] == 'not_found':
+            response_text = f"⚠️ **Unknown job**\n\nNo consultation job `{job_id}` (it may have expired)."
+        elif job['state'] == 'cancelled':
+            response_text = f"🛑 **Job cancelled**\n\nJob `{job_id}` was cancelled and its Gemini process stopped."
+        else:
+            response_text = f"ℹ️ **Job already finished**\n\nJob `{job_id}` had already completed; fetch it with get_consultation_result."
+        
+        return [types.TextContent(type="text", text=response_text)]
+
+    async def _handle_detect_uncertainty_batch(self, arguments: Dict[str, Any]) -> List[types.TextContent]:
+        """Handle batch uncertainty detection requests"""
+        texts = arguments.get('texts')
+        include_patterns = arguments.get('include_patterns', False)
+        
+        if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+            return [types.TextContent(
+                type="text",
+                text="❌ Error: 'texts' parameter must be a list of strings"
+            )]
+        
+        results = self.gemini.detect_uncertainty_batch(texts)
+        flagged = sum(1 for result in results if result['should_consult'])
+        
+        lines = [
+            "🔍 **Uncertainty Batch Analysis**",
+            "",
+            f"• **Texts analyzed**: {len(results)}",
+            f"• **Needing consultation**: {flagged}",
+            ""
+        ]
+        for i, result in enumerate(results, 1):
+            marker = "⚠️" if result['should_consult'] else "✅"
+            counts = ", ".join(f"{category}={count}" for category, count in result['counts'].items())
+            lines.append(f"{marker} #{i}: score {result['score']:.2f} ({counts})")
+            if include_patterns and result['has_uncertainty']:
+                for pattern in self.gemini.patterns_for_mask(result['mask']):
+                    lines.append(f"    - `{pattern}`")
+        
+        return [types.TextContent(type="text", text="\n".join(lines))]
+
     async def _handle_toggle_auto_consult(self, arguments: Dict[str, Any]) -> List[types.TextContent]:
         """Handle toggle auto-consultation requests"""
         enable = arguments.get('enable')
@@ -341,14 +887,22 @@ class MCPServer:
         result = await self.gemini.consult_gemini(
             query=enhancement_prompt,
             context="요청 개선 및 구체화",
-            comparison_mode=False
+            comparison_mode=False,
+            on_progress=self._progress_reporter(),
+            tool="enhance_request",
+            priority=arguments.get('priority'),
+            budget=arguments.get('budget_seconds')
         )
         
         if result['status'] == 'success':
-            response_text = f"🚀 **요청 개선 완료**\n\n"
-            response_text += f"**원본 요청:** {user_request}\n\n"
-            response_text += f"**개선된 요구사항:**\n{result['response']}\n\n"
-            response_text += f"⏱️ *분석 완료 시간: {result['execution_time']:.2f}s*"
+            response_text = "".join([
+                "🚀 **요청 개선 완료**\n\n",
+                f"**원본 요청:** {user_request}\n\n",
+                "**개선된 요구사항:**\n",
+                result['response'],
+                "\n\n",
+                f"⏱️ *분석 완료 시간: {result['execution_time']:.2f}s*"
+            ])
         else:
             response_text = f"❌ **요청 개선 실패**\n\n{result.get('error', 'Unknown error')}"
         
@@ -410,15 +964,22 @@ class MCPServer:
         result = await self.gemini.consult_gemini(
             query=code_guide_prompt,
             context="코드 생성 가이드",
-            comparison_mode=False
+            comparison_mode=False,
+            on_progress=self._progress_reporter(),
+            tool="smart_code_generation",
+            route_hints={'complexity_level': complexity_level},
+            priority=arguments.get('priority'),
+            budget=arguments.get('budget_seconds')
         )
         
         if result['status'] == 'success':
-            response_text = f"💻 **스마트 코드 생성 가이드**\n\n"
-            response_text += f"**기술 스택:** {tech_stack if tech_stack else '범용'}\n"
-            response_text += f"**복잡도:** {complexity_level}\n\n"
-            response_text += result['response']
-            response_text += f"\n\n⏱️ *가이드 생성 시간: {result['execution_time']:.2f}s*"
+            response_text = "".join([
+                "💻 **스마트 코드 생성 가이드**\n\n",
+                f"**기술 스택:** {tech_stack if tech_stack else '범용'}\n",
+                f"**복잡도:** {complexity_level}\n\n",
+                result['response'],
+                f"\n\n⏱️ *가이드 생성 시간: {result['execution_time']:.2f}s*"
+            ])
         else:
             response_text = f"❌ **코드 가이드 생성 실패**\n\n{result.get('error', 'Unknown error')}"
         
@@ -491,16 +1052,23 @@ class MCPServer:
         result = await self.gemini.consult_gemini(
             query=comprehensive_prompt,
             context="종합적 요청 분석 및 개발 계획",
-            comparison_mode=False
+            comparison_mode=False,
+            on_progress=self._progress_reporter(),
+            tool="enhance_user_request",
+            route_hints={'output_format': output_format},
+            priority=arguments.get('priority'),
+            budget=arguments.get('budget_seconds')
         )
         
         if result['status'] == 'success':
-            response_text = f"🚀 **종합 개발 계획 완료**\n\n"
-            response_text += f"**원본 요청:** {user_request}\n"
-            response_text += f"**출력 형식:** {output_format}\n\n"
-            response_text += result['response']
-            response_text += f"\n\n⏱️ *계획 수립 시간: {result['execution_time']:.2f}s*"
-            response_text += f"\n💡 *이제 이 계획을 바탕으로 AI 코딩 도구에게 구체적인 구현을 요청하세요!*"
+            response_text = "".join([
+                "🚀 **종합 개발 계획 완료**\n\n",
+                f"**원본 요청:** {user_request}\n",
+                f"**출력 형식:** {output_format}\n\n",
+                result['response'],
+                f"\n\n⏱️ *계획 수립 시간: {result['execution_time']:.2f}s*",
+                "\n💡 *이제 이 계획을 바탕으로 AI 코딩 도구에게 구체적인 구현을 요청하세요!*"
+            ])
         else:
             response_text = f"❌ **개발 계획 수립 실패**\n\n{result.get('error', 'Unknown error')}"
         
@@ -509,12 +1077,16 @@ class MCPServer:
     async def run(self):
         """Run the MCP server"""
         print("Starting MCP server...")
-        async with mcp.server.stdio.stdio_server() as (read_stream, write_stream):
-            await self.server.run(
-                read_stream,
-                write_stream,
-                self.server.create_initialization_options()
-            )
+        try:
+            async with mcp.server.stdio.stdio_server() as (read_stream, write_stream):
+                await self.server.run(
+                    read_stream,
+                    write_stream,
+                    self.server.create_initialization_options()
+                )
+        finally:
+            # Don't leave warm CLI workers or open connections behind
+            await self.gemini.close()
 
 
 async def main():
@@ -0,0 +1,27 @@
+"""
+Shared pytest setup
+"""
+import importlib.util
+import sys
+from pathlib import Path
+
+import pytest
+
+import gemini_integration
+
+# The server script is named mcp-server.py, which cannot be imported as is
+if 'mcp_server' not in sys.modules:
+    _spec = importlib.util.spec_from_file_location(
+        'mcp_server', Path(__file__).resolve().parent.parent / 'mcp-server.py'
+    )
+    _module = importlib.util.module_from_spec(_spec)
+    sys.modules['mcp_server'] = _module
+    _spec.loader.exec_module(_module)
+
+
+@pytest.fixture(autouse=True)
+def reset_integration_singleton():
+    """Give every test its own GeminiIntegration so servers pick up their own config"""
+    gemini_integration._integration = None
+    yield
+    gemini_integration._integration = None
@@ -5,9 +5,13 @@ Tests for Gemini CLI integration
 import asyncio
 import pytest
 from unittest.mock import AsyncMock, MagicMock, patch
+import os
 import subprocess
+import sys
+import tempfile
+import time
 
-from gemini_integration import GeminiIntegration
+from gemini_integration import GeminiIntegration, SessionStore, estimate_tokens
 
 
 class TestGeminiCLIIntegration:
@@ -31,6 +35,228 @@ class TestGeminiCLIIntegration:
         assert 'execution_time' in result
         assert result['execution_time'] > 0
     
+    @pytest.mark.asyncio
+    async def test_execute_gemini_cli_streams_partial_output(self):
+        """Test that stdout chunks reach the output callback as they arrive"""
+        integration = GeminiIntegration()
+        received = []
+        
+        script = (
+            "import sys, time\n"
+            "for part in ['첫 번째 ', 'second ', 'third']:\n"
+            "    sys.stdout.write(part); sys.stdout.flush(); time.sleep(0.05)\n"
+        )
+        with patch.object(integration, '_build_command', return_value=[sys.executable, '-c', script]):
+            result = await integration._execute_gemini_cli("test query", on_output=received.append)
+        
+        assert result['output'] == "첫 번째 second third"
+        assert "".join(received) == "첫 번째 second third"
+        assert len(received) >= 2
+
+    @pytest.mark.asyncio
+    async def test_execute_gemini_cli_spills_large_output(self):
+        """Test that output above output_memory_limit is spilled and returned intact"""
+        integration = GeminiIntegration({'output_memory_limit': 4096})
+        script = "import sys; sys.stdout.write('가' * 100000 + '\\n')"
+        
+        with patch.object(integration, '_build_command', return_value=[sys.executable, '-c', script]):
+            result = await integration._execute_gemini_cli("test query")
+        
+        assert result['output'] == '가' * 100000
+        assert integration.get_status_info()['spilled_outputs'] == 1
+
+    @pytest.mark.asyncio
+    async def test_execute_gemini_cli_uses_warm_worker(self):
+        """Test that prompts go to pre-started workers over stdin once the pool is warm"""
+        integration = GeminiIntegration({'worker_pool_size': 1})
+        worker = [sys.executable, '-c', "import sys; sys.stdout.write('echo:' + sys.stdin.read())"]
+
+        try:
+            with patch.object(integration, '_build_worker_command', return_value=worker), \
+                 patch.object(integration, '_build_command', return_value=worker + ['unused']):
+                # The first call finds the pool cold and falls back to a one-shot process
+                first = await integration._execute_gemini_cli("first")
+                for _ in range(100):
+                    if integration.worker_pool.stats()['idle']:
+                        break
+                    await asyncio.sleep(0.01)
+                second = await integration._execute_gemini_cli("second 질문")
+        finally:
+            await integration.worker_pool.close()
+
+        assert first['output'] == "echo:"
+        assert second['output'] == "echo:second 질문"
+        stats = integration.worker_pool.stats()
+        assert stats['misses'] == 1
+        assert stats['hits'] == 1
+
+    @pytest.mark.asyncio
+    async def test_execute_gemini_cli_large_prompt_over_stdin(self):
+        """Test that prompts above the threshold are streamed over stdin, not argv"""
+        integration = GeminiIntegration({'stdin_threshold': 1024})
+        script = "import sys; data = sys.argv[1] if len(sys.argv) > 1 else sys.stdin.read(); print(len(sys.argv), len(data))"
+        query = "컨텍스트 " * 300000
+
+        with patch.object(integration, '_build_worker_command', return_value=[sys.executable, '-c', script]), \
+             patch.object(integration, '_build_command', side_effect=lambda q, model=None: [sys.executable, '-c', script, q]):
+            large = await integration._execute_gemini_cli(query)
+            small = await integration._execute_gemini_cli("short")
+
+        assert large['output'] == f"1 {len(query)}"
+        assert small['output'] == "2 5"
+
+    @pytest.mark.asyncio
+    async def test_execute_gemini_cli_argv_too_long_falls_back_to_stdin(self):
+        """Test that E2BIG from an oversized -p argument is retried over stdin"""
+        integration = GeminiIntegration({'prompt_delivery': 'argv'})
+        script = "import sys; print(len(sys.stdin.read()))"
+        query = "x" * (1 << 20)
+
+        with patch.object(integration, '_build_worker_command', return_value=[sys.executable, '-c', script]), \
+             patch.object(integration, '_build_command', side_effect=lambda q, model=None: [sys.executable, '-c', script, q]):
+            result = await integration._execute_gemini_cli(query)
+
+        assert result['output'] == str(len(query))
+
+    @pytest.mark.asyncio
+    async def test_worker_pool_discards_dead_workers(self):
+        """Test that a worker that exited while idle is never handed out"""
+        integration = GeminiIntegration({'worker_pool_size': 1})
+        pool = integration.worker_pool
+        worker = [sys.executable, '-c', "import sys; sys.stdin.read()"]
+
+        try:
+            assert await pool.acquire(worker) is None
+            for _ in range(100):
+                if pool.stats()['idle']:
+                    break
+                await asyncio.sleep(0.01)
+
+            process, _ = pool._idle[tuple(worker)][0]
+            process.kill()
+            await process.wait()
+
+            assert await pool.acquire(worker) is None
+            assert pool.stats()['spawn_failures'] == 1
+            assert pool.stats()['recycled'] == 0
+        finally:
+            await pool.close()
+
+    @pytest.mark.asyncio
+    async def test_worker_pool_disables_itself_when_workers_exit_early(self):
+        """Test that workers which never wait for a prompt turn the pool off instead of adding spawns"""
+        integration = GeminiIntegration({'worker_pool_size': 1})
+        pool = integration.worker_pool
+        worker = [sys.executable, '-c', "pass"]
+
+        try:
+            await pool.acquire(worker)
+            for _ in range(500):
+                if not pool.enabled:
+                    break
+                # Only ask again once the idle worker has exited
+                idle = pool._idle.get(tuple(worker))
+                if idle and idle[0][0].returncode is not None:
+                    await pool.acquire(worker)
+                await asyncio.sleep(0.01)
+        finally:
+            await pool.close()
+
+        assert pool.stats()['size'] == 0
+        assert pool.stats()['spawn_failures'] == 3
+        assert pool.stats()['hits'] == 0
+
+    @pytest.mark.asyncio
+    async def test_worker_pool_keeps_workers_per_model(self):
+        """Test that alternating models reuse warm workers instead of draining the pool"""
+        integration = GeminiIntegration({'worker_pool_size': 1})
+        pool = integration.worker_pool
+        flash = [sys.executable, '-c', "import sys; sys.stdin.read()", 'gemini-2.5-flash']
+        pro = [sys.executable, '-c', "import sys; sys.stdin.read()", 'gemini-2.5-pro']
+
+        async def warm():
+            for _ in range(200):
+                if pool.stats()['idle'] == 2:
+                    return
+                await asyncio.sleep(0.01)
+
+        try:
+            await pool.acquire(flash)
+            await pool.acquire(pro)
+            await warm()
+            for command in [flash, pro] * 3:
+                process = await pool.acquire(command)
+                assert process is not None
+                await pool.tracker.terminate(process)
+                await warm()
+        finally:
+            await pool.close()
+
+        stats = pool.stats()
+        assert stats['hits'] == 6
+        assert stats['misses'] == 2
+        assert stats['spawned'] == 8
+        assert stats['recycled'] == 2
+
+    @staticmethod
+    def _is_running(pid):
+        """Whether a pid belongs to a process that has not exited (zombies count as exited)"""
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+        except FileNotFoundError:
+            return False
+
+    @pytest.mark.asyncio
+    @pytest.mark.skipif(not sys.platform.startswith("linux"), reason="inspects /proc")
+    async def test_execute_gemini_cli_timeout_kills_process_group(self):
+        """Test that a timed-out CLI and the processes it started are killed and reaped"""
+        integration = GeminiIntegration({'timeout': 0.5})
+        
+        with tempfile.TemporaryDirectory() as temp_dir:
+            pid_file = os.path.join(temp_dir, "child.pid")
+            script = (
+                "import subprocess, sys, time\n"
+                "child = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)'])\n"
+                f"open({pid_file!r}, 'w').write(str(child.pid))\n"
+                "time.sleep(30)\n"
+            )
+            with patch.object(integration, '_build_command', return_value=[sys.executable, '-c', script]):
+                with pytest.raises(Exception) as exc_info:
+                    await integration._execute_gemini_cli("test query")
+            
+            assert "timed out" in str(exc_info.value)
+            stats = integration.process_tracker.stats()
+            assert stats['live'] == 0
+            assert stats['terminated'] == 1
+            
+            with open(pid_file) as f:
+                grandchild = int(f.read())
+            for _ in range(50):
+                if not self._is_running(grandchild):
+                    break
+                await asyncio.sleep(0.02)
+            assert not self._is_running(grandchild)
+    
+    @pytest.mark.asyncio
+    async def test_execute_gemini_cli_cancellation_kills_process(self):
+        """Test that cancelling a consultation kills the CLI child"""
+        integration = GeminiIntegration()
+        script = "import time; time.sleep(30)"
+        
+        with patch.object(integration, '_build_command', return_value=[sys.executable, '-c', script]):
+            task = asyncio.ensure_future(integration._execute_gemini_cli("test query"))
+            for _ in range(100):
+                if integration.process_tracker.live:
+                    break
+                await asyncio.sleep(0.01)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+        
+        assert integration.process_tracker.stats()['live'] == 0
+        assert integration.process_tracker.stats()['terminated'] == 1
+    
     @pytest.mark.asyncio
     async def test_execute_gemini_cli_command_not_found(self):
         """Test Gemini CLI command not found error"""
@@ -159,7 +385,7 @@ class TestGeminiCLIIntegration:
     @pytest.mark.asyncio
     async def test_consult_gemini_error_type_detection(self):
         """Test error type detection in consultation"""
-        integration = GeminiIntegration()
+        integration = GeminiIntegration({'retry_max_attempts': 1})
         
         error_cases = [
             ("authentication failed", "authentication"),
@@ -177,6 +403,656 @@ class TestGeminiCLIIntegration:
             assert result['status'] == 'error'
             assert result['error_type'] == expected_type
     
+    @pytest.mark.asyncio
+    async def test_consult_gemini_retries_transient_errors(self):
+        """Test that rate limits and timeouts are retried and the retries are logged"""
+        integration = GeminiIntegration({'retry_base_delay': 0.01, 'retry_max_delay': 0.05})
+        outcomes = [Exception("Gemini API rate limit exceeded (HTTP 429)"),
+                    Exception("Gemini CLI timed out after 60 seconds"),
+                    {'output': 'answer', 'execution_time': 0.1}]
+        
+        with patch.object(integration, '_execute_gemini_cli', side_effect=outcomes) as mock_cli:
+            with patch.object(integration, '_enforce_rate_limit') as mock_rate_limit:
+                result = await integration.consult_gemini("test query")
+        
+        assert result['status'] == 'success'
+        assert result['retries'] == 2
+        assert mock_cli.call_count == 3
+        assert mock_rate_limit.call_count == 3
+        assert integration.consultation_log[-1]['retries'] == 2
+        assert integration.retry_stats == {'retries': 2, 'recovered': 1, 'exhausted': 0}
+    
+    @pytest.mark.asyncio
+    async def test_consult_gemini_does_not_retry_permanent_errors(self):
+        """Test that authentication and missing-CLI errors fail on the first attempt"""
+        integration = GeminiIntegration({'retry_base_delay': 0.01})
+        
+        for error_msg in ("authentication required", "Gemini CLI command 'gemini' not found"):
+            with patch.object(integration, '_execute_gemini_cli', side_effect=Exception(error_msg)) as mock_cli:
+                with patch.object(integration, '_enforce_rate_limit'):
+                    result = await integration.consult_gemini(f"query for {error_msg}")
+            
+            assert mock_cli.call_count == 1
+            assert result['retries'] == 0
+        assert integration.consultation_log[-1]['retries'] == 0
+    
+    @pytest.mark.asyncio
+    async def test_consult_gemini_retries_stop_at_deadline(self):
+        """Test that no retry starts when its backoff would pass the deadline"""
+        integration = GeminiIntegration({'retry_max_attempts': 5, 'retry_base_delay': 10, 'retry_deadline': 1})
+        
+        with patch.object(integration, '_execute_gemini_cli', side_effect=Exception("rate limit exceeded")) as mock_cli:
+            with patch.object(integration, '_enforce_rate_limit'):
+                start = time.monotonic()
+                result = await integration.consult_gemini("test query")
+        
+        assert time.monotonic() - start < 1
+        assert mock_cli.call_count == 1
+        assert result['error_type'] == 'rate_limit'
+        assert integration.retry_stats['exhausted'] == 1
+    
+    @pytest.mark.asyncio
+    async def test_consult_gemini_retry_attempts_are_cut_to_retry_deadline(self):
+        """Test that a retry only gets the time left before retry_deadline, not a full timeout"""
+        integration = GeminiIntegration({'timeout': 1.0, 'retry_deadline': 1.5, 'retry_max_attempts': 3,
+                                         'retry_base_delay': 0.01, 'retry_max_delay': 0.05,
+                                         'circuit_failure_threshold': 2})
+        timeouts = []
+        
+        async def slow_cli(query, timeout=None, **kwargs):
+            timeout = integration.timeout if timeout is None else min(integration.timeout, timeout)
+            timeouts.append(timeout)
+            await asyncio.sleep(timeout)
+            raise Exception(f"Gemini CLI timed out after {timeout:g} seconds")
+        
+        with patch.object(integration, '_execute_gemini_cli', side_effect=slow_cli):
+            with patch.object(integration, '_enforce_rate_limit'):
+                start = time.monotonic()
+                result = await integration.consult_gemini("test query")
+        
+        # A few milliseconds of slack for scheduling around the retry loop
+        assert time.monotonic() - start <= 1.5 + 0.05
+        assert result['status'] == 'error'
+        assert result['retries'] == 1
+        assert timeouts[0] == 1.0
+        assert timeouts[1] < 0.5
+        # Only the caller's own deadline turns a timeout into a deadline error
+        assert result['error_type'] == 'timeout'
+        assert integration.retry_stats['exhausted'] == 1
+        assert integration.breaker.state == 'open'
+    
+    @pytest.mark.asyncio
+    async def test_consult_gemini_budget_bounds_cli_timeout(self):
+        """Test that the remaining budget becomes the CLI timeout and expiry is not a Gemini failure"""
+        integration = GeminiIntegration({'timeout': 600, 'cache_enabled': False, 'circuit_failure_threshold': 1})
+        timeouts = []
+        
+        async def slow_cli(query, timeout=None, **kwargs):
+            timeout = integration.timeout if timeout is None else min(integration.timeout, timeout)
+            timeouts.append(timeout)
+            await asyncio.sleep(60)
+        
+        with patch.object(integration, '_execute_gemini_cli', side_effect=slow_cli):
+            with patch.object(integration, '_enforce_rate_limit'):
+                start_time = time.monotonic()
+                result = await integration.consult_gemini("test query", budget=0.2)
+        
+        assert time.monotonic() - start_time < 2
+        assert 0 < timeouts[0] <= 0.2
+        assert result['status'] == 'error'
+        assert result['error_type'] == 'deadline'
+        assert integration.breaker.state == 'closed'
+        assert integration.load_shed['deadline_exceeded'] == 1
+    
+    @pytest.mark.asyncio
+    async def test_consult_gemini_rejects_when_queue_is_full(self):
+        """Test that admission control sheds new work once the queue is over its limit"""
+        integration = GeminiIntegration({'max_queue_depth': 1, 'max_in_flight': 1, 'cache_enabled': False})
+        
+        async with integration.scheduler.running():
+            queued = asyncio.ensure_future(integration.scheduler._acquire_slot())
+            await asyncio.sleep(0)
+            with patch.object(integration, '_execute_gemini_cli', new_callable=AsyncMock) as mock_cli:
+                result = await integration.consult_gemini("test query")
+            queued.cancel()
+        
+        assert result['status'] == 'overloaded'
+        assert result['queue_depth'] == 1
+        assert "overloaded" in result['message']
+        mock_cli.assert_not_called()
+        assert integration.load_shed['overloaded'] == 1
+    
+    @pytest.mark.asyncio
+    async def test_consult_gemini_uses_response_cache(self):
+        """Test that identical consultations are served from the cache"""
+        integration = GeminiIntegration()
+        
+        mock_cli_result = {
+            'output': 'cached answer',
+            'execution_time': 2.0
+        }
+        
+        with patch.object(integration, '_execute_gemini_cli', return_value=mock_cli_result) as mock_cli:
+            with patch.object(integration, '_enforce_rate_limit') as mock_rate_limit:
+                first = await integration.consult_gemini("test query", "test context")
+                second = await integration.consult_gemini("test query", "test context")
+                bypassed = await integration.consult_gemini("test query", "test context", use_cache=False)
+        
+        assert mock_cli.call_count == 2
+        assert mock_rate_limit.call_count == 2
+        assert first['cached'] == False
+        assert second['cached'] == True
+        assert second['response'] == 'cached answer'
+        assert bypassed['cached'] == False
+        
+        cache_stats = integration.get_status_info()['cache']
+        assert cache_stats['hits'] == 1
+        assert cache_stats['misses'] == 1
+    
+    @pytest.mark.asyncio
+    async def test_consult_gemini_does_not_cache_errors(self):
+        """Test that failed consultations are not cached"""
+        integration = GeminiIntegration()
+        
+        with patch.object(integration, '_execute_gemini_cli', side_effect=Exception("CLI error")) as mock_cli:
+            with patch.object(integration, '_enforce_rate_limit'):
+                await integration.consult_gemini("test query")
+                await integration.consult_gemini("test query")
+        
+        assert mock_cli.call_count == 2
+    
+    @pytest.mark.asyncio
+    async def test_consult_gemini_coalesces_identical_calls(self):
+        """Test that concurrent identical consultations share one CLI call"""
+        integration = GeminiIntegration({'cache_enabled': False})
+        release = asyncio.Event()
+        
+        async def slow_cli(query, **kwargs):
+            await release.wait()
+            return {'output': 'shared answer', 'execution_time': 1.0}
+        
+        with patch.object(integration, '_execute_gemini_cli', side_effect=slow_cli) as mock_cli:
+            with patch.object(integration, '_enforce_rate_limit'):
+                calls = [asyncio.ensure_future(integration.consult_gemini("same query")) for _ in range(3)]
+                await asyncio.sleep(0)
+                assert integration.get_status_info()['inflight_consultations'] == 1
+                release.set()
+                results = await asyncio.gather(*calls)
+        
+        assert mock_cli.call_count == 1
+        assert [r['response'] for r in results] == ['shared answer'] * 3
+        assert sorted(r['coalesced'] for r in results) == [False, True, True]
+        assert integration.get_status_info()['coalesced_consultations'] == 2
+        assert integration.get_status_info()['inflight_consultations'] == 0
+    
+    @pytest.mark.asyncio
+    async def test_consult_gemini_coalesced_failure_reaches_all(self):
+        """Test that a failed shared consultation fails every caller"""
+        integration = GeminiIntegration()
+        release = asyncio.Event()
+        
+        async def failing_cli(query, **kwargs):
+            await release.wait()
+            raise Exception("authentication required")
+        
+        with patch.object(integration, '_execute_gemini_cli', side_effect=failing_cli) as mock_cli:
+            with patch.object(integration, '_enforce_rate_limit'):
+                calls = [asyncio.ensure_future(integration.consult_gemini("same query")) for _ in range(2)]
+                await asyncio.sleep(0)
+                release.set()
+                results = await asyncio.gather(*calls)
+        
+        assert mock_cli.call_count == 1
+        assert [r['error_type'] for r in results] == ['authentication', 'authentication']
+    
+    @pytest.mark.asyncio
+    async def test_consult_gemini_coalesced_callers_keep_their_own_budgets(self):
+        """Test that a caller joining a shared call is not held to the first caller's budget or priority"""
+        integration = GeminiIntegration({'cache_enabled': False})
+        timeouts = []
+        
+        async def slow_cli(query, timeout=None, **kwargs):
+            timeout = integration.timeout if timeout is None else min(integration.timeout, timeout)
+            timeouts.append(timeout)
+            if timeout < 0.5:
+                await asyncio.sleep(timeout)
+                raise Exception(f"Gemini CLI timed out after {timeout:g} seconds")
+            await asyncio.sleep(0.5)
+            return {'output': 'shared answer', 'execution_time': 0.5}
+        
+        with patch.object(integration, '_execute_gemini_cli', side_effect=slow_cli):
+            with patch.object(integration, '_enforce_rate_limit'):
+                hurried = asyncio.ensure_future(integration.consult_gemini("same query", budget=0.3, priority=2))
+                await asyncio.sleep(0.05)
+                patient = asyncio.ensure_future(integration.consult_gemini("same query", priority=0))
+                await asyncio.sleep(0.05)
+                shared_plan = next(iter(integration._inflight.values()))['plan']
+                results = await asyncio.gather(hurried, patient)
+        
+        assert shared_plan['deadline'] is None
+        assert shared_plan['priority'] == 0
+        assert results[0]['error_type'] == 'deadline'
+        assert results[1]['status'] == 'success'
+        assert results[1]['response'] == 'shared answer'
+        assert results[1]['coalesced'] == True
+        assert timeouts[0] <= 0.3
+        assert timeouts[1] > 0.5
+    
+    @pytest.mark.asyncio
+    async def test_consult_gemini_coalesced_cancelled_when_all_waiters_leave(self):
+        """Test that the shared call is cancelled only after its last waiter"""
+        integration = GeminiIntegration()
+        started = asyncio.Event()
+        cancelled = asyncio.Event()
+        
+        async def hanging_cli(query, **kwargs):
+            started.set()
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+        
+        with patch.object(integration, '_execute_gemini_cli', side_effect=hanging_cli):
+            with patch.object(integration, '_enforce_rate_limit'):
+                first = asyncio.ensure_future(integration.consult_gemini("same query"))
+                second = asyncio.ensure_future(integration.consult_gemini("same query"))
+                await started.wait()
+                
+                first.cancel()
+                await asyncio.sleep(0.01)
+                assert not cancelled.is_set()
+                
+                second.cancel()
+                await asyncio.wait_for(cancelled.wait(), timeout=1)
+    
+    @pytest.mark.asyncio
+    async def test_consult_gemini_map_reduces_oversized_context(self):
+        """Test that an oversized context is analysed in concurrent sections and merged"""
+        integration = GeminiIntegration({'max_context_length': 100, 'chunked_context': True,
+                                         'map_parallelism': 2, 'cache_enabled': False})
+        context = "\n\n".join(f"paragraph {i} " + "x" * 60 for i in range(5))
+        running = 0
+        peak = 0
+        
+        async def fake_cli(query, **kwargs):
+            nonlocal running, peak
+            if query.startswith("You are analysing part"):
+                running += 1
+                peak = max(peak, running)
+                await asyncio.sleep(0.02)
+                running -= 1
+                return {'output': f"notes on {query.split()[4]}", 'execution_time': 0.02}
+            return {'output': 'merged answer', 'execution_time': 0.01}
+        
+        with patch.object(integration, '_execute_gemini_cli', side_effect=fake_cli) as mock_cli:
+            with patch.object(integration, '_enforce_rate_limit') as mock_rate_limit:
+                result = await integration.consult_gemini("question", context=context)
+        
+        assert result['status'] == 'success'
+        assert result['response'] == 'merged answer'
+        assert result['chunks'] == 5
+        assert mock_cli.call_count == 6
+        # One rate-limit token per section call plus one for the reduce call
+        assert mock_rate_limit.call_count == 6
+        assert peak == 2
+        reduce_prompt = mock_cli.call_args_list[-1][0][0]
+        assert "[Notes on part 5/5]" in reduce_prompt
+        assert "Context truncated" not in reduce_prompt
+    
+    @pytest.mark.asyncio
+    async def test_consult_gemini_map_reduce_splits_by_token_budget(self):
+        """Test that a token budget splits sections by estimated tokens, not characters"""
+        integration = GeminiIntegration({'max_context_tokens': 1000, 'chunked_context': True,
+                                         'cache_enabled': False})
+        context = "\n\n".join(f"문단 {i} " + "한국어 설명 " * 60 for i in range(8))
+        
+        async def fake_cli(query, **kwargs):
+            if query.startswith("You are analysing part"):
+                return {'output': 'notes', 'execution_time': 0.01}
+            return {'output': 'merged answer', 'execution_time': 0.01}
+        
+        with patch.object(integration, '_execute_gemini_cli', side_effect=fake_cli) as mock_cli:
+            with patch.object(integration, '_enforce_rate_limit'):
+                result = await integration.consult_gemini("question", context=context)
+        
+        assert len(context) < integration.max_context_length
+        assert result['chunks'] > 1
+        assert mock_cli.call_count == result['chunks'] + 1
+        sections = [call.args[0] for call in mock_cli.call_args_list[:-1]]
+        assert all(estimate_tokens(section) <= 1000 + 100 for section in sections)
+    
+    @pytest.mark.asyncio
+    async def test_consult_gemini_single_section_skips_map_reduce(self):
+        """Test that a context which compacts into one section is sent as one prompt"""
+        integration = GeminiIntegration({'max_context_tokens': 1000, 'chunked_context': True,
+                                         'cache_enabled': False})
+        context = "WARN connection pool exhausted, retrying\n" * 2000
+        
+        with patch.object(integration, '_execute_gemini_cli',
+                          return_value={'output': 'answer', 'execution_time': 0.1}) as mock_cli:
+            with patch.object(integration, '_enforce_rate_limit') as mock_rate_limit:
+                result = await integration.consult_gemini("question", context=context)
+        
+        assert result['status'] == 'success'
+        assert result['chunks'] == 1
+        assert mock_cli.call_count == 1
+        assert mock_rate_limit.call_count == 1
+        assert not mock_cli.call_args[0][0].startswith("You are analysing part")
+    
+    @pytest.mark.asyncio
+    async def test_consult_gemini_truncates_when_not_chunked(self):
+        """Test that chunking is opt-in and the old truncation still applies"""
+        integration = GeminiIntegration({'max_context_length': 100, 'cache_enabled': False})
+        
+        with patch.object(integration, '_execute_gemini_cli',
+                          return_value={'output': 'answer', 'execution_time': 0.1}) as mock_cli:
+            with patch.object(integration, '_enforce_rate_limit'):
+                result = await integration.consult_gemini("question", context="y" * 500)
+        
+        assert result['chunks'] == 1
+        assert mock_cli.call_count == 1
+        assert "[Context truncated...]" in mock_cli.call_args[0][0]
+    
+    @pytest.mark.asyncio
+    async def test_consult_gemini_session_follow_up_sends_summary(self):
+        """Test that follow-ups in a session send the context summary and history, not the context"""
+        integration = GeminiIntegration({'cache_enabled': False, 'session_digest': True,
+                                         'session_digest_min_tokens': 10})
+        context = "def handler(request):\n    return process(request)\n" * 40
+        prompts = []
+        
+        async def fake_cli(query, **kwargs):
+            prompts.append(query)
+            if query.startswith("Summarize the following context"):
+                return {'output': 'handler() delegates to process()', 'execution_time': 0.1}
+            return {'output': f'answer {len(prompts)}', 'execution_time': 0.1}
+        
+        with patch.object(integration, '_execute_gemini_cli', side_effect=fake_cli):
+            with patch.object(integration, '_enforce_rate_limit'):
+                first = await integration.consult_gemini("Is this safe?", context=context, new_session=True)
+                session = integration.sessions.get(first['session_id'])
+                await session.digest_task
+                second = await integration.consult_gemini("And under load?", session_id=first['session_id'])
+        
+        assert first['session_turn'] == 1
+        assert second['session_turn'] == 2
+        assert second['session_id'] == first['session_id']
+        follow_up = prompts[-1]
+        assert "handler() delegates to process()" in follow_up
+        assert "return process(request)" not in follow_up
+        assert "Q: Is this safe?" in follow_up
+        assert "And under load?" in follow_up
+        assert first['session_digest_used'] is False
+        assert second['session_digest_used'] is True
+    
+    @pytest.mark.asyncio
+    async def test_consult_gemini_session_follow_up_sends_context_by_default(self):
+        """Test that follow-ups resend the stored context unless summaries are enabled"""
+        integration = GeminiIntegration({'cache_enabled': False, 'session_digest_min_tokens': 10})
+        context = "def handler(request):\n    return process(request)\n" * 40
+        
+        with patch.object(integration, '_execute_gemini_cli',
+                          return_value={'output': 'answer', 'execution_time': 0.1}) as mock_cli:
+            with patch.object(integration, '_enforce_rate_limit'):
+                first = await integration.consult_gemini("Is this safe?", context=context, new_session=True)
+                second = await integration.consult_gemini("And under load?", session_id=first['session_id'])
+        
+        session = integration.sessions.get(first['session_id'])
+        assert session.digest_task is None
+        assert mock_cli.call_count == 2
+        follow_up = mock_cli.call_args[0][0]
+        assert "return process(request)" in follow_up
+        assert "Q: Is this safe?" in follow_up
+        assert second['session_digest_used'] is False
+    
+    @pytest.mark.asyncio
+    async def test_consult_gemini_expired_session_is_an_error(self):
+        """Test that a follow-up on an expired session fails instead of answering without its context"""
+        integration = GeminiIntegration({'cache_enabled': False, 'session_ttl': 0.1, 'session_digest': False})
+        
+        with patch.object(integration, '_execute_gemini_cli',
+                          return_value={'output': 'answer', 'execution_time': 0.1}) as mock_cli:
+            with patch.object(integration, '_enforce_rate_limit'):
+                first = await integration.consult_gemini("Is this safe?", context="stored context",
+                                                         new_session=True)
+                await asyncio.sleep(0.2)
+                expired = await integration.consult_gemini("And under load?", session_id=first['session_id'])
+                unknown = await integration.consult_gemini("Hello?", session_id="never-started")
+                named = await integration.consult_gemini("Start here", context="fresh context",
+                                                         session_id="named", new_session=True)
+        
+        assert expired['status'] == 'error'
+        assert expired['error_type'] == 'session_not_found'
+        assert unknown['error_type'] == 'session_not_found'
+        assert mock_cli.call_count == 2
+        assert named['status'] == 'success'
+        assert named['session_id'] == 'named'
+    
+    @pytest.mark.asyncio
+    async def test_consult_gemini_hedges_after_p95_and_cancels_loser(self):
+        """Test that a slow primary is hedged at its observed p95 and cancelled when the hedge wins"""
+        integration = GeminiIntegration({
+            'cache_enabled': False,
+            'hedging': {'consult_gemini': {'policy': 'hedge', 'models': ['gemini-2.5-pro', 'gemini-2.5-flash'],
+                                           'hedge_delay': 30, 'min_samples': 3}}
+        })
+        for _ in range(3):
+            integration.latency.record('gemini-2.5-pro', 0.05)
+        primary_cancelled = asyncio.Event()
+
+        async def cli(query, on_output=None, model=None, **kwargs):
+            if model == 'gemini-2.5-pro':
+                try:
+                    await asyncio.sleep(60)
+                except asyncio.CancelledError:
+                    primary_cancelled.set()
+                    raise
+            return {'output': f'answer from {model}', 'execution_time': 0.01}
+
+        with patch.object(integration, '_execute_gemini_cli', side_effect=cli):
+            with patch.object(integration, '_enforce_rate_limit'):
+                start = time.monotonic()
+                result = await integration.consult_gemini("test query", tool="consult_gemini")
+                elapsed = time.monotonic() - start
+
+        assert result['status'] == 'success'
+        assert result['response'] == 'answer from gemini-2.5-flash'
+        assert result['model'] == 'gemini-2.5-flash'
+        assert elapsed < 5
+        await asyncio.wait_for(primary_cancelled.wait(), timeout=1)
+        assert integration.hedge_stats == {'hedged': 1, 'fanouts': 0, 'secondary_wins': 1, 'cancelled': 1}
+        assert integration.get_status_info()['latency']['gemini-2.5-flash']['count'] == 1
+
+    @pytest.mark.asyncio
+    async def test_consult_gemini_fanout_returns_first_success(self):
+        """Test that a fan-out asks every model at once and skips a failed one"""
+        integration = GeminiIntegration({
+            'cache_enabled': False,
+            'hedging': {'default': {'policy': 'fanout', 'models': ['model-a', 'model-b', 'model-c']}}
+        })
+
+        async def cli(query, on_output=None, model=None, **kwargs):
+            if model == 'model-a':
+                raise Exception("rate limit exceeded")
+            await asyncio.sleep(0.01 if model == 'model-b' else 60)
+            return {'output': f'answer from {model}', 'execution_time': 0.01}
+
+        with patch.object(integration, '_execute_gemini_cli', side_effect=cli) as mock_cli:
+            with patch.object(integration, '_enforce_rate_limit'):
+                result = await integration.consult_gemini("test query")
+
+        assert mock_cli.call_count == 3
+        assert result['response'] == 'answer from model-b'
+        assert integration.hedge_stats['fanouts'] == 1
+        assert integration.hedge_stats['cancelled'] == 1
+
+    def test_hedging_plan_per_tool(self):
+        """Test that tool settings override the default hedging policy"""
+        integration = GeminiIntegration({
+            'model': 'gemini-2.5-flash',
+            'hedging': {'default': {'policy': 'none'}, 'enhance_user_request': {'policy': 'hedge'}}
+        })
+
+        assert integration._hedging_plan('consult_gemini')['models'] == ['gemini-2.5-flash']
+        plan = integration._hedging_plan('enhance_user_request')
+        assert plan['policy'] == 'hedge'
+        assert plan['models'] == ['gemini-2.5-flash', 'gemini-2.5-flash']
+
+    @pytest.mark.asyncio
+    async def test_consultation_job_lifecycle(self):
+        """Test that a submitted job can be polled while running and after it completes"""
+        integration = GeminiIntegration({'cache_enabled': False})
+        release = asyncio.Event()
+        
+        async def cli(query, on_output=None, **kwargs):
+            await on_output("partial ")
+            await release.wait()
+            return {'output': 'partial answer', 'execution_time': 0.1}
+        
+        with patch.object(integration, '_execute_gemini_cli', side_effect=cli):
+            with patch.object(integration, '_enforce_rate_limit'):
+                submitted = integration.submit_consultation("long question", context="big context")
+                job_id = submitted['job_id']
+                
+                running = await integration.get_consultation_result(job_id, wait=0.05)
+                release.set()
+                done = await integration.get_consultation_result(job_id, wait=1)
+        
+        assert submitted['status'] == 'submitted'
+        assert running['state'] == 'running'
+        assert running['partial_response'] == "partial "
+        assert done['state'] == 'completed'
+        assert done['result']['response'] == 'partial answer'
+        assert (await integration.get_consultation_result("missing"))['state'] == 'not_found'
+        assert integration.get_status_info()['jobs']['submitted'] == 1
+    
+    @pytest.mark.asyncio
+    async def test_cancel_consultation_job(self):
+        """Test that cancelling a job cancels the consultation running for it"""
+        integration = GeminiIntegration()
+        started = asyncio.Event()
+        cancelled = asyncio.Event()
+        
+        async def hanging_cli(query, **kwargs):
+            started.set()
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+        
+        with patch.object(integration, '_execute_gemini_cli', side_effect=hanging_cli):
+            with patch.object(integration, '_enforce_rate_limit'):
+                job_id = integration.submit_consultation("question")['job_id']
+                await started.wait()
+                
+                assert integration.cancel_consultation(job_id)['state'] == 'cancelled'
+                await asyncio.wait_for(cancelled.wait(), timeout=1)
+        
+        assert (await integration.get_consultation_result(job_id))['state'] == 'cancelled'
+        assert integration.jobs.stats()['running'] == 0
+    
+    @pytest.mark.asyncio
+    async def test_consult_gemini_batch_bounds_parallelism_and_keeps_order(self):
+        """Test that batch items run at most `parallelism` at once and return in input order"""
+        integration = GeminiIntegration({'cache_enabled': False})
+        in_flight = 0
+        peak = 0
+        
+        async def cli(query, **kwargs):
+            nonlocal in_flight, peak
+            in_flight += 1
+            peak = max(peak, in_flight)
+            await asyncio.sleep(0.02 if 'first' in query else 0.01)
+            in_flight -= 1
+            return {'output': f"answer to {query.split()[-1]}", 'execution_time': 0.01}
+        
+        items = [{'query': "question first"}] + [{'query': f"question q{i}"} for i in range(5)]
+        items.append({'context': 'no query'})
+        
+        with patch.object(integration, '_execute_gemini_cli', side_effect=cli):
+            with patch.object(integration, '_enforce_rate_limit'):
+                batch = await integration.consult_gemini_batch(items, parallelism=2, comparison_mode=False)
+        
+        assert peak == 2
+        assert batch['status'] == 'partial'
+        assert batch['succeeded'] == 6
+        assert batch['failed'] == 1
+        assert [result['index'] for result in batch['results']] == list(range(7))
+        assert batch['results'][0]['response'] == 'answer to first'
+        assert batch['results'][5]['response'] == 'answer to q4'
+        assert batch['results'][6]['error_type'] == 'invalid_request'
+    
+    @pytest.mark.asyncio
+    async def test_consult_gemini_batch_caps_client_parallelism(self):
+        """Test that a client cannot raise batch parallelism past the batch_parallelism setting"""
+        integration = GeminiIntegration({'cache_enabled': False, 'batch_parallelism': 2})
+        in_flight = 0
+        peak = 0
+        
+        async def cli(query, **kwargs):
+            nonlocal in_flight, peak
+            in_flight += 1
+            peak = max(peak, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            return {'output': 'answer', 'execution_time': 0.01}
+        
+        items = [{'query': f"question q{i}"} for i in range(6)]
+        
+        with patch.object(integration, '_execute_gemini_cli', side_effect=cli):
+            with patch.object(integration, '_enforce_rate_limit'):
+                batch = await integration.consult_gemini_batch(items, parallelism=1000, comparison_mode=False)
+        
+        assert peak == 2
+        assert batch['succeeded'] == 6
+    
+    @pytest.mark.asyncio
+    async def test_consult_gemini_batch_rejects_oversized_batch(self):
+        """Test that batches over max_batch_items are refused without consulting"""
+        integration = GeminiIntegration({'max_batch_items': 2})
+        
+        with patch.object(integration, 'consult_gemini') as mock_consult:
+            batch = await integration.consult_gemini_batch([{'query': 'q'}] * 3)
+        
+        assert batch['status'] == 'error'
+        assert batch['error_type'] == 'invalid_request'
+        mock_consult.assert_not_called()
+    
+    def test_session_store_evicts_idle_and_over_budget(self):
+        """Test that sessions expire after the TTL and are evicted over the size budget"""
+        store = SessionStore(ttl=60, max_chars=100)
+        store.open("a", "x" * 60, new=True)
+        store.open("b", "y" * 60, new=True)
+        assert store.get("a") is None
+        assert store.evictions == 1
+        
+        with patch('time.monotonic', return_value=time.monotonic() + 120):
+            assert store.get("b") is None
+        assert store.expirations == 1
+    
+    def test_split_context_keeps_structure(self):
+        """Test that sections break at code fences and paragraphs, never above the limit"""
+        code = "```python\n" + "print('hi')\n" * 5 + "```\n"
+        context = "intro paragraph\n\n" + code + "\n" + "z" * 250
+        
+        chunks = GeminiIntegration._split_context(context, 100)
+        
+        assert "".join(chunks) == context
+        assert all(len(chunk) <= 100 for chunk in chunks)
+        assert any(code in chunk for chunk in chunks)
+    
+    def test_split_context_by_tokens(self):
+        """Test that a token measure keeps each section within the token limit"""
+        context = "\n\n".join("한국어 문단입니다 " * 40 for _ in range(6))
+        
+        chunks = GeminiIntegration._split_context(context, 300, estimate_tokens)
+        
+        assert "".join(chunks) == context
+        assert len(chunks) > 1
+        assert all(estimate_tokens(chunk) <= 300 for chunk in chunks)
+    
     def test_prepare_query_with_context(self):
         """Test query preparation with context"""
         integration = GeminiIntegration()
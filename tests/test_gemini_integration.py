@@ -3,11 +3,39 @@
 Tests for GeminiIntegration class
 """
 import asyncio
+import json
 import pytest
+import random
+import re
+import tempfile
+import threading
 from unittest.mock import AsyncMock, MagicMock, patch
 import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
 
-from gemini_integration import GeminiIntegration, get_integration, UNCERTAINTY_PATTERNS
+from gemini_integration import (
+    CapturedOutput,
+    CircuitBreaker,
+    CircuitOpenError,
+    CLIBackend,
+    ConsultationScheduler,
+    ContextCompactor,
+    DeadlineExceededError,
+    DiskResponseCache,
+    GeminiBackend,
+    GeminiIntegration,
+    HTTPBackend,
+    LatencyTracker,
+    ModelRouter,
+    PatternMatcher,
+    ResponseCache,
+    UncertaintyStream,
+    get_integration,
+    PATTERN_CATEGORIES,
+    UNCERTAINTY_PATTERNS,
+    estimate_tokens,
+)
 
 
 class TestGeminiIntegration:
@@ -81,6 +109,172 @@ class TestGeminiIntegration:
             has_uncertainty, patterns = integration.detect_uncertainty(text)
             assert has_uncertainty == True, f"Case insensitive detection failed for: '{text}'"
     
+    def test_detect_uncertainty_matches_per_pattern_search(self):
+        """Test that the single-pass matcher reports the same patterns as re.search"""
+        integration = GeminiIntegration()
+        
+        texts = [
+            "여러 방법 중에 어떤 게 좋을까요? 방법이 궁금해요",
+            "I'M NOT SURE whether the production database migration is broken",
+            "Security vs performance\n  critical trade-offs, considering alternatives",
+            "ſecurity and KEY credentials",  # Characters that only IGNORECASE folds
+            "İ think the issue is here",  # Lower-casing changes the length
+            "this is fine",
+            ""
+        ]
+        
+        for text in texts:
+            expected = [
+                f"{category}: {pattern}"
+                for category, patterns in PATTERN_CATEGORIES
+                for pattern in patterns
+                if re.search(pattern, text, re.IGNORECASE)
+            ]
+            has_uncertainty, patterns = integration.detect_uncertainty(text)
+            assert patterns == expected, f"Mismatch for text: '{text}'"
+            assert has_uncertainty == bool(expected)
+    
+    def test_pattern_matcher_reports_overlapping_matches(self):
+        """Test that matches starting inside another match are reported"""
+        matcher = PatternMatcher([('test', [r"여러 방법", r"방법", r"\bnot\b", r"\bnot working\b"])])
+        
+        hits = list(matcher.iter_matches("여러 방법 not working"))
+        
+        assert hits == [(0, 0, 5), (1, 3, 5), (2, 6, 9), (3, 6, 17)]
+        assert matcher.find("not workingman") == [2]
+    
+    def test_uncertainty_stream_matches_across_chunks(self):
+        """Test that streamed detection finds matches spanning chunk boundaries"""
+        integration = GeminiIntegration()
+        text = "Everything compiled. " * 20 + "But the login is not working and 여러 방법을 시도했어요."
+        
+        stream = integration.uncertainty_stream(window=32)
+        hits = []
+        for i in range(0, len(text), 7):
+            hits.extend(stream.feed(text[i:i + 7]))
+            assert len(stream._buffer) <= 32 + 7
+        hits.extend(stream.close())
+        
+        assert stream.found_patterns == integration.detect_uncertainty(text)[1]
+        not_working = next(hit for hit in hits if hit['pattern'] == r"uncertainty: \bnot working\b")
+        assert text[not_working['start']:not_working['end']] == "not working"
+    
+    def test_uncertainty_stream_respects_trailing_word_boundary(self):
+        """Test that a match is not reported before its word boundary is known"""
+        stream = UncertaintyStream(window=16)
+        
+        assert stream.feed("it is " + "x" * 20 + " not working") == []
+        assert stream.feed("man") == []
+        stream.close()
+        
+        assert r"uncertainty: \bnot working\b" not in stream.found_patterns
+        with pytest.raises(ValueError):
+            stream.feed("more")
+    
+    def test_uncertainty_stream_small_window_matches_re_search(self):
+        """Test that a window shorter than the longest pattern is raised instead of missing matches"""
+        integration = GeminiIntegration()
+        words = ["weigh the options", "not working", "performance critical", "I think", "on", "the", "\n"]
+        
+        for seed in range(20):
+            rng = random.Random(seed)
+            text = " ".join(rng.choice(words) for _ in range(40))
+            for window in (1, 8, 16):
+                stream = UncertaintyStream(window=window)
+                size = rng.randint(1, 9)
+                for i in range(0, len(text), size):
+                    stream.feed(text[i:i + size])
+                stream.close()
+                
+                assert stream.window > PatternMatcher().max_match_length
+                assert stream.found_patterns == integration.detect_uncertainty(text)[1]
+    
+    def test_detect_uncertainty_chunks(self):
+        """Test chunked detection against whole-text detection"""
+        integration = GeminiIntegration()
+        text = "I think the production deploy failed. 왜 안 돼?"
+        chunks = [text[i:i + 3] for i in range(0, len(text), 3)]
+        
+        assert integration.detect_uncertainty_chunks(chunks) == integration.detect_uncertainty(text)
+    
+    def test_detect_uncertainty_batch(self):
+        """Test batch detection against per-text detection"""
+        integration = GeminiIntegration()
+        texts = [
+            "I think the production build failed",
+            "This is a simple task",
+            "",
+            "여러 방법 중에 선택",
+            "not working",
+        ]
+        
+        results = integration.detect_uncertainty_batch(texts)
+        
+        assert len(results) == len(texts)
+        for text, result in zip(texts, results):
+            has_uncertainty, patterns = integration.detect_uncertainty(text)
+            assert result['has_uncertainty'] == has_uncertainty
+            assert integration.patterns_for_mask(result['mask']) == patterns
+            for category, count in result['counts'].items():
+                assert count == len([p for p in patterns if p.startswith(f"{category}:")])
+        
+        assert results[0]['counts']['critical_operation'] == 1
+        assert results[1]['mask'] == 0
+    
+    def test_pattern_matcher_masks_do_not_span_texts(self):
+        """Test that batch groups never match across text boundaries"""
+        matcher = PatternMatcher([('test', [r"\bnot working\b", r"ab"])])
+        
+        assert matcher.find_masks(["not", "working", "a", "b", "not working"], group_size=4) == [0, 0, 0, 0, 1]
+    
+    def test_score_uncertainty_weights_common_patterns_low(self):
+        """Test that very common patterns alone do not trigger consultation"""
+        integration = GeminiIntegration()
+        
+        for text in ["대체로 괜찮아요", "why not", "vs code 설정"]:
+            result = integration.score_uncertainty(text)
+            assert result['matched_patterns'], f"Expected a match for: '{text}'"
+            assert result['should_consult'] == False, f"Should not consult for: '{text}'"
+        
+        result = integration.score_uncertainty("I'm not sure the production deploy is right")
+        assert result['should_consult'] == True
+        assert result['early_exit'] == True
+        assert result['matched_patterns'] == ["uncertainty: \\bI'm not sure\\b"]
+    
+    def test_score_uncertainty_uses_config_thresholds(self):
+        """Test that uncertainty_thresholds drives weights and category switches"""
+        config = {
+            'uncertainty_thresholds': {
+                'uncertainty_patterns': False,
+                'consult_score': 1.0,
+                'category_weights': {'critical_operation': 0.5},
+                'pattern_weights': {r"\bsecurity\b": 4.0}
+            }
+        }
+        integration = GeminiIntegration(config)
+        
+        assert integration.score_uncertainty("I'm not sure, maybe an error")['score'] == 0.0
+        assert integration.score_uncertainty("production")['should_consult'] == False
+        assert integration.score_uncertainty("security")['score'] == 2.0
+        
+        batch = integration.detect_uncertainty_batch(["security", "maybe"])
+        assert [r['should_consult'] for r in batch] == [True, False]
+        assert batch[1]['has_uncertainty'] == True
+    
+    def test_should_auto_consult(self):
+        """Test auto-consult decision and statistics"""
+        integration = GeminiIntegration()
+        
+        assert integration.should_auto_consult("I'm not sure about this")[0] == True
+        assert integration.should_auto_consult("왜?")[0] == False
+        
+        status = integration.get_status_info()
+        assert status['auto_consult_checks'] == 2
+        assert status['auto_consult_triggered'] == 1
+        
+        integration.auto_consult = False
+        assert integration.should_auto_consult("I'm not sure about this")[0] == False
+    
     @pytest.mark.asyncio
     async def test_rate_limiting(self):
         """Test rate limiting functionality"""
@@ -217,6 +411,709 @@ class TestGeminiIntegration:
         assert status['last_consultation'] is not None
 
 
+class TestConsultationScheduler:
+    """Test cases for the token bucket and in-flight scheduler"""
+    
+    @pytest.mark.asyncio
+    async def test_burst_admits_immediately(self):
+        """Test that up to `burst` consultations start without waiting"""
+        scheduler = ConsultationScheduler(rate_limit_delay=0.1, burst=3)
+        
+        start_time = time.time()
+        for _ in range(3):
+            await scheduler.acquire_token()
+        burst_time = time.time() - start_time
+        
+        await scheduler.acquire_token()
+        total_time = time.time() - start_time
+        
+        assert burst_time < 0.05
+        assert total_time >= 0.09
+    
+    @pytest.mark.asyncio
+    async def test_tokens_granted_in_fifo_order(self):
+        """Test that waiting callers are admitted in arrival order"""
+        scheduler = ConsultationScheduler(rate_limit_delay=0.02, burst=1)
+        order = []
+        
+        async def caller(i):
+            await scheduler.acquire_token()
+            order.append(i)
+        
+        tasks = []
+        for i in range(5):
+            tasks.append(asyncio.ensure_future(caller(i)))
+            await asyncio.sleep(0)
+        assert scheduler.queue_depth >= 4
+        await asyncio.gather(*tasks)
+        
+        assert order == [0, 1, 2, 3, 4]
+        assert scheduler.stats()['max_wait'] > 0
+    
+    @pytest.mark.asyncio
+    async def test_tokens_granted_by_priority(self):
+        """Test that a more urgent caller overtakes earlier, less urgent ones"""
+        scheduler = ConsultationScheduler(rate_limit_delay=0.02, burst=1)
+        order = []
+        
+        async def caller(name, priority):
+            await scheduler.acquire_token(priority)
+            order.append(name)
+        
+        tasks = []
+        for name, priority in [('first', 2), ('batch-1', 2), ('batch-2', 2), ('interactive', 0)]:
+            tasks.append(asyncio.ensure_future(caller(name, priority)))
+            await asyncio.sleep(0)
+        assert scheduler.stats()['queued_priorities'] == [0, 2, 2]
+        await asyncio.gather(*tasks)
+        
+        assert order == ['first', 'interactive', 'batch-1', 'batch-2']
+    
+    @pytest.mark.asyncio
+    async def test_aging_prevents_starvation(self):
+        """Test that a long-waiting low-priority caller eventually beats fresh urgent ones"""
+        scheduler = ConsultationScheduler(rate_limit_delay=0, max_in_flight=1, aging=0.01)
+        order = []
+        
+        async def consultation(name, priority):
+            async with scheduler.running(priority):
+                order.append(name)
+        
+        async with scheduler.running():
+            old = asyncio.ensure_future(consultation('old-batch', 5))
+            await asyncio.sleep(0.1)
+            fresh = asyncio.ensure_future(consultation('fresh-interactive', 0))
+            await asyncio.sleep(0)
+        await asyncio.gather(old, fresh)
+        
+        assert order == ['old-batch', 'fresh-interactive']
+    
+    @pytest.mark.asyncio
+    async def test_slots_granted_by_priority(self):
+        """Test that a freed slot goes to the most urgent waiter"""
+        scheduler = ConsultationScheduler(rate_limit_delay=0, max_in_flight=1)
+        order = []
+        
+        async def consultation(name, priority):
+            async with scheduler.running(priority):
+                order.append(name)
+        
+        async with scheduler.running():
+            waiters = [asyncio.ensure_future(consultation(name, priority))
+                       for name, priority in [('plan', 2), ('guide', 1), ('question', 0)]]
+            await asyncio.sleep(0)
+        await asyncio.gather(*waiters)
+        
+        assert order == ['question', 'guide', 'plan']
+    
+    @pytest.mark.asyncio
+    async def test_consult_gemini_uses_tool_priority(self):
+        """Test that tool defaults and the per-call override reach the scheduler"""
+        integration = GeminiIntegration({'cache_enabled': False})
+        
+        with patch.object(integration, '_execute_gemini_cli', new_callable=AsyncMock) as mock_cli:
+            mock_cli.return_value = {'output': 'answer', 'execution_time': 0.1}
+            with patch.object(integration, '_enforce_rate_limit') as mock_rate_limit:
+                await integration.consult_gemini("plan", tool="enhance_user_request")
+                await integration.consult_gemini("urgent plan", tool="enhance_user_request", priority=0)
+        
+        assert [call.args[0] for call in mock_rate_limit.call_args_list] == [2, 0]
+    
+    @pytest.mark.asyncio
+    async def test_expired_waiters_are_dropped(self):
+        """Test that callers whose deadline passes in a queue never start"""
+        scheduler = ConsultationScheduler(rate_limit_delay=10, burst=1, max_in_flight=1)
+        await scheduler.acquire_token()
+        
+        start_time = time.monotonic()
+        with pytest.raises(DeadlineExceededError):
+            await scheduler.acquire_token(deadline=time.monotonic() + 0.05)
+        assert time.monotonic() - start_time < 1
+        
+        async with scheduler.running():
+            with pytest.raises(DeadlineExceededError):
+                await scheduler._acquire_slot(deadline=time.monotonic() + 0.05)
+        
+        assert scheduler.queue_depth == 0
+        assert scheduler.in_flight == 0
+        assert scheduler.stats()['expired'] == 2
+    
+    @pytest.mark.asyncio
+    async def test_max_in_flight(self):
+        """Test that no more than max_in_flight consultations run at once"""
+        scheduler = ConsultationScheduler(rate_limit_delay=0, max_in_flight=2)
+        running = 0
+        peak = 0
+        
+        async def consultation():
+            nonlocal running, peak
+            async with scheduler.running():
+                running += 1
+                peak = max(peak, running)
+                await asyncio.sleep(0.01)
+                running -= 1
+        
+        await asyncio.gather(*(consultation() for _ in range(6)))
+        
+        assert peak == 2
+        assert scheduler.in_flight == 0
+        assert scheduler.queue_depth == 0
+    
+    @pytest.mark.asyncio
+    async def test_cancelled_waiter_does_not_leak_slot(self):
+        """Test that cancelling a queued caller keeps the slot count right"""
+        scheduler = ConsultationScheduler(rate_limit_delay=0, max_in_flight=1)
+        
+        async with scheduler.running():
+            waiter = asyncio.ensure_future(scheduler._acquire_slot())
+            await asyncio.sleep(0)
+            waiter.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await waiter
+        
+        assert scheduler.in_flight == 0
+        async with scheduler.running():
+            assert scheduler.in_flight == 1
+
+
+class TestResponseCache:
+    """Test cases for the in-memory response cache"""
+    
+    def test_cache_hit_and_miss_counters(self):
+        """Test that lookups are counted"""
+        cache = ResponseCache()
+        key = ResponseCache.make_key("prompt", "gemini-2.5-flash")
+        
+        assert cache.get(key) is None
+        cache.put(key, {'response': 'answer'}, 10)
+        assert cache.get(key) == {'response': 'answer'}
+        
+        stats = cache.stats()
+        assert stats['hits'] == 1
+        assert stats['misses'] == 1
+        assert stats['entries'] == 1
+        assert stats['bytes'] == 10
+    
+    def test_cache_key_depends_on_model(self):
+        """Test that the same prompt for different models has different keys"""
+        assert ResponseCache.make_key("prompt", "gemini-2.5-flash") != ResponseCache.make_key("prompt", "gemini-2.5-pro")
+    
+    def test_cache_lru_eviction(self):
+        """Test least recently used entries are evicted first"""
+        cache = ResponseCache(max_entries=2)
+        cache.put('a', {'response': 'a'}, 1)
+        cache.put('b', {'response': 'b'}, 1)
+        cache.get('a')
+        cache.put('c', {'response': 'c'}, 1)
+        
+        assert cache.get('b') is None
+        assert cache.get('a') is not None
+        assert cache.get('c') is not None
+        assert cache.evictions == 1
+    
+    def test_cache_memory_budget(self):
+        """Test that the byte budget is enforced"""
+        cache = ResponseCache(max_bytes=100)
+        cache.put('a', {'response': 'a'}, 60)
+        cache.put('b', {'response': 'b'}, 60)
+        cache.put('huge', {'response': 'huge'}, 101)
+        
+        assert cache.get('a') is None
+        assert cache.get('b') is not None
+        assert cache.get('huge') is None
+        assert cache.total_bytes == 60
+    
+    def test_cache_ttl_expiry(self):
+        """Test that expired entries are dropped"""
+        cache = ResponseCache(ttl=10)
+        cache.put('a', {'response': 'a'}, 1)
+        
+        with patch('gemini_integration.time.time', return_value=time.time() + 11):
+            assert cache.get('a') is None
+        
+        assert cache.expirations == 1
+        assert len(cache) == 0
+
+
+class TestDiskResponseCache:
+    """Test cases for the persistent SQLite response cache"""
+    
+    def test_disk_cache_is_lazy_and_persistent(self):
+        """Test that the database is only created on use and survives reopening"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = Path(temp_dir) / ".gemini-cache" / "consultations.sqlite3"
+            cache = DiskResponseCache(str(path))
+            
+            assert not path.exists()
+            assert cache.stats()['loaded'] == False
+            
+            cache.put('key', {'response': '답변'}, 'gemini-2.5-pro')
+            cache.close()
+            
+            reopened = DiskResponseCache(str(path))
+            assert reopened.get('key') == {'response': '답변'}
+            assert reopened.get('missing') is None
+            assert reopened.hits == 1
+            assert reopened.misses == 1
+            reopened.close()
+    
+    def test_disk_cache_size_eviction(self):
+        """Test that least recently accessed entries are evicted over budget"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache = DiskResponseCache(str(Path(temp_dir) / "cache.sqlite3"), max_bytes=25)
+            
+            cache.put('a', {'response': 'a' * 10})
+            cache.put('b', {'response': 'b' * 10})
+            cache.get('a')
+            cache.put('c', {'response': 'c' * 10})
+            
+            assert cache.get('b') is None
+            assert cache.get('a') is not None
+            assert cache.get('c') is not None
+            assert cache.evictions == 1
+            cache.close()
+    
+    def test_disk_cache_shared_between_instances(self):
+        """Test that two open caches on one file see each other's writes"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = str(Path(temp_dir) / "cache.sqlite3")
+            first = DiskResponseCache(path)
+            second = DiskResponseCache(path)
+            
+            first.put('key', {'response': 'from first'})
+            second.put('other', {'response': 'from second'})
+            
+            assert second.get('key') == {'response': 'from first'}
+            assert first.get('other') == {'response': 'from second'}
+            first.close()
+            second.close()
+    
+    @pytest.mark.asyncio
+    async def test_consultation_served_from_disk_after_restart(self):
+        """Test that a new integration instance reuses persisted answers"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            config = {'disk_cache_path': str(Path(temp_dir) / "cache.sqlite3")}
+            mock_cli_result = {'output': 'persisted answer', 'execution_time': 1.0}
+            
+            first = GeminiIntegration(config)
+            with patch.object(first, '_execute_gemini_cli', return_value=mock_cli_result):
+                with patch.object(first, '_enforce_rate_limit'):
+                    await first.consult_gemini("test query")
+            first.disk_cache.close()
+            
+            second = GeminiIntegration(config)
+            with patch.object(second, '_execute_gemini_cli') as mock_cli:
+                result = await second.consult_gemini("test query")
+            second.disk_cache.close()
+            
+            mock_cli.assert_not_called()
+            assert result['cached'] == True
+            assert result['response'] == 'persisted answer'
+    
+    @pytest.mark.asyncio
+    async def test_disk_cache_records_answering_model(self):
+        """Test that the disk cache stores the model that answered, not the configured default"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            config = {
+                'disk_cache_path': str(Path(temp_dir) / "cache.sqlite3"),
+                'model': 'gemini-2.5-pro',
+                'hedging': {'default': {'models': ['gemini-2.5-flash']}}
+            }
+            integration = GeminiIntegration(config)
+            
+            with patch.object(integration, '_execute_gemini_cli',
+                              return_value={'output': 'flash answer', 'execution_time': 1.0}):
+                with patch.object(integration, '_enforce_rate_limit'):
+                    with patch.object(integration.disk_cache, 'put', wraps=integration.disk_cache.put) as mock_put:
+                        await integration.consult_gemini("test query")
+            integration.disk_cache.close()
+            
+            assert mock_put.call_args.args[2] == 'gemini-2.5-flash'
+
+
+class TestContextCompactor:
+    """Test cases for token-aware context compaction"""
+    
+    def test_estimate_tokens_weighs_korean_higher(self):
+        """Test that non-ASCII text is estimated at more tokens per character"""
+        assert estimate_tokens("") == 0
+        assert estimate_tokens("가" * 100) > estimate_tokens("a" * 100) * 2
+    
+    def test_whitespace_and_repeated_lines(self):
+        """Test that trailing spaces, blank runs and repeated lines are compacted"""
+        compactor = ContextCompactor()
+        log = "start   \n\n\n\n" + "ERROR connection refused\n" * 50 + "end"
+        
+        text, stats = compactor.compact(log)
+        
+        assert text == "start\n\nERROR connection refused\n[previous line repeated 49 more times]\nend"
+        assert stats['repeated_lines_removed'] == 49
+        assert stats['bytes_after'] < stats['bytes_before']
+        assert compactor.stats()['saved_tokens'] == stats['tokens_before'] - stats['tokens_after']
+    
+    def test_repeated_stack_frames(self):
+        """Test that a repeating multi-line block is kept once"""
+        frames = '  File "app.py", line 3, in recurse\n    return recurse(n)\n' * 20
+        
+        text, stats = ContextCompactor().compact("Traceback:\n" + frames + "RecursionError")
+        
+        assert text.count("recurse(n)") == 1
+        assert "[previous 2 lines repeated 19 more times]" in text
+    
+    def test_short_repeats_are_kept(self):
+        """Test that a line appearing twice in a row (e.g. closing braces) is untouched"""
+        code = "if (a) {\n  if (b) {\n  }\n}\n}"
+        
+        text, stats = ContextCompactor().compact(code)
+        
+        assert text == code
+        assert stats['repeated_lines_removed'] == 0
+    
+    def test_head_and_tail_fit_token_budget(self):
+        """Test that over-budget context keeps its start and end"""
+        compactor = ContextCompactor(max_tokens=200)
+        context = "\n".join(f"line {i} " + "word " * 10 for i in range(200))
+        
+        text, stats = compactor.compact(context)
+        
+        assert text.startswith("line 0 ")
+        assert text.endswith("line 199 " + "word " * 9 + "word")
+        assert "tokens omitted" in text
+        assert stats['tokens_after'] <= 220
+        assert stats['omitted_tokens'] > 0
+    
+    def test_prepare_query_uses_token_budget(self):
+        """Test that a token budget replaces character truncation in _prepare_query"""
+        integration = GeminiIntegration({'max_context_length': 100, 'max_context_tokens': 1000})
+        
+        result = integration._prepare_query("question", "x" * 2000, comparison_mode=False)
+        context, compaction = integration._compact_context("x" * 2000)
+        
+        assert "[Context truncated...]" not in result
+        assert "x" * 2000 in result
+        assert context == "x" * 2000
+        assert compaction['tokens_after'] <= 1000
+    
+    @pytest.mark.asyncio
+    async def test_consult_gemini_reports_its_own_compaction(self):
+        """Test that each consultation returns the compaction stats of its own context"""
+        integration = GeminiIntegration({'max_context_tokens': 1000, 'cache_enabled': False})
+        repeated = "WARN connection pool exhausted, retrying\n" * 50
+        
+        with patch.object(integration, '_execute_gemini_cli',
+                          return_value={'output': 'answer', 'execution_time': 0.1}):
+            with patch.object(integration, '_enforce_rate_limit'):
+                compacted, plain = await asyncio.gather(
+                    integration.consult_gemini("first", context=repeated),
+                    integration.consult_gemini("second", context="short context")
+                )
+        
+        assert compacted['compaction']['repeated_lines_removed'] > 0
+        assert plain['compaction']['repeated_lines_removed'] == 0
+
+
+class TestCapturedOutput:
+    """Test cases for bounded-memory output capture"""
+    
+    def test_small_output_stays_in_memory(self):
+        """Test that output under the limit is never written to disk"""
+        captured = CapturedOutput(memory_limit=64)
+        captured.write("답변 ".encode())
+        captured.write(b"text")
+        
+        assert not captured.spilled
+        assert len(captured) == len("답변 ".encode()) + 4
+        assert captured.decode() == "답변 text"
+        captured.close()
+    
+    def test_large_output_spills_to_disk(self):
+        """Test that output over the limit spills and stays readable without copies"""
+        captured = CapturedOutput(memory_limit=1024)
+        for _ in range(100):
+            captured.write(b"x" * 100)
+        
+        assert captured.spilled
+        with captured.getbuffer() as view:
+            assert view.readonly
+            assert len(view) == 10000
+            assert view[:3] == b"xxx"
+        assert captured.decode() == "x" * 10000
+        captured.close()
+
+
+class TestCircuitBreaker:
+    """Test cases for the circuit breaker around Gemini calls"""
+    
+    def test_opens_after_threshold_in_window(self):
+        """Test that classified failures open the breaker and unknown ones do not"""
+        breaker = CircuitBreaker(failure_threshold=3, window=60, recovery_timeout=30)
+        
+        for _ in range(5):
+            breaker.record_failure('unknown')
+        assert breaker.state == CircuitBreaker.CLOSED
+        
+        for _ in range(3):
+            assert breaker.before_call() is False
+            breaker.record_failure('rate_limit')
+        
+        assert breaker.state == CircuitBreaker.OPEN
+        with pytest.raises(CircuitOpenError) as exc_info:
+            breaker.before_call()
+        assert exc_info.value.error_type == 'rate_limit'
+        assert breaker.stats()['rejected'] == 1
+    
+    def test_half_open_probe_closes_or_reopens(self):
+        """Test that one probe is admitted after the recovery timeout"""
+        breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=0.05)
+        breaker.record_failure('timeout')
+        assert breaker.rejecting
+        
+        time.sleep(0.06)
+        assert breaker.before_call() is True
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        with pytest.raises(CircuitOpenError):
+            breaker.before_call()
+        breaker.record_failure('timeout', probe=True)
+        assert breaker.state == CircuitBreaker.OPEN
+        
+        time.sleep(0.06)
+        probe = breaker.before_call()
+        breaker.release(probe)
+        probe = breaker.before_call()
+        breaker.record_success()
+        assert breaker.state == CircuitBreaker.CLOSED
+        assert breaker.stats()['opened'] == 2
+    
+    def test_disabled_with_zero_threshold(self):
+        """Test that a threshold of 0 never opens the breaker"""
+        breaker = CircuitBreaker(failure_threshold=0)
+        for _ in range(10):
+            breaker.record_failure('authentication')
+        assert breaker.before_call() is False
+    
+    @pytest.mark.asyncio
+    async def test_consult_gemini_fails_fast_while_open(self):
+        """Test that an open breaker rejects consultations without running the CLI"""
+        integration = GeminiIntegration({'circuit_failure_threshold': 2, 'cache_enabled': False})
+        
+        with patch.object(integration, '_execute_gemini_cli', side_effect=Exception("authentication required")) as mock_cli:
+            with patch.object(integration, '_enforce_rate_limit'):
+                for index in range(2):
+                    await integration.consult_gemini(f"query {index}")
+                result = await integration.consult_gemini("query 3")
+        
+        assert mock_cli.call_count == 2
+        assert result['status'] == 'error'
+        assert result['circuit_open'] is True
+        assert result['error_type'] == 'authentication'
+        assert integration.get_status_info()['circuit_breaker']['state'] == 'open'
+
+
+class TestModelRouter:
+    """Test cases for latency- and size-aware model routing"""
+    
+    RULES = [
+        {'tool': 'consult_gemini', 'max_tokens': 100, 'model': 'gemini-2.5-flash'},
+        {'tool': 'enhance_user_request', 'output_format': 'detailed_plan', 'model': 'gemini-2.5-pro'},
+        {'min_tokens': 10000, 'model': 'gemini-2.5-pro'}
+    ]
+    
+    def test_first_matching_rule_wins(self):
+        """Test routing on tool, prompt size and output format"""
+        router = ModelRouter('default-model', rules=self.RULES)
+        
+        assert router.route(50, tool='consult_gemini') == ('gemini-2.5-flash', 'rule 0')
+        assert router.route(500, tool='consult_gemini') == ('default-model', 'default')
+        assert router.route(500, tool='enhance_user_request', output_format='detailed_plan')[0] == 'gemini-2.5-pro'
+        assert router.route(500, tool='enhance_user_request', output_format='quick_summary')[0] == 'default-model'
+        assert router.route(20000, tool='consult_gemini')[0] == 'gemini-2.5-pro'
+        
+        stats = router.stats()
+        assert stats['routes'] == {'gemini-2.5-flash': 1, 'default-model': 2, 'gemini-2.5-pro': 2}
+        assert stats['recent'][-1] == {'model': 'gemini-2.5-pro', 'reason': 'rule 2', 'tokens': 20000,
+                                       'tool': 'consult_gemini'}
+    
+    def test_falls_back_when_over_latency_slo(self):
+        """Test that a model whose p95 exceeds its SLO is routed to the fallback"""
+        latency = LatencyTracker()
+        router = ModelRouter('default-model', rules=self.RULES, latency=latency,
+                             latency_slo={'gemini-2.5-pro': 30}, fallback_model='gemini-2.5-flash', min_samples=3)
+        
+        for _ in range(2):
+            latency.record('gemini-2.5-pro', 90.0)
+        assert router.route(20000)[0] == 'gemini-2.5-pro'
+        
+        latency.record('gemini-2.5-pro', 90.0)
+        model, reason = router.route(20000)
+        assert model == 'gemini-2.5-flash'
+        assert 'latency SLO' in reason
+    
+    @pytest.mark.asyncio
+    async def test_consult_gemini_uses_routed_model(self):
+        """Test that consult_gemini runs the CLI with the routed model"""
+        integration = GeminiIntegration({'model': 'gemini-2.5-pro', 'routing': {'rules': self.RULES}})
+        
+        with patch.object(integration, '_execute_gemini_cli', new_callable=AsyncMock) as mock_cli:
+            mock_cli.return_value = {'output': 'answer', 'execution_time': 0.1}
+            with patch.object(integration, '_enforce_rate_limit'):
+                result = await integration.consult_gemini("short question", tool="consult_gemini")
+        
+        assert result['model'] == 'gemini-2.5-flash'
+        assert mock_cli.call_args.kwargs['model'] == 'gemini-2.5-flash'
+        assert integration.get_status_info()['routing']['routes'] == {'gemini-2.5-flash': 1}
+    
+    @pytest.mark.asyncio
+    async def test_cache_hits_are_not_counted_as_routes(self):
+        """Test that only dispatched consultations show up in the routing stats"""
+        integration = GeminiIntegration({'model': 'gemini-2.5-pro', 'routing': {'rules': self.RULES}})
+        
+        with patch.object(integration, '_execute_gemini_cli', new_callable=AsyncMock) as mock_cli:
+            mock_cli.return_value = {'output': 'answer', 'execution_time': 0.1}
+            with patch.object(integration, '_enforce_rate_limit'):
+                first = await integration.consult_gemini("short question", tool="consult_gemini")
+                second = await integration.consult_gemini("short question", tool="consult_gemini")
+        
+        routing = integration.get_status_info()['routing']
+        assert first['cached'] == False
+        assert second['cached'] == True
+        assert routing['routes'] == {'gemini-2.5-flash': 1}
+        assert len(routing['recent']) == 1
+        assert routing['recent'][0]['tool'] == 'consult_gemini'
+
+
+class StubGeminiHandler(BaseHTTPRequestHandler):
+    """Minimal stand-in for the Gemini REST API"""
+    
+    protocol_version = "HTTP/1.1"
+    
+    def log_message(self, *args):
+        pass
+    
+    def _send(self, status, body, content_type="application/json"):
+        data = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+    
+    def do_POST(self):
+        self.server.clients.add(self.client_address)
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        prompt = payload["contents"][0]["parts"][0]["text"]
+        
+        if self.headers.get("x-goog-api-key") != "test-key":
+            self._send(403, json.dumps({"error": {"message": "API key not valid"}}))
+        elif ":streamGenerateContent" in self.path:
+            events = "".join(
+                f"data: {json.dumps({'candidates': [{'content': {'parts': [{'text': part}]}}]})}\r\n\r\n"
+                for part in ("stub ", "answer")
+            )
+            self._send(200, events, "text/event-stream")
+        else:
+            answer = {"candidates": [{"content": {"parts": [{"text": f"stub answer to: {prompt.splitlines()[-1]}"}]}}]}
+            self._send(200, json.dumps(answer))
+
+
+@pytest.fixture
+def stub_gemini_api():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubGeminiHandler)
+    server.clients = set()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class TestBackends:
+    """Test cases for the pluggable consultation backends"""
+    
+    def test_backend_selection(self):
+        """Test that the backend comes from config and defaults to the CLI"""
+        assert isinstance(GeminiIntegration().backend, CLIBackend)
+        assert isinstance(GeminiIntegration({'backend': 'http'}).backend, HTTPBackend)
+        assert isinstance(GeminiIntegration({'backend': 'unknown'}).backend, CLIBackend)
+    
+    def test_backend_base_is_abstract(self):
+        """Test that a backend must implement generate"""
+        with pytest.raises(TypeError):
+            GeminiBackend()
+    
+    @pytest.mark.asyncio
+    async def test_http_backend_reuses_connection(self, stub_gemini_api):
+        """Test consultations over HTTP share one keep-alive connection"""
+        integration = GeminiIntegration({
+            'backend': 'http',
+            'api_key': 'test-key',
+            'api_base_url': f"http://127.0.0.1:{stub_gemini_api.server_port}/v1beta",
+            'cache_enabled': False,
+            'rate_limit_delay': 0
+        })
+        
+        received = []
+        
+        try:
+            first = await integration.consult_gemini("first question", comparison_mode=False)
+            second = await integration.consult_gemini("second question", comparison_mode=False,
+                                                      on_progress=received.append)
+        finally:
+            await integration.close()
+        
+        assert first['status'] == 'success'
+        # Without a progress listener the plain generateContent call is used
+        assert first['response'] == "stub answer to: first question"
+        assert second['response'] == "stub answer"
+        assert received == ["stub ", "answer"]
+        assert len(stub_gemini_api.clients) == 1
+        assert integration.backend.stats()['requests'] == 2
+    
+    @pytest.mark.asyncio
+    async def test_http_backend_generate_content(self, stub_gemini_api):
+        """Test a non-streaming call returns the candidate text"""
+        backend = HTTPBackend('test-key', base_url=f"http://127.0.0.1:{stub_gemini_api.server_port}/v1beta")
+        
+        try:
+            result = await backend.generate("a question", "gemini-2.5-flash")
+        finally:
+            await backend.close()
+        
+        assert result['output'] == "stub answer to: a question"
+    
+    @pytest.mark.asyncio
+    async def test_http_backend_streams_partial_output(self, stub_gemini_api):
+        """Test that streamed API chunks reach the progress callback"""
+        backend = HTTPBackend('test-key', base_url=f"http://127.0.0.1:{stub_gemini_api.server_port}/v1beta")
+        received = []
+        
+        try:
+            result = await backend.generate("question", "gemini-2.5-flash", on_output=received.append)
+        finally:
+            await backend.close()
+        
+        assert received == ["stub ", "answer"]
+        assert result['output'] == "stub answer"
+    
+    @pytest.mark.asyncio
+    async def test_http_backend_authentication_error(self, stub_gemini_api):
+        """Test that rejected API keys surface as authentication errors"""
+        integration = GeminiIntegration({
+            'backend': 'http',
+            'api_key': 'wrong-key',
+            'api_base_url': f"http://127.0.0.1:{stub_gemini_api.server_port}/v1beta",
+            'rate_limit_delay': 0
+        })
+        
+        try:
+            result = await integration.consult_gemini("question")
+        finally:
+            await integration.close()
+        
+        assert result['status'] == 'error'
+        assert result['error_type'] == 'authentication'
+        assert "API key not valid" in result['error']
+
+
 class TestSingletonPattern:
     """Test singleton pattern implementation"""
     
@@ -6,7 +6,7 @@ import json
 import os
 import pytest
 from pathlib import Path
-from unittest.mock import AsyncMock, MagicMock, patch
+from unittest.mock import AsyncMock, MagicMock, PropertyMock, patch
 import tempfile
 
 import mcp.types as types
@@ -141,7 +141,7 @@ class TestMCPServerTools:
             assert isinstance(result[0], types.TextContent)
             assert 'Gemini Second Opinion' in result[0].text
             assert 'Gemini analysis response' in result[0].text
-            assert '1.5s' in result[0].text
+            assert '1.50s' in result[0].text
     
     @pytest.mark.asyncio
     async def test_handle_consult_gemini_missing_query(self, server):
@@ -216,11 +216,117 @@ class TestMCPServerTools:
             status_text = result[0].text
             
             assert 'Gemini Integration Status' in status_text
-            assert 'Enabled: ✅ Yes' in status_text
-            assert 'Auto-consult: ✅ Yes' in status_text
-            assert 'Total Consultations: 5' in status_text
-            assert 'Successful: 4' in status_text
-            assert 'Failed: 1' in status_text
+            assert '**Enabled**: ✅ Yes' in status_text
+            assert '**Auto-consult**: ✅ Yes' in status_text
+            assert '**Total Consultations**: 5' in status_text
+            assert '**Successful**: 4' in status_text
+            assert '**Failed**: 1' in status_text
+    
+    def test_progress_reporter_outside_request(self, server):
+        """Test that no progress callback is created outside a tool call"""
+        assert server._progress_reporter() is None
+    
+    @pytest.mark.asyncio
+    async def test_progress_reporter_sends_notifications(self, server):
+        """Test that partial output is forwarded as MCP progress notifications"""
+        ctx = MagicMock()
+        ctx.meta.progressToken = "token-1"
+        ctx.session.send_progress_notification = AsyncMock()
+        
+        with patch.object(type(server.server), 'request_context', new_callable=PropertyMock, return_value=ctx):
+            report = server._progress_reporter()
+        
+        await report("partial ")
+        await report("answer")
+        
+        calls = ctx.session.send_progress_notification.call_args_list
+        assert calls[0].args == ("token-1", 8)
+        assert calls[1].kwargs['message'] == "answer"
+        assert calls[1].args == ("token-1", 14)
+    
+    @pytest.mark.asyncio
+    async def test_handle_detect_uncertainty_batch(self, server):
+        """Test detect_uncertainty_batch tool call"""
+        arguments = {
+            'texts': ["I think this is broken", "All good"],
+            'include_patterns': True
+        }
+        
+        result = await server._handle_detect_uncertainty_batch(arguments)
+        
+        assert len(result) == 1
+        text = result[0].text
+        assert 'Uncertainty Batch Analysis' in text
+        assert 'Texts analyzed**: 2' in text
+        assert 'Needing consultation**: 1' in text
+        assert '\\bI think\\b' in text
+    
+    @pytest.mark.asyncio
+    async def test_handle_detect_uncertainty_batch_invalid(self, server):
+        """Test detect_uncertainty_batch with invalid texts"""
+        result = await server._handle_detect_uncertainty_batch({'texts': "not a list"})
+        
+        assert 'Error' in result[0].text
+    
+    @pytest.mark.asyncio
+    async def test_handle_end_gemini_session(self, server):
+        """Test ending a known and an unknown consultation session"""
+        server.gemini.sessions.open("s1", "stored context", new=True)
+        
+        ended = await server._handle_end_gemini_session({'session_id': 's1'})
+        unknown = await server._handle_end_gemini_session({'session_id': 's1'})
+        
+        assert 'Session ended' in ended[0].text
+        assert 'Unknown session' in unknown[0].text
+    
+    @pytest.mark.asyncio
+    async def test_handle_consultation_job_tools(self, server):
+        """Test submitting, polling and cancelling a consultation job"""
+        mock_result = {
+            'status': 'success',
+            'response': 'Background answer',
+            'execution_time': 42.0,
+            'consultation_id': 'job_consult'
+        }
+        
+        with patch.object(server.gemini, 'consult_gemini', return_value=mock_result):
+            submitted = await server._handle_submit_consultation({'query': 'Long question'})
+            job_id = submitted[0].text.split('`')[1]
+            polled = await server._handle_get_consultation_result({'job_id': job_id, 'wait_seconds': 1})
+        cancelled = await server._handle_cancel_consultation({'job_id': job_id})
+        unknown = await server._handle_get_consultation_result({'job_id': 'missing'})
+        
+        assert 'Consultation submitted' in submitted[0].text
+        assert 'Background answer' in polled[0].text
+        assert 'already completed' in cancelled[0].text
+        assert 'Unknown job' in unknown[0].text
+    
+    @pytest.mark.asyncio
+    async def test_handle_consult_gemini_batch(self, server):
+        """Test batch consultation output lists every item in order"""
+        mock_batch = {
+            'status': 'partial',
+            'results': [
+                {'index': 0, 'status': 'success', 'response': 'First answer', 'elapsed': 1.5},
+                {'index': 1, 'status': 'error', 'error': 'Rate limited', 'error_type': 'rate_limit', 'elapsed': 0.5}
+            ],
+            'succeeded': 1,
+            'failed': 1,
+            'execution_time': 2.0
+        }
+        
+        with patch.object(server.gemini, 'consult_gemini_batch', return_value=mock_batch) as mock_batch_call:
+            result = await server._handle_consult_gemini_batch({
+                'items': [{'query': 'a'}, {'query': 'b'}],
+                'parallelism': 3
+            })
+        invalid = await server._handle_consult_gemini_batch({'items': 'not a list'})
+        
+        assert mock_batch_call.call_args.kwargs['parallelism'] == 3
+        assert '1/2 succeeded' in result[0].text
+        assert result[0].text.index('First answer') < result[0].text.index('Rate limited')
+        assert 'rate_limit' in result[0].text
+        assert 'non-empty list' in invalid[0].text
     
     @pytest.mark.asyncio
     async def test_handle_toggle_auto_consult_enable(self, server):